@@ -0,0 +1,85 @@
+"""
+Scaling of the blocked clustering engine against the previous pairwise loop of `clustering_custom`,
+on synthetic normalized embeddings (no model needed).
+
+python -m bench.clustering [N ...]
+"""
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+from helpers.clustering import cluster_embeddings
+
+SIZES = [100, 1000, 5000, 20000]
+### the pairwise loop is quadratic in Python, skip it above this size
+MAX_LOOP_SIZE = 2000
+DIMENSION = 384
+THRESHOLD = 0.7
+
+def clustering_loop(embeddings, similarity_threshold):
+    """
+    The previous implementation of `clustering_custom`
+    """
+    n = len(embeddings)
+    similarities = np.zeros((n, n))
+    for i in range(n):
+        for j in range(i+1, n):
+            similarities[i][j] = np.dot(embeddings[i], embeddings[j])
+            similarities[j][i] = similarities[i][j]
+
+    labels = [i for i in range(n)]
+    visited = [False for _ in range(n)]
+    for i in range(n):
+        if visited[i]:
+            continue
+        visited[i] = True
+        for j in range(i+1, n):
+            if visited[j]:
+                continue
+            if similarities[i][j] >= similarity_threshold:
+                visited[j] = True
+                labels[j] = labels[i]
+    return labels
+
+def synthetic_embeddings(n, seed=0):
+    """
+    Noisy copies of n/10 centers, similar to repeated link texts
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 10), DIMENSION))
+    embeddings = centers[rng.integers(0, len(centers), n)] + 0.6 * rng.standard_normal((n, DIMENSION))
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    return embeddings.astype(np.float32)
+
+def measure(f):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = f()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def run(sizes=SIZES):
+    results = {}
+    for n in sizes:
+        embeddings = synthetic_embeddings(n)
+        runs = {}
+        if n <= MAX_LOOP_SIZE:
+            runs["loop"] = lambda: clustering_loop(embeddings, THRESHOLD)
+        runs["leader"] = lambda: cluster_embeddings(embeddings, THRESHOLD, mode="leader")
+        runs["components"] = lambda: cluster_embeddings(embeddings, THRESHOLD, mode="components")
+
+        labels = {}
+        for name, f in runs.items():
+            labels[name], elapsed, peak = measure(f)
+            results[(n, name)] = (elapsed, peak)
+            print(f"n={n:6d} {name:10s} {elapsed:8.3f}s peak {peak / 1024 / 1024:8.1f}MB clusters {len(set(labels[name])):6d}")
+        if "loop" in labels and labels["loop"] != labels["leader"]:
+            print(f"WARNING: leader labels differ from the loop for n={n}")
+    return results
+
+if __name__ == "__main__":
+    run([int(n) for n in sys.argv[1:]] or SIZES)
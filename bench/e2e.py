@@ -0,0 +1,121 @@
+"""
+End-to-end throughput of `setup_ds` on synthetic pools of N videos against the local OpenAI stand-in
+(`bench.stand_in_server`): wall time, LLM requests/sec and peak RSS per pool size.
+
+Each size runs in a fresh working directory and its own process (so the peak RSS is its own), from ingestion
+(local fetch, frame extraction, Whisper through the stand-in) to export, with the response cache disabled.
+
+python -m bench.e2e [N ...] [-w WORKERS] [--chat-latency SPEC] [--audio-latency SPEC] [--rate-limit P] [--fixtures DIR] [--json FILE]
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+
+from argparse import ArgumentParser, SUPPRESS
+
+from bench.stand_in_server import StandInServer, FixtureStore
+
+SIZES = [2, 6, 20, 50]
+RESULT_PREFIX = "E2E_RESULT "
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def run_task(task_id, workers):
+    """
+    Runs in the benchmark process, inside the working directory of the pool
+    """
+    import resource
+    from helpers import configure_response_cache, set_max_concurrent_requests, transcribe_audio
+    from preprocess import setup_ds
+
+    configure_response_cache(enabled=False)
+    set_max_concurrent_requests(workers)
+    start = time.perf_counter()
+    error = None
+    try:
+        setup_ds(task_id, workers=workers, local_ingest=True, transcribe_f=transcribe_audio)
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    wall = time.perf_counter() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(RESULT_PREFIX + json.dumps({"wall": wall, "peak_rss": peak_rss, "error": error}))
+
+def run(sizes=SIZES, workers=8, chat_latency="uniform:0.05:0.2", audio_latency="uniform:0.1:0.3", rate_limit_rate=0, fixtures_path=None, keep=False):
+    """
+    Returns {n: {"wall", "requests", "rate_limited", "req_per_sec", "peak_rss", "error"}};
+    a run that did not get through the pipeline has its `error` and no `req_per_sec`, it is not a throughput
+    """
+    work_root = tempfile.mkdtemp(prefix="e2e-")
+    fixtures = FixtureStore(fixtures_path or os.path.join(work_root, "fixtures"))
+    server = StandInServer(fixtures, chat_latency, audio_latency, rate_limit_rate)
+    base_url = server.start(port=0)
+    results = {}
+    try:
+        from bench.synthetic_pool import generate_pool
+        for n in sizes:
+            work_dir = os.path.join(work_root, f"n{n}")
+            task_id = generate_pool(work_dir, n, fixtures)
+            server.reset_stats()
+            python_path = os.pathsep.join([REPO_PATH] + ([os.environ["PYTHONPATH"]] if "PYTHONPATH" in os.environ else []))
+            env = dict(os.environ, OPENAI_BASE_URL=base_url, OPENAI_API_KEY="stand-in", PYTHONPATH=python_path)
+            process = subprocess.run(
+                [sys.executable, "-m", "bench.e2e", "--run", task_id, "-w", str(workers)],
+                cwd=work_dir, env=env, capture_output=True, text=True,
+            )
+            lines = [line for line in process.stdout.splitlines() if line.startswith(RESULT_PREFIX)]
+            if len(lines) == 0:
+                print(process.stdout[-2000:])
+                print(process.stderr[-2000:])
+                results[n] = {"wall": None, "requests": None, "rate_limited": None, "req_per_sec": None, "peak_rss": None, "error": f"exit code {process.returncode}"}
+                print(f"n={n:3d} FAILED exit code {process.returncode}")
+                continue
+            result = json.loads(lines[-1][len(RESULT_PREFIX):])
+            stats = server.stats()
+            requests = stats["chat"] + stats["audio"]
+            results[n] = {
+                "wall": result["wall"],
+                "requests": requests,
+                "rate_limited": stats["rate_limited"],
+                "req_per_sec": requests / max(result["wall"], 1e-9) if result["error"] is None else None,
+                "peak_rss": result["peak_rss"],
+                "error": result["error"],
+            }
+            if result["error"] is not None:
+                print(f"n={n:3d} FAILED after {result['wall']:8.2f}s requests {requests:6d}  {result['error']}")
+            else:
+                print(
+                    f"n={n:3d} wall {result['wall']:8.2f}s requests {requests:6d} (429: {stats['rate_limited']:4d}) "
+                    f"{results[n]['req_per_sec']:7.2f} req/s peak RSS {result['peak_rss'] / 1024 / 1024:8.1f}MB"
+                )
+            if not keep:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        server.stop()
+        if not keep:
+            shutil.rmtree(work_root, ignore_errors=True)
+    return results
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("sizes", nargs="*", type=int, default=SIZES, help="Numbers of videos")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=8, help="Number of concurrent LLM calls")
+    parser.add_argument("--chat-latency", dest="chat_latency", default="uniform:0.05:0.2", help="Latency of chat completions (see `bench.stand_in_server.LatencyModel`)")
+    parser.add_argument("--audio-latency", dest="audio_latency", default="uniform:0.1:0.3", help="Latency of transcriptions")
+    parser.add_argument("--rate-limit", dest="rate_limit_rate", type=float, default=0, help="Share of requests answered with 429")
+    parser.add_argument("--fixtures", dest="fixtures_path", default=None, help="Replay recorded fixtures from this directory")
+    parser.add_argument("--keep", dest="keep", action="store_true", help="Keep the working directories")
+    parser.add_argument("--json", dest="json_path", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--run", dest="run_task_id", default=None, help=SUPPRESS)
+    parsed_args = parser.parse_args(sys.argv[1:])
+
+    if parsed_args.run_task_id is not None:
+        run_task(parsed_args.run_task_id, parsed_args.workers)
+    else:
+        results = run(parsed_args.sizes, parsed_args.workers, parsed_args.chat_latency, parsed_args.audio_latency,
+            parsed_args.rate_limit_rate, parsed_args.fixtures_path, parsed_args.keep)
+        if parsed_args.json_path is not None:
+            with open(parsed_args.json_path, "w") as file:
+                json.dump({str(n): result for n, result in results.items()}, file, indent=2)
@@ -0,0 +1,67 @@
+"""
+Compare frames/sec of the streaming `extract_frames` against the previous seek-based loop.
+
+python -m bench.extract_frames VIDEO_PATH [VIDEO_PATH ...]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+
+import cv2
+
+from helpers.video_scripts import extract_frames, extract_frames_parallel
+
+def extract_frames_seek(video_path):
+    """
+    The previous implementation: one `CAP_PROP_POS_MSEC` seek per second of video
+    """
+    frames_dir = f"{video_path}_frames"
+    os.makedirs(frames_dir)
+    video_cap = cv2.VideoCapture(video_path)
+    seconds = 0
+    while True:
+        video_cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000 + 500)
+        res, frame = video_cap.read()
+        if (res == False):
+            break
+        cv2.imwrite(f"{frames_dir}/{seconds}.jpg", frame)
+        seconds += 1
+    video_cap.release()
+    return seconds
+
+def copy_videos(video_paths, tmp_dir):
+    os.makedirs(tmp_dir)
+    copies = []
+    for index, video_path in enumerate(video_paths):
+        copy_path = os.path.join(tmp_dir, f"{index}-{os.path.basename(video_path)}")
+        shutil.copy(video_path, copy_path)
+        copies.append(copy_path)
+    return copies
+
+def run(video_paths, workers=None):
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        copies = copy_videos(video_paths, os.path.join(tmp_dir, "seek"))
+        start = time.perf_counter()
+        frames = sum([extract_frames_seek(path) for path in copies])
+        results["seek"] = (frames, time.perf_counter() - start)
+
+        copies = copy_videos(video_paths, os.path.join(tmp_dir, "stream"))
+        start = time.perf_counter()
+        frames = sum([len(extract_frames(path)) for path in copies])
+        results["stream"] = (frames, time.perf_counter() - start)
+
+        if len(video_paths) > 1:
+            copies = copy_videos(video_paths, os.path.join(tmp_dir, "pool"))
+            start = time.perf_counter()
+            frames = sum([len(paths) for paths in extract_frames_parallel(copies, workers).values()])
+            results["stream+pool"] = (frames, time.perf_counter() - start)
+
+    for name, (frames, elapsed) in results.items():
+        print(f"{name:12s} {frames:6d} frames {elapsed:8.2f}s {frames / elapsed:8.1f} frames/sec")
+    return results
+
+if __name__ == "__main__":
+    run(sys.argv[1:])
@@ -0,0 +1,55 @@
+"""
+Wall time of importing the pipeline modules and of `preprocess.py -h` in fresh interpreters,
+plus the slowest imports reported by `python -X importtime`.
+
+python -m bench.import_time [MODULE ...]
+"""
+import sys
+import time
+import subprocess
+
+MODULES = ["helpers", "helpers.bert", "helpers.clip", "helpers.video_scripts", "src.VideoPool", "preprocess"]
+REPEATS = 3
+TOP_IMPORTS = 10
+
+def time_command(command):
+    """
+    Best of `REPEATS` wall times of `command` in seconds
+    """
+    best = None
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+def slowest_imports(module):
+    """
+    Returns [(cumulative seconds, imported module)] of the slowest imports of `module`
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        imports.append((int(cumulative) / 1e6, name.strip()))
+    return sorted(imports, reverse=True)[:TOP_IMPORTS]
+
+def run(modules=MODULES):
+    baseline = time_command([sys.executable, "-c", "pass"])
+    results = {}
+    for module in modules:
+        results[module] = time_command([sys.executable, "-c", f"import {module}"]) - baseline
+        print(f"import {module:24s} {results[module]:8.3f}s")
+    results["preprocess.py -h"] = time_command([sys.executable, "preprocess.py", "-h"]) - baseline
+    print(f"{'preprocess.py -h':31s} {results['preprocess.py -h']:8.3f}s")
+
+    print(f"\nslowest imports of {modules[-1]}:")
+    for cumulative, name in slowest_imports(modules[-1]):
+        print(f"{cumulative:8.3f}s {name}")
+    return results
+
+if __name__ == "__main__":
+    run(sys.argv[1:] or MODULES)
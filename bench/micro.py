@@ -0,0 +1,303 @@
+"""
+Microbenchmarks of the per-video helpers at several input sizes: best wall time of `REPEATS` runs and the peak
+memory traced by `tracemalloc` (Python and numpy allocations, not the ones made inside torch or OpenCV).
+
+Inputs are synthetic and seeded, every case runs in a fresh working directory (so no cache of the repository is
+used or touched) and the results are written as JSON with the commit they were measured on, to compare commits:
+
+python -m bench.micro [CASE ...] [-r REPEATS] [--json FILE] [--compare BASELINE.json]
+
+Cases that need a model (`sentence_transformers`, `torch`/`clip`) are skipped when it is not installed.
+"""
+import os
+import sys
+import copy
+import json
+import time
+import random
+import shutil
+import platform
+import tempfile
+import subprocess
+import tracemalloc
+
+from argparse import ArgumentParser
+
+REPEATS = 5
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+### texts passed to `clip_similar_per_text` per call
+CLIP_TEXTS = 10
+### queries passed to `find_most_similar` per call
+QUERIES = 100
+### a run is reported as slower/faster in `--compare` beyond this ratio
+COMPARE_THRESHOLD = 1.1
+
+def synthetic_texts(n, rng):
+    from bench.stand_in_server import WORDS
+    return [" ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 16))).capitalize() + "." for _ in range(n)]
+
+def synthetic_frames(work_dir, name, seconds, rng):
+    """
+    Frame paths of a synthetic video of `seconds` distinct frames
+    """
+    from bench.synthetic_pool import write_video
+    from helpers.video_scripts import extract_frames
+    video_path = os.path.join(work_dir, f"{name}-{seconds}.mp4")
+    write_video(video_path, seconds, rng)
+    return extract_frames(video_path)
+
+def prepare_bert_embedding(size, work_dir, rng):
+    """
+    Cold: a new embedding cache per run, so all `size` texts are encoded
+    """
+    import helpers.bert as bert
+    from helpers.embedding_cache import EmbeddingCache
+    bert.get_model()
+    texts = synthetic_texts(size, rng)
+    runs = [0]
+    def setup():
+        runs[0] += 1
+        bert.EMBEDDING_CACHE = EmbeddingCache(os.path.join(work_dir, f"embeddings-{size}-{runs[0]}.sqlite"))
+        return (texts,)
+    return setup, bert.bert_embedding
+
+def prepare_find_most_similar(size, work_dir, rng):
+    from bench.clustering import synthetic_embeddings
+    from helpers.bert import find_most_similar
+    embeddings = synthetic_embeddings(size, seed=rng.randint(0, 1000))
+    queries = synthetic_embeddings(QUERIES, seed=rng.randint(0, 1000))
+    return lambda: (embeddings, queries), find_most_similar
+
+def prepare_clustering_custom(size, work_dir, rng):
+    """
+    The embeddings are cached, as after the first stage that embeds the texts
+    """
+    import helpers.bert as bert
+    from helpers.embedding_cache import EmbeddingCache
+    bert.EMBEDDING_CACHE = EmbeddingCache(os.path.join(work_dir, f"embeddings-clustering-{size}.sqlite"))
+    texts = synthetic_texts(size, rng)
+    bert.bert_embedding(texts)
+    return lambda: (texts, 0.7), bert.clustering_custom
+
+def prepare_clip_embed_image(size, work_dir, rng):
+    import helpers.clip as clip
+    clip.get_model()
+    frame_paths = synthetic_frames(work_dir, "clip_embed_image", size, rng)
+    return lambda: (frame_paths,), clip.clip_embed_image
+
+def prepare_clip_similar_per_text(size, work_dir, rng):
+    """
+    The CLIP index of the video is built beforehand, the texts are encoded on every run
+    """
+    import helpers.clip as clip
+    frame_paths = synthetic_frames(work_dir, "clip_similar_per_text", size, rng)
+    texts = synthetic_texts(CLIP_TEXTS, rng)
+    clip.clip_similar_per_text(texts, frame_paths)
+    return lambda: (texts, frame_paths), clip.clip_similar_per_text
+
+def prepare_extract_frames(size, work_dir, rng):
+    from bench.synthetic_pool import write_video
+    from helpers.frame_store import get_pack_path, get_index_path
+    from helpers.video_scripts import extract_frames
+    video_path = os.path.join(work_dir, f"extract-{size}.mp4")
+    write_video(video_path, size, rng)
+    def setup():
+        for path in [get_pack_path(video_path), get_index_path(video_path)]:
+            if os.path.exists(path):
+                os.remove(path)
+        return (video_path,)
+    return setup, extract_frames
+
+def prepare_transcript_from_response(size, work_dir, rng):
+    """
+    The sentence realignment of `extract_transcript_from_audio_openai` on a transcription of `size` segments
+    """
+    from bench.synthetic_pool import synthetic_transcription
+    from helpers.video_scripts import transcript_from_response
+    response = synthetic_transcription(rng, sentences=size)
+    return lambda: (copy.deepcopy(response),), transcript_from_response
+
+def prepare_extend_contents(size, work_dir, rng):
+    """
+    Cold: a new image cache per run, so all `size` frames are downscaled and encoded;
+    the frame hashes are known, as when they are loaded from `Video.frames`
+    """
+    import helpers
+    from helpers.image_cache import ImageCache
+    from helpers.frame_dedup import dedup_frame_paths
+    frame_paths = synthetic_frames(work_dir, "extend_contents", size, rng)
+    dedup_frame_paths(frame_paths)
+    texts = synthetic_texts(size, rng)
+    contents = [{"text": text, "frame_paths": [frame_path]} for text, frame_path in zip(texts, frame_paths)]
+    runs = [0]
+    def setup():
+        runs[0] += 1
+        helpers.IMAGE_CACHE = ImageCache(os.path.join(work_dir, f"images-{size}-{runs[0]}"))
+        return (contents,)
+    return setup, lambda contents: helpers.extend_contents(contents, include_images=True)
+
+def synthetic_video_dict(seconds, rng):
+    """
+    A processed video of `seconds` seconds with one sentence every 5 seconds, in the format of `Video.to_dict`
+    """
+    video_id = f"micro-{seconds}"
+    video_path = f"static/database/{video_id}.mp4"
+    frames = {
+        str(sec): {"path": f"{video_path}_frames/{sec}.jpg", "caption": "", "hash": f"{rng.getrandbits(64):016x}"}
+        for sec in range(seconds)
+    }
+    texts = synthetic_texts(max(1, seconds // 5), rng)
+    subtitles = [{"start": index * 5.0, "finish": (index + 1) * 5.0, "text": text} for index, text in enumerate(texts)]
+    sentences = [{
+        **subtitle,
+        "frame_paths": [frames[str(int(subtitle["start"]) + offset)]["path"] for offset in range(0, 5) if int(subtitle["start"]) + offset < seconds],
+        "id": f"{video_id}-{index}",
+    } for index, subtitle in enumerate(subtitles)]
+    steps = texts[:20]
+    return {
+        "video_id": video_id,
+        "video_link": f"https://www.youtube.com/watch?v={video_id}",
+        "frames": frames,
+        "subtitles": subtitles,
+        "sentences": sentences,
+        "steps": steps,
+        "subgoals": [],
+        "meta_summary": None,
+        "subgoal_summaries": [],
+        "metadata": {"title": video_id, "duration": seconds, "width": 160, "height": 90, "fps": 2},
+    }
+
+def prepare_video_round_trip(size, work_dir, rng):
+    """
+    `to_dict`, JSON and back with `from_dict`, as a video goes through the JSON state store
+    """
+    from src.Video import Video
+    data = synthetic_video_dict(size, rng)
+    video = Video(data["video_link"])
+    video.from_dict(**data)
+    def round_trip(video):
+        data = json.loads(json.dumps(video.to_dict()))
+        result = Video(data["video_link"])
+        result.from_dict(**data)
+        return result
+    return lambda: (video,), round_trip
+
+### name: (prepare(size, work_dir, rng) -> (setup() -> args, f(*args)), sizes)
+CASES = {
+    "bert_embedding": (prepare_bert_embedding, [10, 100, 1000]),
+    "find_most_similar": (prepare_find_most_similar, [1000, 10000, 50000]),
+    "clustering_custom": (prepare_clustering_custom, [100, 1000, 5000]),
+    "clip_embed_image": (prepare_clip_embed_image, [16, 64, 256]),
+    "clip_similar_per_text": (prepare_clip_similar_per_text, [16, 64, 256]),
+    "extract_frames": (prepare_extract_frames, [30, 120, 600]),
+    "transcript_from_response": (prepare_transcript_from_response, [50, 200, 1000]),
+    "extend_contents": (prepare_extend_contents, [10, 50, 200]),
+    "video_round_trip": (prepare_video_round_trip, [600, 3600, 14400]),
+}
+
+def measure(setup, f, repeats):
+    """
+    Returns (wall times of `repeats` runs, peak traced memory of one more run); `setup` is not measured
+    """
+    times = []
+    for _ in range(repeats):
+        args = setup()
+        start = time.perf_counter()
+        f(*args)
+        times.append(time.perf_counter() - start)
+    args = setup()
+    tracemalloc.start()
+    f(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return times, peak
+
+def get_commit():
+    """
+    Returns (commit, whether the working tree has uncommitted changes) or (None, None) outside of git
+    """
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], cwd=REPO_PATH, capture_output=True, text=True, check=True).stdout.strip()
+        status = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_PATH, capture_output=True, text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, status.strip() != ""
+
+def run(names=None, repeats=REPEATS):
+    """
+    Returns [{"case", "size", "time", "times", "peak_memory", "skipped"}]
+    """
+    if names is None or len(names) == 0:
+        names = list(CASES.keys())
+    work_dir = tempfile.mkdtemp(prefix="micro-")
+    cwd = os.getcwd()
+    results = []
+    try:
+        ### relative cache paths (`static/cache/...`) resolve into the working directory
+        os.chdir(work_dir)
+        for name in names:
+            prepare, sizes = CASES[name]
+            for size in sizes:
+                result = {"case": name, "size": size, "time": None, "times": [], "peak_memory": None, "skipped": None}
+                try:
+                    setup, f = prepare(size, work_dir, random.Random(size))
+                except ImportError as e:
+                    print(f"WARNING: skipping `{name}`: {e}")
+                    results += [{**result, "size": size, "skipped": str(e)} for size in sizes]
+                    break
+                times, peak = measure(setup, f, repeats)
+                result.update({"time": min(times), "times": times, "peak_memory": peak})
+                results.append(result)
+                print(f"{name:26s} {size:7d} {result['time'] * 1000:10.2f}ms peak {peak / 1024 / 1024:8.2f}MB")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+def compare(baseline, results):
+    """
+    Prints the time and memory of `results` relative to the baseline run
+    """
+    base = {(result["case"], result["size"]): result for result in baseline["results"] if result["skipped"] is None}
+    print(f"Compared to {baseline.get('commit')}:")
+    for result in results:
+        key = (result["case"], result["size"])
+        if result["skipped"] is not None or key not in base:
+            continue
+        time_ratio = result["time"] / max(base[key]["time"], 1e-9)
+        memory_ratio = result["peak_memory"] / max(base[key]["peak_memory"], 1)
+        verdict = ""
+        if time_ratio > COMPARE_THRESHOLD:
+            verdict = "slower"
+        elif time_ratio < 1 / COMPARE_THRESHOLD:
+            verdict = "faster"
+        print(f"{key[0]:26s} {key[1]:7d} time x{time_ratio:6.2f} memory x{memory_ratio:6.2f} {verdict}")
+
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("cases", nargs="*", default=[], help=f"Cases to run (default: all): {', '.join(CASES.keys())}")
+    parser.add_argument("-r", "--repeats", dest="repeats", type=int, default=REPEATS, help="Measured runs per case and size")
+    parser.add_argument("--json", dest="json_path", default=None, help="Write the results to this JSON file")
+    parser.add_argument("--compare", dest="baseline_path", default=None, help="Compare with the results of an earlier `--json`")
+    parsed_args = parser.parse_args(sys.argv[1:])
+    for name in parsed_args.cases:
+        if name not in CASES:
+            parser.error(f"unknown case `{name}`")
+
+    results = run(parsed_args.cases, parsed_args.repeats)
+    commit, dirty = get_commit()
+    output = {
+        "commit": commit,
+        "dirty": dirty,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "repeats": parsed_args.repeats,
+        "results": results,
+    }
+    if parsed_args.json_path is not None:
+        with open(parsed_args.json_path, "w") as file:
+            json.dump(output, file, indent=2)
+    if parsed_args.baseline_path is not None:
+        with open(parsed_args.baseline_path, "r") as file:
+            compare(json.load(file), results)
@@ -0,0 +1,500 @@
+"""
+Local OpenAI-compatible stand-in server: answers `chat.completions.parse` and `audio.transcriptions` over real HTTP,
+so the whole client stack (SDK, retries, request budget, telemetry) runs without network or API spend.
+
+Responses come from recorded fixtures; requests without a fixture get a synthesized response that is valid
+for the requested JSON schema (shaped after the pipeline prompts, so every stage has something to work on).
+Point the clients at it with `OPENAI_BASE_URL=http://127.0.0.1:PORT/v1`.
+
+python -m bench.stand_in_server [--port 8321] [--fixtures DIR] [--record https://api.openai.com/v1] [--seed static/results/test]
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import hashlib
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.request import Request, urlopen
+from urllib.error import HTTPError
+
+FIXTURES_PATH = "static/cache/fixtures"
+DEFAULT_PORT = 8321
+### procedural steps the synthesized responses draw from, a small shared vocabulary keeps the subgoals bounded
+STEP_TITLES = [
+    "Gather the ingredients",
+    "Prepare the tools",
+    "Measure the quantities",
+    "Mix the base",
+    "Heat the pan",
+    "Combine the parts",
+    "Check the result",
+    "Finish and serve",
+]
+WORDS = [
+    "carefully", "slowly", "evenly", "fresh", "small", "large", "bowl", "pan", "knife", "whisk", "heat", "salt",
+    "pepper", "layer", "edge", "surface", "minute", "texture", "color", "temperature", "amount", "side", "tip",
+]
+
+def chat_fixture_key(model, messages, schema_name):
+    """
+    Fixture key of a chat request: the model, the messages and the name of the response schema
+    """
+    payload = json.dumps({"model": model, "messages": messages, "schema": schema_name}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class LatencyModel:
+    """
+    Latency distribution from a spec: `0.5` (fixed), `uniform:LOW:HIGH`, `normal:MEAN:STD` or `lognormal:MEDIAN:SIGMA` (seconds)
+    """
+    spec = "0"
+
+    def __init__(self, spec="0"):
+        self.spec = str(spec)
+        parts = self.spec.split(":")
+        self.kind = parts[0] if len(parts) > 1 else "fixed"
+        self.params = [float(part) for part in (parts[1:] if len(parts) > 1 else parts)]
+        expected = {"fixed": 1, "uniform": 2, "normal": 2, "lognormal": 2}
+        if self.kind not in expected or len(self.params) != expected[self.kind]:
+            raise ValueError(f"Invalid latency `{spec}`, expected e.g. 0.5, uniform:0.2:1, normal:0.5:0.1 or lognormal:0.5:0.4")
+
+    def sample(self, rng):
+        if self.kind == "fixed":
+            return self.params[0]
+        if self.kind == "uniform":
+            return rng.uniform(*self.params)
+        if self.kind == "normal":
+            return max(0, rng.gauss(*self.params))
+        return self.params[0] * rng.lognormvariate(0, self.params[1])
+
+class FixtureStore:
+    """
+    Recorded responses on disk: `{path}/chat/{key[:2]}/{key}.json` (message content) and `{path}/audio/{name}.json` (transcription)
+    """
+    path = FIXTURES_PATH
+
+    def __init__(self, path=FIXTURES_PATH):
+        self.path = path
+
+    def __chat_path(self, key):
+        return os.path.join(self.path, "chat", key[:2], f"{key}.json")
+
+    def __audio_path(self, name):
+        return os.path.join(self.path, "audio", f"{name}.json")
+
+    def __read(self, file_path):
+        if not os.path.exists(file_path):
+            return None
+        with open(file_path, "r") as file:
+            return json.load(file)
+
+    def __write(self, file_path, value):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path + ".tmp", "w") as file:
+            json.dump(value, file)
+        os.replace(file_path + ".tmp", file_path)
+
+    def get_chat(self, key):
+        return self.__read(self.__chat_path(key))
+
+    def put_chat(self, key, content):
+        self.__write(self.__chat_path(key), content)
+
+    def get_transcription(self, name):
+        return self.__read(self.__audio_path(name))
+
+    def put_transcription(self, name, response):
+        self.__write(self.__audio_path(name), response)
+
+def __resolve(schema, root):
+    while "$ref" in schema:
+        schema = root["$defs"][schema["$ref"].split("/")[-1]]
+    if "anyOf" in schema:
+        schema = [option for option in schema["anyOf"] if option.get("type") != "null"][0]
+    return schema
+
+def __phrase(rng, length=4):
+    return " ".join(rng.choice(WORDS) for _ in range(length)).capitalize()
+
+def synthesize_value(schema, root, rng):
+    """
+    A random value valid for the JSON `schema` (`root` holds the `$defs`)
+    """
+    schema = __resolve(schema, root)
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    if "const" in schema:
+        return schema["const"]
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: synthesize_value(value, root, rng) for name, value in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [synthesize_value(schema.get("items", {}), root, rng) for _ in range(rng.randint(1, 3))]
+    if kind == "integer":
+        return rng.randint(1, 5)
+    if kind == "number":
+        return round(rng.uniform(0, 1), 3)
+    if kind == "boolean":
+        return False
+    return __phrase(rng)
+
+def __message_text(message):
+    if isinstance(message.get("content"), list):
+        return "\n".join([content.get("text", "") for content in message["content"] if content.get("type") == "text"])
+    return message.get("content") or ""
+
+def __find_lines(messages, header):
+    """
+    The lines after `header` in the first message that starts with it
+    """
+    for message in messages:
+        text = __message_text(message)
+        if text.startswith(header):
+            return [line.strip() for line in text[len(header):].split("\n") if line.strip() != ""]
+    return []
+
+def __count_contents(messages, header):
+    """
+    Number of text contents after the `header` text of a message built with `extend_contents`
+    """
+    for message in messages:
+        if not isinstance(message.get("content"), list):
+            continue
+        texts = [content for content in message["content"] if content.get("type") == "text"]
+        if len(texts) > 0 and texts[0]["text"].startswith(header):
+            return len(texts) - 1
+    return 0
+
+def synthesize_content(messages, schema_name, schema, rng):
+    """
+    Response of a pipeline prompt (by the name of its schema), consistent with the request where the next stages depend on it;
+    any other schema gets a random valid instance
+    """
+    if schema_name == "StepsSchema":
+        count = rng.randint(4, 6)
+        return {"steps": sorted(rng.sample(STEP_TITLES, count), key=STEP_TITLES.index)}
+    if schema_name == "AggStepsSchema":
+        steps_1 = __find_lines(messages, "## Video 1:")
+        steps_2 = __find_lines(messages, "## Video 2:")
+        agg_steps = list(dict.fromkeys(steps_1 + steps_2))
+        return {
+            "agg_steps": agg_steps,
+            "assignments_1": [{"original_step": step, "agg_step": step} for step in steps_1],
+            "assignments_2": [{"original_step": step, "agg_step": step} for step in steps_2],
+        }
+    if schema_name == "AggSubgoalsSchema":
+        steps = __find_lines(messages, "## Generalized Steps:")
+        subgoals = []
+        assignments = []
+        for index in range(0, len(steps), 2):
+            title = f"Phase {index // 2 + 1}"
+            subgoals.append({"title": title, "description": " and ".join(steps[index:index + 2])})
+            for step in steps[index:index + 2]:
+                assignments.append({"step": step, "subgoal": title})
+        return {"subgoals": subgoals, "assignments": assignments}
+    if schema_name == "SegmentationSchema":
+        steps = __find_lines(messages, "## Steps:")
+        count = __count_contents(messages, "## Contents:")
+        segments = []
+        if len(steps) > 0 and count > 0:
+            bounds = [round(index * count / len(steps)) for index in range(len(steps) + 1)]
+            for step, start, end in zip(steps, bounds[:-1], bounds[1:]):
+                if end > start:
+                    segments.append({"step": step, "start_index": start, "end_index": end - 1})
+        return {"segments": segments}
+    if schema_name == "StepSummarySchema":
+        count = __count_contents(messages, "Contents:")
+        summary = {}
+        for name, value in schema.get("properties", {}).items():
+            if name.endswith("_content_ids"):
+                summary[name] = sorted(rng.sample(range(count), min(count, 2)))
+            elif value.get("type") == "array":
+                summary[name] = [__phrase(rng) for _ in range(2)]
+            else:
+                summary[name] = __phrase(rng, 8) + "."
+        return summary
+    return synthesize_value(schema, schema, rng)
+
+def synthesize_transcription(name, rng, sentences=24):
+    """
+    Verbose JSON transcription with `sentences` segments of 5 seconds
+    """
+    segments = []
+    for index in range(sentences):
+        segments.append({
+            "id": index,
+            "start": index * 5.0,
+            "end": index * 5.0 + 5.0,
+            "text": f" {__phrase(rng, 8)}.",
+        })
+    return {
+        "task": "transcribe",
+        "language": "english",
+        "duration": sentences * 5.0,
+        "text": "".join([segment["text"] for segment in segments]),
+        "segments": segments,
+    }
+
+class StandInServer:
+    """
+    The stand-in HTTP server; `start()` serves from a daemon thread, `stats()` counts the requests it answered
+    `rate_limit_rate` is the share of requests answered with a 429 (with `Retry-After: retry_after`),
+    `upstream` (e.g. https://api.openai.com/v1) records fixtures from the real API for requests without one
+    """
+    fixtures = None
+    chat_latency = None
+    audio_latency = None
+    rate_limit_rate = 0
+    retry_after = 0.1
+    upstream = None
+
+    def __init__(self, fixtures=None, chat_latency="0", audio_latency="0", rate_limit_rate=0, retry_after=0.1, upstream=None, seed=0):
+        self.fixtures = fixtures if fixtures is not None else FixtureStore()
+        self.chat_latency = LatencyModel(chat_latency)
+        self.audio_latency = LatencyModel(audio_latency)
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.upstream = upstream.rstrip("/") if upstream is not None else None
+        self.__rng = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.__server = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self.__lock:
+            self.__stats = {"chat": 0, "audio": 0, "rate_limited": 0, "fixtures": 0, "synthesized": 0, "recorded": 0, "in_flight": 0, "peak_in_flight": 0}
+
+    def stats(self):
+        with self.__lock:
+            return dict(self.__stats)
+
+    def __count(self, name, value=1):
+        with self.__lock:
+            self.__stats[name] += value
+
+    def __sample(self, f):
+        with self.__lock:
+            return f(self.__rng)
+
+    def begin_request(self, kind):
+        """
+        Count a request of `kind` ("chat" or "audio"); returns False if it is to be answered with a 429
+        """
+        with self.__lock:
+            if self.rate_limit_rate > 0 and self.__rng.random() < self.rate_limit_rate:
+                self.__stats["rate_limited"] += 1
+                return False
+            self.__stats[kind] += 1
+            self.__stats["in_flight"] += 1
+            self.__stats["peak_in_flight"] = max(self.__stats["peak_in_flight"], self.__stats["in_flight"])
+            return True
+
+    def end_request(self):
+        self.__count("in_flight", -1)
+
+    def __forward(self, path, body, headers):
+        request = Request(self.upstream + path, data=body, headers=headers, method="POST")
+        with urlopen(request) as response:
+            return json.loads(response.read())
+
+    def handle_chat(self, body, headers):
+        """
+        Returns the chat completion for the request `body`
+        """
+        request = json.loads(body)
+        response_format = request.get("response_format", {})
+        json_schema = response_format.get("json_schema", {})
+        schema_name = json_schema.get("name", "")
+        key = chat_fixture_key(request["model"], request["messages"], schema_name)
+        content = self.fixtures.get_chat(key)
+        if content is not None:
+            self.__count("fixtures")
+        elif self.upstream is not None:
+            completion = self.__forward("/chat/completions", body, headers)
+            self.fixtures.put_chat(key, completion["choices"][0]["message"]["content"])
+            self.__count("recorded")
+            return completion
+        else:
+            seed = int(key[:16], 16)
+            content = json.dumps(synthesize_content(request["messages"], schema_name, json_schema.get("schema", {}), random.Random(seed)))
+            self.__count("synthesized")
+        time.sleep(self.__sample(self.chat_latency.sample))
+
+        prompt_tokens = len(json.dumps(request["messages"])) // 4
+        return {
+            "id": f"chatcmpl-{key[:24]}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request["model"],
+            "system_fingerprint": "stand-in",
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content, "refusal": None},
+                "logprobs": None,
+                "finish_reason": "stop",
+            }],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": len(content) // 4,
+                "total_tokens": prompt_tokens + len(content) // 4,
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        }
+
+    def handle_transcription(self, body, headers):
+        """
+        Returns the transcription of the uploaded audio file, by its file name
+        """
+        match = re.search(rb'filename="([^"]+)"', body)
+        name = os.path.splitext(os.path.basename(match.group(1).decode("utf-8")))[0] if match else ""
+        response = self.fixtures.get_transcription(name)
+        if response is not None:
+            self.__count("fixtures")
+        elif self.upstream is not None:
+            response = self.__forward("/audio/transcriptions", body, headers)
+            self.fixtures.put_transcription(name, response)
+            self.__count("recorded")
+            return response
+        else:
+            response = synthesize_transcription(name, random.Random(name))
+            self.__count("synthesized")
+        time.sleep(self.__sample(self.audio_latency.sample))
+        return response
+
+    def start(self, host="127.0.0.1", port=DEFAULT_PORT):
+        """
+        Serve from a daemon thread, `port=0` picks a free port; returns the base URL for `OPENAI_BASE_URL`
+        """
+        stand_in = self
+
+        class StandInHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def __send(self, status, payload, headers={}):
+                data = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if self.path.rstrip("/").endswith("/stats"):
+                    self.__send(200, stand_in.stats())
+                else:
+                    self.__send(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                path = self.path.split("?")[0]
+                if path.startswith("/v1/"):
+                    path = path[len("/v1"):]
+                if path == "/chat/completions":
+                    handler, kind = stand_in.handle_chat, "chat"
+                elif path == "/audio/transcriptions":
+                    handler, kind = stand_in.handle_transcription, "audio"
+                else:
+                    self.__send(404, {"error": {"message": f"Unknown path {self.path}", "type": "invalid_request_error"}})
+                    return
+                if not stand_in.begin_request(kind):
+                    self.__send(429, {
+                        "error": {"message": "Rate limit reached (stand-in)", "type": "requests", "param": None, "code": "rate_limit_exceeded"},
+                    }, {"Retry-After": str(stand_in.retry_after)})
+                    return
+                try:
+                    headers = {name: self.headers[name] for name in ["Content-Type", "Authorization"] if name in self.headers}
+                    self.__send(200, handler(body, headers))
+                except HTTPError as e:
+                    self.__send(e.code, json.loads(e.read() or b"{}"))
+                except Exception as e:
+                    self.__send(500, {"error": {"message": str(e), "type": "server_error"}})
+                finally:
+                    stand_in.end_request()
+
+            def log_message(self, *args):
+                pass
+
+        self.__server = ThreadingHTTPServer((host, port), StandInHandler)
+        self.__server.daemon_threads = True
+        threading.Thread(target=self.__server.serve_forever, daemon=True).start()
+        return f"http://{host}:{self.__server.server_address[1]}/v1"
+
+    def stop(self):
+        if self.__server is not None:
+            self.__server.shutdown()
+            self.__server.server_close()
+            self.__server = None
+
+def seed_fixtures(fixtures, task_path, task):
+    """
+    Fixtures from the results of a task (e.g. static/results/test): the transcriptions of its videos from their subtitles
+    and the step extraction of each video, so replaying the task answers those requests as in the recorded run
+    Returns the number of fixtures written
+    """
+    from helpers import MODEL_NAME
+    from helpers.prompts_segmentation import define_steps_v4_request
+    from src.Video import Video
+
+    with open(os.path.join(task_path, "video_data.json"), "r") as file:
+        video_data = json.load(file)
+    written = 0
+    for data in video_data:
+        fixtures.put_transcription(data["video_id"], {
+            "task": "transcribe",
+            "language": "english",
+            "duration": data["subtitles"][-1]["finish"] if len(data["subtitles"]) > 0 else 0,
+            "text": "".join([subtitle["text"] for subtitle in data["subtitles"]]),
+            "segments": [
+                {"id": index, "start": subtitle["start"], "end": subtitle["finish"], "text": subtitle["text"]}
+                for index, subtitle in enumerate(data["subtitles"])
+            ],
+        })
+        written += 1
+        if len(data.get("steps", [])) == 0:
+            continue
+        video = Video(data["video_link"])
+        video.from_dict(**data)
+        messages, response_format = define_steps_v4_request(video.get_all_contents(), task)
+        key = chat_fixture_key(MODEL_NAME, json.loads(json.dumps(messages)), response_format.__name__)
+        fixtures.put_chat(key, json.dumps({"steps": data["steps"]}))
+        written += 1
+    return written
+
+def main(args):
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("--host", dest="host", default="127.0.0.1")
+    parser.add_argument("--port", dest="port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--fixtures", dest="fixtures", default=FIXTURES_PATH, help="Directory of the recorded responses")
+    parser.add_argument("--record", dest="upstream", default=None, help="Forward requests without a fixture to this API (e.g. https://api.openai.com/v1) and record the responses")
+    parser.add_argument("--seed", dest="seed_path", default=None, help="Seed the fixtures from the results of a task, e.g. static/results/test")
+    parser.add_argument("--seed-task", dest="seed_task", default="test", help="Task ID of --seed in metadata.json")
+    parser.add_argument("--chat-latency", dest="chat_latency", default="0", help="Latency of chat completions, e.g. 0.5, uniform:0.2:1, lognormal:0.5:0.4")
+    parser.add_argument("--audio-latency", dest="audio_latency", default="0", help="Latency of transcriptions")
+    parser.add_argument("--rate-limit", dest="rate_limit_rate", type=float, default=0, help="Share of requests answered with 429")
+    parser.add_argument("--retry-after", dest="retry_after", type=float, default=0.1, help="Retry-After of the 429 responses (seconds)")
+    parsed_args = parser.parse_args(args)
+
+    fixtures = FixtureStore(parsed_args.fixtures)
+    if parsed_args.seed_path is not None:
+        with open("./metadata.json", "r") as file:
+            task = json.load(file)[parsed_args.seed_task]["title"]
+        print(f"Seeded {seed_fixtures(fixtures, parsed_args.seed_path, task)} fixtures from {parsed_args.seed_path}")
+    server = StandInServer(fixtures, parsed_args.chat_latency, parsed_args.audio_latency,
+        parsed_args.rate_limit_rate, parsed_args.retry_after, parsed_args.upstream)
+    base_url = server.start(parsed_args.host, parsed_args.port)
+    print(f"Serving at {base_url}, run with OPENAI_BASE_URL={base_url}")
+    try:
+        while True:
+            time.sleep(60)
+            print("Stand-in:", server.stats())
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,98 @@
+"""
+Synthetic video pools for the end-to-end benchmark: N short videos with one distinct frame per second and a narration,
+written as a task of `metadata.json` in a working directory (its `static/database`), with the narrations as
+transcription fixtures of the stand-in server (`bench.stand_in_server`).
+
+python -m bench.synthetic_pool WORK_DIR N
+"""
+import os
+import sys
+import json
+import random
+
+import numpy as np
+
+from bench.stand_in_server import FixtureStore, WORDS
+
+### narration sentences per video, one every `SENTENCE_SECONDS`
+SENTENCES = 24
+SENTENCE_SECONDS = 5
+FRAME_SIZE = (160, 90)
+FPS = 2
+
+def get_task_id(n):
+    return f"synthetic-{n}"
+
+def get_video_id(index):
+    return f"synthetic-{index:04d}"
+
+def write_video(video_path, seconds, rng):
+    """
+    `seconds` of video, the color changes every second so no two frames are deduplicated
+    """
+    import cv2
+    writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*"mp4v"), FPS, FRAME_SIZE)
+    for second in range(seconds):
+        frame = np.full((FRAME_SIZE[1], FRAME_SIZE[0], 3), rng.randint(0, 255), dtype=np.uint8)
+        frame[:, :, rng.randint(0, 2)] = rng.randint(0, 255)
+        cv2.putText(frame, str(second), (10, 60), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (255, 255, 255), 2)
+        for _ in range(FPS):
+            writer.write(frame)
+    writer.release()
+
+def synthetic_transcription(rng, sentences=SENTENCES):
+    segments = []
+    for index in range(sentences):
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(6, 12))).capitalize()
+        segments.append({
+            "id": index,
+            "start": float(index * SENTENCE_SECONDS),
+            "end": float((index + 1) * SENTENCE_SECONDS),
+            "text": f" {text}.",
+        })
+    return {
+        "task": "transcribe",
+        "language": "english",
+        "duration": float(sentences * SENTENCE_SECONDS),
+        "text": "".join([segment["text"] for segment in segments]),
+        "segments": segments,
+    }
+
+def generate_pool(work_dir, n, fixtures, seed=0):
+    """
+    Writes N videos (with placeholder audio files) to `{work_dir}/static/database`, their narrations to `fixtures`
+    and the task to `{work_dir}/metadata.json`; returns the task id
+    """
+    database = os.path.join(work_dir, "static", "database")
+    os.makedirs(database, exist_ok=True)
+    video_links = []
+    for index in range(n):
+        rng = random.Random(seed * 100003 + index)
+        video_id = get_video_id(index)
+        video_path = os.path.join(database, f"{video_id}.mp4")
+        if not os.path.exists(video_path):
+            write_video(video_path, SENTENCES * SENTENCE_SECONDS, rng)
+        ### the stand-in answers the transcription by the file name, the audio itself is never decoded
+        with open(os.path.join(database, f"{video_id}.mp3"), "wb") as file:
+            file.write(b"\0" * 1024)
+        fixtures.put_transcription(video_id, synthetic_transcription(rng))
+        video_links.append(f"https://www.youtube.com/watch?v={video_id}")
+
+    task_id = get_task_id(n)
+    metadata_path = os.path.join(work_dir, "metadata.json")
+    metadata = {}
+    if os.path.exists(metadata_path):
+        with open(metadata_path, "r") as file:
+            metadata = json.load(file)
+    metadata[task_id] = {
+        "title": f"How to follow a synthetic tutorial ({n} videos)?",
+        "videos": video_links,
+    }
+    with open(metadata_path, "w") as file:
+        json.dump(metadata, file, indent=2)
+    return task_id
+
+if __name__ == "__main__":
+    work_dir, n = sys.argv[1], int(sys.argv[2])
+    fixtures = FixtureStore(os.path.join(work_dir, "fixtures"))
+    print(f"Generated task `{generate_pool(work_dir, n, fixtures)}` in {work_dir}")
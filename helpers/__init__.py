@@ -1,81 +1,390 @@
 import os
+import time
 import base64
-import json
+import asyncio
+import threading
+import weakref
 
-from openai import OpenAI
 from uuid import uuid4
+from collections import deque
 
-API_KEY = os.getenv('OPENAI_API_KEY')   
-print(API_KEY)
-client = OpenAI(
-    api_key=API_KEY,
-)
+from helpers.cache import ResponseCache, response_cache_key, LOCAL_CACHE_PATH
+from helpers.frame_store import read_frame
+from helpers.image_cache import ImageCache
+from helpers.frame_dedup import dedup_frame_paths
+from helpers.call_context import get_call_context, prompt_call
+from helpers.telemetry import TELEMETRY
+from helpers.tracing import TRACER
+
+API_KEY = os.getenv('OPENAI_API_KEY')
+### created on first use by `get_client`/`get_async_client`, importing `openai` alone takes a noticeable time
+client = None
+async_client = None
+
+### upper bound of in-flight LLM requests
+MAX_CONCURRENT_REQUESTS = 1
+### the clients do not retry themselves (`max_retries=0`), `_with_retries` does so the retries can be counted
+MAX_RETRIES = 2
+RETRY_BACKOFF = 1
+### stages may run their own event loops on different threads, async clients are per loop
+_loop_async_clients = weakref.WeakKeyDictionary()
+_loop_lock = threading.Lock()
+
+def get_client():
+    global client
+    if client is None:
+        from openai import OpenAI
+        client = OpenAI(
+            api_key=API_KEY,
+            max_retries=0,
+        )
+    return client
+
+def get_async_client():
+    """
+    The client set with `set_clients`, otherwise one client per event loop (its connections are bound to the loop)
+    """
+    if async_client is not None:
+        return async_client
+    loop = asyncio.get_running_loop()
+    with _loop_lock:
+        if loop not in _loop_async_clients:
+            from openai import AsyncOpenAI
+            _loop_async_clients[loop] = AsyncOpenAI(
+                api_key=API_KEY,
+                max_retries=0,
+            )
+        return _loop_async_clients[loop]
+
+def set_clients(sync_client=None, async_client_=None):
+    """
+    Replace the OpenAI clients, e.g. with the local stubs from `helpers.stub_client`
+    """
+    global client, async_client
+    if sync_client is not None:
+        client = sync_client
+    if async_client_ is not None:
+        async_client = async_client_
+
+class RequestBudget:
+    """
+    Bound on the LLM requests in flight across all threads and event loops, e.g. of several tasks run at once;
+    a released slot is handed to the longest waiting thread or coroutine
+    """
+    size = 1
+
+    def __init__(self, size):
+        self.size = size
+        self.__available = size
+        self.__lock = threading.Lock()
+        ### waiting threads (`threading.Event`) and coroutines (`(loop, future)`) in the order they came
+        self.__waiters = deque()
+
+    def __try_acquire(self):
+        ### no barging past the waiters
+        if self.__available > 0 and len(self.__waiters) == 0:
+            self.__available -= 1
+            return True
+        return False
+
+    def __enter__(self):
+        with self.__lock:
+            if self.__try_acquire():
+                return self
+            event = threading.Event()
+            self.__waiters.append(event)
+        event.wait()
+        return self
+
+    def __exit__(self, *args):
+        self.__release()
+
+    async def __aenter__(self):
+        loop = asyncio.get_running_loop()
+        with self.__lock:
+            if self.__try_acquire():
+                return self
+            waiter = (loop, loop.create_future())
+            self.__waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self.__lock:
+                if waiter in self.__waiters:
+                    self.__waiters.remove(waiter)
+                    raise
+            ### the slot was handed over already; if the future was cancelled first, `__wake` passes it on
+            if waiter[1].done() and not waiter[1].cancelled():
+                self.__release()
+            raise
+        return self
+
+    async def __aexit__(self, *args):
+        self.__release()
+
+    def __release(self):
+        with self.__lock:
+            while len(self.__waiters) > 0:
+                waiter = self.__waiters.popleft()
+                if isinstance(waiter, threading.Event):
+                    waiter.set()
+                    return
+                loop, future = waiter
+                try:
+                    loop.call_soon_threadsafe(self.__wake, future)
+                    return
+                except RuntimeError:
+                    ### the loop of the waiter is closed
+                    continue
+            self.__available += 1
+
+    def __wake(self, future):
+        if future.cancelled():
+            self.__release()
+        else:
+            future.set_result(None)
+
+REQUEST_BUDGET = RequestBudget(MAX_CONCURRENT_REQUESTS)
+
+def set_max_concurrent_requests(max_requests):
+    global MAX_CONCURRENT_REQUESTS, REQUEST_BUDGET
+    MAX_CONCURRENT_REQUESTS = max(1, max_requests)
+    REQUEST_BUDGET = RequestBudget(MAX_CONCURRENT_REQUESTS)
+
+### {task: {"requests": n, "cached": n, "refused": n}} of the LLM calls, see `helpers.call_context`
+REQUEST_COUNTS = {}
+_request_counts_lock = threading.Lock()
+
+def _count_request(kind):
+    task = get_call_context().get("task", "")
+    with _request_counts_lock:
+        if task not in REQUEST_COUNTS:
+            REQUEST_COUNTS[task] = {"requests": 0, "cached": 0, "refused": 0}
+        REQUEST_COUNTS[task][kind] += 1
+
+def get_request_counts(task=""):
+    with _request_counts_lock:
+        return dict(REQUEST_COUNTS.get(task, {"requests": 0, "cached": 0, "refused": 0}))
 
 SEED = 13774
 TEMPERATURE = 0
 MODEL_NAME = 'gpt-4o-2024-08-06'
 
+RESPONSE_CACHE = ResponseCache()
+
+def configure_response_cache(enabled=True, offline=False, max_size=None, max_age=None, path=None):
+    RESPONSE_CACHE.enabled = enabled
+    RESPONSE_CACHE.offline = offline
+    RESPONSE_CACHE.max_size = max_size
+    RESPONSE_CACHE.max_age = max_age
+    if path is not None:
+        RESPONSE_CACHE.path = path
+    return RESPONSE_CACHE
+
+IMAGE_CACHE = ImageCache()
+
+def configure_image_cache(max_edge=None, quality=None, max_disk_size=None):
+    if max_edge is not None:
+        ### 0 means original size
+        IMAGE_CACHE.max_edge = max_edge if max_edge > 0 else None
+    if quality is not None:
+        IMAGE_CACHE.quality = quality
+    if max_disk_size is not None:
+        IMAGE_CACHE.max_disk_size = max_disk_size
+    return IMAGE_CACHE
+
 def random_uid():
     return str(uuid4())
 
 def encode_image(image_path):
-    with open(image_path, "rb") as image:
-        return base64.b64encode(image.read()).decode("utf-8")
+    return base64.b64encode(read_frame(image_path)).decode("utf-8")
 
+@prompt_call
 def transcribe_audio(audio_path, granularity=["segment"]):
-    with open(audio_path, "rb") as audio:
-        response = client.audio.transcriptions.create(
-            model="whisper-1",
-            file=audio,
-            response_format="verbose_json",
-            timestamp_granularities=granularity,
-            prompt="Umm, let me think like, hmm... Okay, here's what I'm, like, thinking."
-        )
-        response = response.to_dict()
-        return response
-    return None
+    def __transcribe(attempt):
+        with open(audio_path, "rb") as audio:
+            return get_client().audio.transcriptions.create(
+                model="whisper-1",
+                file=audio,
+                response_format="verbose_json",
+                timestamp_granularities=granularity,
+                prompt="Umm, let me think like, hmm... Okay, here's what I'm, like, thinking."
+            )
 
+    start = time.perf_counter()
+    retries = [0]
+    try:
+        response = _with_retries(__transcribe, retries)
+    except Exception as e:
+        TELEMETRY.record(time.perf_counter() - start, retries=retries[0], error=type(e).__name__)
+        raise
+    TELEMETRY.record(time.perf_counter() - start, retries=retries[0])
+    return response.to_dict()
 
+def _get_retry_delay(error, attempt):
+    """
+    Seconds to wait before retrying after `error`, None if it is not worth retrying (e.g. a bad request)
+    """
+    try:
+        from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+    except ImportError:
+        return None
+    if not isinstance(error, (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)):
+        return None
+    delay = RETRY_BACKOFF * 2 ** attempt
+    response = getattr(error, "response", None)
+    if response is not None:
+        try:
+            delay = float(response.headers.get("retry-after", delay))
+        except ValueError:
+            pass
+    return delay
 
-def get_response_pydantic(messages, response_format):
-    print("MESSAGES:", json.dumps(messages, indent=2))
-    completion = client.beta.chat.completions.parse(
-        model=MODEL_NAME,
-        messages=messages,
-        seed=SEED,
-        temperature=TEMPERATURE,
-        response_format=response_format,
-    )
+def _with_retries(f, retries):
+    """
+    `f(attempt)` retried up to `MAX_RETRIES` times, `retries[0]` counts the retries
+    """
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return f(attempt)
+        except Exception as e:
+            delay = _get_retry_delay(e, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                raise
+            print(f"WARNING: retrying LLM request in {delay:.1f}s: {type(e).__name__}")
+            retries[0] += 1
+            time.sleep(delay)
 
+async def _with_retries_async(f, retries):
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            return await f(attempt)
+        except Exception as e:
+            delay = _get_retry_delay(e, attempt)
+            if delay is None or attempt == MAX_RETRIES:
+                raise
+            print(f"WARNING: retrying LLM request in {delay:.1f}s: {type(e).__name__}")
+            retries[0] += 1
+            await asyncio.sleep(delay)
+
+def _cached_response(messages, response_format):
+    key = response_cache_key(MODEL_NAME, SEED, TEMPERATURE, messages, response_format)
+    return key, RESPONSE_CACHE.get(key)
+
+def _completion_to_response(key, completion):
     response = completion.choices[0].message
     if (response.refusal):
-        print("REFUSED: ", response.refusal)
-        return None
-    
+        _count_request("refused")
+        return None, response.content
+
     json_response = response.parsed.dict()
+    RESPONSE_CACHE.put(key, {
+        "response": json_response,
+        "content": response.content,
+    })
+    return json_response, response.content
+
+def _trace(key, messages, response_format, response=None, latency=0, response_cached=False, retries=0, error=None):
+    ### the data URLs of the frames are traced by their path
+    TRACER.trace(key, messages, response_format, response, latency, response_cached, retries, error, resolve_image=IMAGE_CACHE.get_frame_path)
+
+def _parse_completion(messages, response_format):
+    """
+    Returns the parsed response and the raw message content, served from `RESPONSE_CACHE` if possible
+    """
+    start = time.perf_counter()
+    key, entry = _cached_response(messages, response_format)
+    if entry is not None:
+        _count_request("cached")
+        TELEMETRY.record(time.perf_counter() - start, messages, response_cached=True)
+        _trace(key, messages, response_format, entry["response"], time.perf_counter() - start, response_cached=True)
+        return entry["response"], entry["content"]
+
+    def __parse(attempt):
+        return get_client().beta.chat.completions.parse(
+            model=MODEL_NAME,
+            messages=messages,
+            seed=SEED,
+            temperature=TEMPERATURE,
+            response_format=response_format,
+        )
+
+    retries = [0]
+    with REQUEST_BUDGET:
+        queue_time = time.perf_counter() - start
+        try:
+            completion = _with_retries(__parse, retries)
+        except Exception as e:
+            TELEMETRY.record(time.perf_counter() - start - queue_time, messages, retries=retries[0], queue_time=queue_time, error=type(e).__name__)
+            _trace(key, messages, response_format, latency=time.perf_counter() - start - queue_time, retries=retries[0], error=type(e).__name__)
+            raise
+    latency = time.perf_counter() - start - queue_time
+    TELEMETRY.record(latency, messages, completion, retries=retries[0], queue_time=queue_time)
+    _count_request("requests")
+    json_response, content = _completion_to_response(key, completion)
+    _trace(key, messages, response_format, json_response, latency, retries=retries[0], error="refused" if json_response is None else None)
+    return json_response, content
 
-    print("RESPONSE:", json.dumps(json_response, indent=2))
+async def _parse_completion_async(messages, response_format):
+    """
+    Async twin of `_parse_completion`, sync and async calls share the `MAX_CONCURRENT_REQUESTS` slots
+    """
+    start = time.perf_counter()
+    key, entry = _cached_response(messages, response_format)
+    if entry is not None:
+        _count_request("cached")
+        TELEMETRY.record(time.perf_counter() - start, messages, response_cached=True)
+        _trace(key, messages, response_format, entry["response"], time.perf_counter() - start, response_cached=True)
+        return entry["response"], entry["content"]
+
+    async def __parse(attempt):
+        return await get_async_client().beta.chat.completions.parse(
+            model=MODEL_NAME,
+            messages=messages,
+            seed=SEED,
+            temperature=TEMPERATURE,
+            response_format=response_format,
+        )
+
+    retries = [0]
+    async with REQUEST_BUDGET:
+        queue_time = time.perf_counter() - start
+        try:
+            completion = await _with_retries_async(__parse, retries)
+        except Exception as e:
+            TELEMETRY.record(time.perf_counter() - start - queue_time, messages, retries=retries[0], queue_time=queue_time, error=type(e).__name__)
+            _trace(key, messages, response_format, latency=time.perf_counter() - start - queue_time, retries=retries[0], error=type(e).__name__)
+            raise
+    latency = time.perf_counter() - start - queue_time
+    TELEMETRY.record(latency, messages, completion, retries=retries[0], queue_time=queue_time)
+    _count_request("requests")
+    json_response, content = _completion_to_response(key, completion)
+    _trace(key, messages, response_format, json_response, latency, retries=retries[0], error="refused" if json_response is None else None)
+    return json_response, content
+
+def get_response_pydantic(messages, response_format):
+    json_response, _ = _parse_completion(messages, response_format)
+    if json_response is None:
+        return None
     return json_response
 
 def get_response_pydantic_with_message(messages, response_format):
-    print("MESSAGES:", json.dumps(messages, indent=2))
-    completion = client.beta.chat.completions.parse(
-        model=MODEL_NAME,
-        messages=messages,
-        seed=SEED,
-        temperature=TEMPERATURE,
-        response_format=response_format,
-    )
+    json_response, content = _parse_completion(messages, response_format)
+    if json_response is None:
+        return None, content
+    return json_response, content
 
-    response = completion.choices[0].message
-    if (response.refusal):
-        print("REFUSED: ", response.refusal)
-        return None, response.choices[0].message.content
-    
-    json_response = response.parsed.dict()
+async def get_response_pydantic_async(messages, response_format):
+    json_response, _ = await _parse_completion_async(messages, response_format)
+    if json_response is None:
+        return None
+    return json_response
 
-    print("RESPONSE:", json.dumps(json_response, indent=2))
-    return json_response, completion.choices[0].message.content
+async def get_response_pydantic_with_message_async(messages, response_format):
+    json_response, content = await _parse_completion_async(messages, response_format)
+    if json_response is None:
+        return None, content
+    return json_response, content
 
 def extend_contents(contents, include_images=False, include_ids=False):
     extended_contents = []
@@ -88,11 +397,10 @@ def extend_contents(contents, include_images=False, include_ids=False):
             "text": text,
         })
         if include_images:
-            for frame_path in content["frame_paths"]:
-                frame_base64 = encode_image(frame_path)
+            for frame_path in dedup_frame_paths(content["frame_paths"]):
                 extended_contents.append({
                     "type": "image_url",
-                    "image_url": {"url": f"data:image/jpeg;base64,{frame_base64}"}
+                    "image_url": {"url": IMAGE_CACHE.get_data_url(frame_path)}
                 })
     return extended_contents
 
@@ -110,8 +418,7 @@ def str_to_float(str_time):
 def float_to_str(float_time):
     return str(int(float_time // 3600)) + ":" + str(int((float_time % 3600) // 60)) + ":" + str(int(float_time % 60))
 
-import pysbd
-
 def segment_into_sentences(text):
+    import pysbd
     seg = pysbd.Segmenter(language="en", clean=False)
     return seg.segment(text)
\ No newline at end of file
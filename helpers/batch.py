@@ -0,0 +1,268 @@
+import os
+import json
+import time
+import hashlib
+
+import helpers
+from helpers import MODEL_NAME, SEED, TEMPERATURE, RESPONSE_CACHE, response_cache_key
+
+BATCH_PATH = "static/cache/batches"
+### batch files of `LocalBatchBackend` runs
+LOCAL_BATCH_PATH = "static/cache/local/batches"
+BATCH_ENDPOINT = "/v1/chat/completions"
+POLL_INTERVAL = 60
+
+FINISHED_STATUSES = ["completed", "failed", "expired", "cancelled"]
+
+def strict_json_schema(schema):
+    """
+    The JSON schema of a pydantic model in the form structured outputs require:
+    every object closed (`additionalProperties: false`) with all of its properties required
+    """
+    if isinstance(schema, list):
+        return [strict_json_schema(item) for item in schema]
+    if not isinstance(schema, dict):
+        return schema
+    result = {key: strict_json_schema(value) for key, value in schema.items() if not (key == "default" and value is None)}
+    if result.get("type") == "object" and "properties" in result:
+        result["additionalProperties"] = False
+        result["required"] = list(result["properties"].keys())
+    ### a `$ref` cannot have sibling keywords
+    if "$ref" in result and len(result) > 1:
+        result = {"$ref": result["$ref"]}
+    return result
+
+def get_response_format_param(response_format):
+    """
+    The `response_format` body parameter of a pydantic model, without the SDK's private helpers
+    """
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": response_format.__name__,
+            "schema": strict_json_schema(response_format.model_json_schema()),
+            "strict": True,
+        },
+    }
+
+def batch_request_line(custom_id, messages, response_format):
+    return {
+        "custom_id": custom_id,
+        "method": "POST",
+        "url": BATCH_ENDPOINT,
+        "body": {
+            "model": MODEL_NAME,
+            "messages": messages,
+            "seed": SEED,
+            "temperature": TEMPERATURE,
+            "response_format": get_response_format_param(response_format),
+        },
+    }
+
+def parse_batch_output_line(line, response_format):
+    """
+    Returns the parsed response of one line of a batch output file, None if it failed or was refused
+    """
+    if line.get("error") is not None:
+        print("BATCH ERROR:", line["custom_id"], line["error"])
+        return None, None
+    body = line["response"]["body"]
+    message = body["choices"][0]["message"]
+    if message.get("refusal"):
+        print("REFUSED: ", message["refusal"])
+        return None, message.get("content")
+    parsed = response_format.model_validate_json(message["content"])
+    return parsed.model_dump(), message["content"]
+
+class OpenAIBatchBackend:
+    """
+    Runs batch files through the OpenAI Batch API
+    """
+    poll_interval = POLL_INTERVAL
+
+    def __init__(self, poll_interval=POLL_INTERVAL):
+        self.poll_interval = poll_interval
+
+    def submit(self, input_path, response_formats):
+        with open(input_path, "rb") as f:
+            input_file = helpers.get_client().files.create(file=f, purpose="batch")
+        batch = helpers.get_client().batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h",
+        )
+        return batch.id
+
+    def status(self, batch_id):
+        batch = helpers.get_client().batches.retrieve(batch_id)
+        return batch.status
+
+    def download(self, batch_id, output_path):
+        batch = helpers.get_client().batches.retrieve(batch_id)
+        lines = []
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id is None:
+                continue
+            lines.append(helpers.get_client().files.content(file_id).text.strip())
+        with open(output_path, "w") as f:
+            f.write("\n".join([l for l in lines if l != ""]) + "\n")
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the Batch API: every request is answered on submit by `client`
+    (by default `helpers.stub_client.StubOpenAI`) and written next to the input file
+    """
+    poll_interval = 0
+    client = None
+
+    def __init__(self, client=None):
+        if client is None:
+            from helpers.stub_client import StubOpenAI
+            client = StubOpenAI()
+        self.client = client
+        self.poll_interval = 0
+
+    def submit(self, input_path, response_formats):
+        batch_id = os.path.basename(input_path).replace(".input.jsonl", "")
+        output_lines = []
+        with open(input_path, "r") as f:
+            for line in f:
+                request = json.loads(line)
+                body = request["body"]
+                completion = self.client.beta.chat.completions.parse(
+                    model=body["model"],
+                    messages=body["messages"],
+                    seed=body["seed"],
+                    temperature=body["temperature"],
+                    response_format=response_formats[request["custom_id"]],
+                )
+                message = completion.choices[0].message
+                output_lines.append({
+                    "id": f"{batch_id}-{request['custom_id']}",
+                    "custom_id": request["custom_id"],
+                    "response": {
+                        "status_code": 200,
+                        "body": {"choices": [{"message": {"content": message.content, "refusal": message.refusal}}]},
+                    },
+                    "error": None,
+                })
+        with open(self.__output_path(input_path), "w") as f:
+            for line in output_lines:
+                f.write(json.dumps(line) + "\n")
+        return input_path
+
+    def __output_path(self, input_path):
+        return input_path.replace(".input.jsonl", ".local.jsonl")
+
+    def status(self, batch_id):
+        if os.path.exists(self.__output_path(batch_id)):
+            return "completed"
+        return "failed"
+
+    def download(self, batch_id, output_path):
+        with open(self.__output_path(batch_id), "r") as src, open(output_path, "w") as dst:
+            dst.write(src.read())
+
+class BatchRunner:
+    """
+    Collects all requests of a pipeline stage into one JSONL batch file, submits it, polls for
+    completion and returns the parsed responses in the order of the requests.
+    Responses already in the response cache are not resubmitted; submitted batch ids are recorded so
+    that an interrupted run resumes polling instead of paying twice.
+    """
+    backend = None
+    path = BATCH_PATH
+    cache = None
+
+    def __init__(self, backend, path=BATCH_PATH, cache=None):
+        self.backend = backend
+        self.path = path
+        ### defaults to `RESPONSE_CACHE`
+        self.cache = cache if cache is not None else RESPONSE_CACHE
+
+    def run(self, stage, requests):
+        """
+        requests: list of (messages, response_format)
+        """
+        responses = [None for _ in requests]
+        keys = []
+        pending = []
+        for index, (messages, response_format) in enumerate(requests):
+            key = response_cache_key(MODEL_NAME, SEED, TEMPERATURE, messages, response_format)
+            keys.append(key)
+            entry = self.cache.get(key)
+            if entry is not None:
+                responses[index] = entry["response"]
+            else:
+                pending.append(index)
+        if len(pending) == 0:
+            return responses
+
+        os.makedirs(self.path, exist_ok=True)
+        batch_hash = hashlib.sha256("".join([keys[index] for index in pending]).encode("utf-8")).hexdigest()[:16]
+        input_path = os.path.join(self.path, f"{stage}-{batch_hash}.input.jsonl")
+        output_path = os.path.join(self.path, f"{stage}-{batch_hash}.output.jsonl")
+        state_path = os.path.join(self.path, f"{stage}-{batch_hash}.json")
+
+        response_formats = {}
+        if not os.path.exists(output_path):
+            with open(input_path, "w") as f:
+                for index in pending:
+                    messages, response_format = requests[index]
+                    response_formats[f"request-{index}"] = response_format
+                    f.write(json.dumps(batch_request_line(f"request-{index}", messages, response_format)) + "\n")
+
+            batch_id = None
+            if os.path.exists(state_path):
+                with open(state_path, "r") as f:
+                    batch_id = json.load(f)["batch_id"]
+                print(f"Resuming batch {batch_id} for stage `{stage}`")
+            else:
+                batch_id = self.backend.submit(input_path, response_formats)
+                with open(state_path, "w") as f:
+                    json.dump({"batch_id": batch_id, "stage": stage, "requests": len(pending)}, f)
+                print(f"Submitted batch {batch_id} for stage `{stage}` with {len(pending)} requests")
+
+            status = self.backend.status(batch_id)
+            while status not in FINISHED_STATUSES:
+                time.sleep(self.backend.poll_interval)
+                status = self.backend.status(batch_id)
+            if status != "completed":
+                os.remove(state_path)
+                raise Exception(f"Batch {batch_id} for stage `{stage}` finished with status `{status}`")
+            self.backend.download(batch_id, output_path)
+
+        lines = {}
+        with open(output_path, "r") as f:
+            for line in f:
+                if line.strip() == "":
+                    continue
+                line = json.loads(line)
+                lines[line["custom_id"]] = line
+
+        failed = 0
+        for index in pending:
+            messages, response_format = requests[index]
+            if f"request-{index}" not in lines:
+                print("BATCH ERROR: missing response for", keys[index])
+                failed += 1
+                continue
+            response, content = parse_batch_output_line(lines[f"request-{index}"], response_format)
+            if response is None:
+                failed += 1
+                continue
+            self.cache.put(keys[index], {
+                "response": response,
+                "content": content,
+            })
+            responses[index] = response
+
+        if failed > 0:
+            ### the successful responses are cached, move the batch aside so that a rerun resubmits the failed requests
+            failed_path = os.path.join(self.path, f"{stage}-{batch_hash}.{int(time.time())}.failed.jsonl")
+            os.replace(output_path, failed_path)
+            for path in [input_path, state_path]:
+                if os.path.exists(path):
+                    os.remove(path)
+            print(f"BATCH ERROR: {failed} of {len(pending)} requests of stage `{stage}` failed, see {failed_path}")
+        return responses
@@ -1,61 +1,75 @@
+import threading
+
 import numpy as np
-from sentence_transformers import SentenceTransformer
 
-model = SentenceTransformer("all-MiniLM-L6-v2")
+from helpers.embedding_cache import EmbeddingCache, text_key
+from helpers.clustering import cluster_embeddings
+from helpers.similarity import top_k_similar
+
+BERT_MODEL_NAME = "all-MiniLM-L6-v2"
+
+### loaded on first use by `get_model`
+model = None
+
+EMBEDDING_CACHE = EmbeddingCache()
+
+### see `helpers.clustering.CLUSTER_MODES`
+CLUSTERING_MODE = "leader"
+
+### stages running on different threads may ask for the model at the same time
+__model_lock = threading.Lock()
+
+def get_model():
+    global model
+    with __model_lock:
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+            model = SentenceTransformer(BERT_MODEL_NAME)
+    return model
 
 def bert_embedding(texts):
+    """
+    Embeddings of `texts`, only the texts missing from `EMBEDDING_CACHE` are encoded (in one batch)
+    """
     if len(texts) == 0:
         return []
 
-    for i in range(len(texts)):
-        if texts[i] == "":
-            texts[i] = " "
-    embeddings = model.encode(texts)
-    return embeddings
+    texts = [text if text != "" else " " for text in texts]
+    keys = [text_key(BERT_MODEL_NAME, text) for text in texts]
+    embeddings = EMBEDDING_CACHE.get_many(keys)
+
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key not in embeddings and key not in missing:
+            missing[key] = text
+    if len(missing) > 0:
+        encoded = get_model().encode(list(missing.values()))
+        new_embeddings = {key: encoded[i] for i, key in enumerate(missing.keys())}
+        EMBEDDING_CACHE.put_many(new_embeddings)
+        embeddings.update(new_embeddings)
+    return np.stack([embeddings[key] for key in keys])
+
+def get_embedding_cache_stats():
+    return EMBEDDING_CACHE.stats()
 
 def find_most_similar(embeddings, query_embeddings):
     """
     embeddings: List of embeddings (Tensor)
     query_embeddings: Query embeddings (Tensor)
+    Returns the index and score of the most similar embedding per query, see `helpers.similarity.top_k_similar`
     """
+    indexes, scores = top_k_similar(embeddings, query_embeddings, k=1)
+    return indexes[:, 0].tolist(), scores[:, 0].tolist()
 
-    ## Calculate cosine similarity between query_embeddings and embeddings
-    cos_scores = np.dot(query_embeddings, embeddings.T)
-    top_results_per_query = cos_scores.argsort()[:,-1].tolist()
-    scores = cos_scores[
-        np.arange(len(query_embeddings)),
-        top_results_per_query
-    ].tolist()
-    return top_results_per_query, scores
-
-def clustering_custom(texts, similarity_threshold):
+def clustering_custom(texts, similarity_threshold, mode=None):
     """
     cluster texts that have `high` similarity
     """
+    if mode is None:
+        mode = CLUSTERING_MODE
 
     if len(texts) <= 1:
         return [0 for _ in range(len(texts))]
-    
-    labels = []
-    embeddings = bert_embedding(texts)
 
-    similarities = np.zeros((len(texts), len(texts)))
-    for i in range(len(texts)):
-        for j in range(i+1, len(texts)):
-            similarities[i][j] = np.dot(embeddings[i], embeddings[j])
-            similarities[j][i] = similarities[i][j]
-    
-
-    labels = [i for i in range(len(texts))]
-    visited = [False for _ in range(len(texts))]
-    for i in range(len(texts)):
-        if visited[i]:
-            continue
-        visited[i] = True
-        for j in range(i+1, len(texts)):
-            if visited[j]:
-                continue
-            if similarities[i][j] >= similarity_threshold:
-                visited[j] = True
-                labels[j] = labels[i]
-    return labels
\ No newline at end of file
+    embeddings = bert_embedding(texts)
+    return cluster_embeddings(embeddings, similarity_threshold, mode=mode)
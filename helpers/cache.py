@@ -0,0 +1,138 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+CACHE_PATH = "static/cache/responses"
+### responses of runs with local stand-ins, never mixed with the real ones
+LOCAL_CACHE_PATH = "static/cache/local/responses"
+
+class CacheMissError(Exception):
+    pass
+
+def response_cache_key(model, seed, temperature, messages, response_format):
+    """
+    Hash of everything that determines the response of a structured call
+    """
+    payload = {
+        "model": model,
+        "seed": seed,
+        "temperature": temperature,
+        "messages": messages,
+        "response_format": response_format.model_json_schema(),
+    }
+    payload = json.dumps(payload, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of parsed LLM responses.
+    Each entry is stored as `{path}/{key[:2]}/{key}.json`.
+    """
+    path = CACHE_PATH
+    enabled = True
+    ### fail on a miss instead of calling the API
+    offline = False
+    ### eviction limits (None means unbounded)
+    max_size = None
+    max_age = None
+
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, path=CACHE_PATH, enabled=True, offline=False, max_size=None, max_age=None):
+        self.path = path
+        self.enabled = enabled
+        self.offline = offline
+        self.max_size = max_size
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        ### several pools or worker threads share the cache
+        self.__lock = threading.Lock()
+
+    def __entry_path(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.json")
+
+    def get(self, key):
+        """
+        Returns the cached entry or None; raises CacheMissError on a miss in offline mode
+        """
+        if not self.enabled:
+            return None
+        entry_path = self.__entry_path(key)
+        entry = None
+        if os.path.exists(entry_path):
+            if self.max_age is not None and time.time() - os.path.getmtime(entry_path) > self.max_age:
+                try:
+                    os.remove(entry_path)
+                    with self.__lock:
+                        self.evictions += 1
+                except FileNotFoundError:
+                    pass
+            else:
+                with open(entry_path, "r") as f:
+                    entry = json.load(f)
+        if entry is None:
+            with self.__lock:
+                self.misses += 1
+            if self.offline:
+                raise CacheMissError(f"Offline replay: no cached response for {key}")
+            return None
+        with self.__lock:
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if not self.enabled:
+            return
+        entry_path = self.__entry_path(key)
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        ### write-then-rename so that a crash never leaves a truncated entry
+        tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, entry_path)
+
+    def evict(self):
+        """
+        Remove expired entries, then the oldest ones until the cache fits into `max_size` bytes
+        """
+        if not self.enabled or not os.path.exists(self.path):
+            return 0
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                if not file.endswith(".json"):
+                    continue
+                entry_path = os.path.join(root, file)
+                stat = os.stat(entry_path)
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+        entries = sorted(entries)
+
+        now = time.time()
+        total_size = sum([size for _, size, _ in entries])
+        removed = 0
+        for mtime, size, entry_path in entries:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            oversized = self.max_size is not None and total_size > self.max_size
+            if not expired and not oversized:
+                continue
+            os.remove(entry_path)
+            total_size -= size
+            removed += 1
+        with self.__lock:
+            self.evictions += removed
+        return removed
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total > 0 else 0,
+        }
@@ -0,0 +1,68 @@
+import inspect
+import contextvars
+
+from functools import wraps
+from contextlib import contextmanager
+
+### labels of the running work (e.g. the task) that the LLM calls are attributed to
+CALL_CONTEXT = contextvars.ContextVar("call_context", default=None)
+
+def get_call_context():
+    context = CALL_CONTEXT.get()
+    return context if context is not None else {}
+
+@contextmanager
+def call_context(**labels):
+    """
+    Add `labels` to the call context of the code in the `with` block
+    """
+    token = CALL_CONTEXT.set({**get_call_context(), **labels})
+    try:
+        yield
+    finally:
+        CALL_CONTEXT.reset(token)
+
+def submit_with_context(executor, f, *args, **kwargs):
+    """
+    `executor.submit` that runs `f` in a copy of the current context, worker threads do not inherit it otherwise
+    """
+    context = contextvars.copy_context()
+    return executor.submit(context.run, f, *args, **kwargs)
+
+def thread_target_with_context(f):
+    """
+    Wrap `f` to run in a copy of the current context, for `threading.Thread(target=...)`
+    """
+    context = contextvars.copy_context()
+    def __run(*args, **kwargs):
+        return context.run(f, *args, **kwargs)
+    return __run
+
+def prompt_call(f):
+    """
+    Decorator of the prompt functions: their LLM calls are attributed to the prompt `f.__name__` (without `_async`)
+    """
+    prompt = f.__name__[:-len("_async")] if f.__name__.endswith("_async") else f.__name__
+    if inspect.iscoroutinefunction(f):
+        @wraps(f)
+        async def __call_async(*args, **kwargs):
+            with call_context(prompt=prompt):
+                return await f(*args, **kwargs)
+        return __call_async
+
+    @wraps(f)
+    def __call(*args, **kwargs):
+        with call_context(prompt=prompt):
+            return f(*args, **kwargs)
+    return __call
+
+def call_with_labels(labels, f, *args, **kwargs):
+    """
+    `f(*args, **kwargs)` with `labels` (e.g. the video ids of the call) added to the call context
+    """
+    with call_context(**(labels or {})):
+        return f(*args, **kwargs)
+
+async def call_with_labels_async(labels, async_f, *args, **kwargs):
+    with call_context(**(labels or {})):
+        return await async_f(*args, **kwargs)
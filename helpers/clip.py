@@ -1,26 +1,87 @@
-import torch
-import clip
+import io
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
 from PIL import Image
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
-model, preprocess = clip.load("ViT-B/32", device=device)
+from helpers.frame_store import read_frame, parse_frame_path, get_frame_store
+from helpers.frame_dedup import dedup_frame_paths
+from helpers.similarity import top_k_similar
+
+CLIP_MODEL_NAME = "ViT-B/32"
+### frames embedded between two saves of a CLIP index, an interrupted run resumes from the last save
+CLIP_INDEX_CHUNK = 256
+### images per `encode_image` call, at most two batches of image tensors are in memory
+CLIP_BATCH_SIZE = 32
+### threads decoding and preprocessing the next batch while the current one is encoded
+CLIP_DECODE_WORKERS = min(4, os.cpu_count() or 1)
+
+### loaded on first use by `get_model`, importing `torch` alone takes seconds
+device = None
+model = None
+preprocess = None
+### stages running on different threads may ask for the model at the same time
+__model_lock = threading.Lock()
 
-def clip_embed_image(image_paths):
+def get_model():
     """
-    Embed an image using a CLIP model
+    Returns (model, preprocess, device)
     """
-    ### transform the image to a tensor
-    images = torch.cat([preprocess(Image.open(path)).unsqueeze(0) for path in image_paths]).to(device)
-    with torch.no_grad():
-        image_features = model.encode_image(images)
-    image_features /= image_features.norm(dim=-1, keepdim=True)
-    return image_features
+    global device, model, preprocess
+    with __model_lock:
+        if model is None:
+            import torch
+            import clip
+            device = "cuda" if torch.cuda.is_available() else "cpu"
+            model, preprocess = clip.load(CLIP_MODEL_NAME, device=device)
+    return model, preprocess, device
+
+def load_image(image_path):
+    _, preprocess, _ = get_model()
+    return preprocess(Image.open(io.BytesIO(read_frame(image_path))))
+
+def clip_embed_image(image_paths, batch_size=None, workers=None):
+    """
+    Embed images using a CLIP model
+    Images are decoded and preprocessed on a thread pool while the previous batch is encoded,
+    so memory is bounded by `batch_size` regardless of the number of images
+    """
+    import torch
+    model, _, device = get_model()
+    if batch_size is None:
+        batch_size = CLIP_BATCH_SIZE
+    if workers is None:
+        workers = CLIP_DECODE_WORKERS
+    if len(image_paths) == 0:
+        return torch.zeros((0, model.visual.output_dim))
+
+    batches = [image_paths[start:start + batch_size] for start in range(0, len(image_paths), batch_size)]
+    image_features = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = [executor.submit(load_image, path) for path in batches[0]]
+        for index in range(len(batches)):
+            images = torch.stack([future.result() for future in pending])
+            if index + 1 < len(batches):
+                pending = [executor.submit(load_image, path) for path in batches[index + 1]]
+            with torch.no_grad():
+                features = model.encode_image(images.to(device))
+            del images
+            features /= features.norm(dim=-1, keepdim=True)
+            image_features.append(features.float().cpu())
+    return torch.cat(image_features)
 
 
 def clip_embed_text(texts):
     """
     Embed a text using a CLIP model
     """
+    import torch
+    import clip
+    model, _, device = get_model()
 
     embeddings = torch.cat([clip.tokenize([text]) for text in texts]).to(device)
     with torch.no_grad():
@@ -28,21 +89,79 @@ def clip_embed_text(texts):
     text_features /= text_features.norm(dim=-1, keepdim=True)
     return text_features
 
+def get_clip_index_path(video_path):
+    return f"{video_path}_frames.clip.{CLIP_MODEL_NAME.replace('/', '-')}.npy"
+
+__clip_indexes = {}
+__clip_indexes_lock = threading.Lock()
+
+def get_clip_index(video_path):
+    """
+    Normalized CLIP embeddings of all frames of a video, one row per second, stored next to its frame store.
+    Frames that are not in the index yet are embedded and appended. Returns None if the video has no frame store.
+    """
+    store = get_frame_store(video_path)
+    if store is None:
+        return None
+    with __clip_indexes_lock:
+        embeddings = __clip_indexes.get(video_path)
+        path = get_clip_index_path(video_path)
+        if embeddings is None and os.path.exists(path):
+            ### the frames were re-extracted after the index was written
+            if os.path.getmtime(path) >= store.mtime:
+                embeddings = np.load(path)
+        if embeddings is not None and len(embeddings) > len(store):
+            embeddings = None
+        if embeddings is None:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+        frame_paths = store.frame_paths()
+        for start in range(len(embeddings), len(store), CLIP_INDEX_CHUNK):
+            chunk = clip_embed_image(frame_paths[start:start + CLIP_INDEX_CHUNK]).float().cpu().numpy()
+            embeddings = chunk if len(embeddings) == 0 else np.concatenate([embeddings, chunk])
+            tmp_path = f"{path}.tmp.npy"
+            np.save(tmp_path, embeddings)
+            os.replace(tmp_path, path)
+        __clip_indexes[video_path] = embeddings
+        return embeddings
+
+def get_frame_embeddings(frame_paths):
+    """
+    Normalized CLIP embeddings of frames, looked up in the per-video CLIP indexes
+    """
+    rows = [None for _ in frame_paths]
+    indexes = {}
+    for position, frame_path in enumerate(frame_paths):
+        video_path, sec = parse_frame_path(frame_path)
+        if video_path is None:
+            continue
+        if video_path not in indexes:
+            indexes[video_path] = get_clip_index(video_path)
+        if indexes[video_path] is not None and sec < len(indexes[video_path]):
+            rows[position] = indexes[video_path][sec]
+
+    missing = [position for position, row in enumerate(rows) if row is None]
+    if len(missing) > 0:
+        embeddings = clip_embed_image([frame_paths[position] for position in missing]).float().cpu().numpy()
+        for position, embedding in zip(missing, embeddings):
+            rows[position] = embedding
+    return np.stack(rows)
+
 def clip_similar_per_text(texts, image_paths, top_k=1):
     ### TODO: May need to consider the narrations for each image
     """
     Find the most similar image to a given text
     if multiple texts are given, return the most similar image to each text
-    if multiple images are equally similar to a text, return the last one
     """
-    image_embeddings = clip_embed_image(image_paths)
-    text_embeddings = clip_embed_text(texts)
+    ### visually identical frames would get the same score, keep the first of each run
+    image_paths = dedup_frame_paths(image_paths)
+    if len(image_paths) == 0:
+        return []
+    image_embeddings = get_frame_embeddings(image_paths)
+    text_embeddings = clip_embed_text(texts).float().cpu().numpy()
 
-    similarity = (100.0 * image_embeddings @ text_embeddings.T).softmax(dim=0)
-    values, indices = similarity.T.topk(top_k)
+    indices, _ = top_k_similar(image_embeddings, text_embeddings, k=min(top_k, len(image_paths)))
 
-    indices = indices.squeeze(1).tolist()
     if top_k == 1:
-        return [image_paths[idx] for idx in indices]
+        return [image_paths[idxs[0]] for idxs in indices]
     else:
-        return [[image_paths[idx] for idx in idxs] for idxs in indices]
\ No newline at end of file
+        return [[image_paths[idx] for idx in idxs] for idxs in indices]
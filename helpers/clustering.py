@@ -0,0 +1,78 @@
+import numpy as np
+
+### rows (and columns) of the similarity matrix computed at once, bounds memory to O(block_size * n)
+CLUSTER_BLOCK_SIZE = 1024
+### "leader": greedy, order-dependent clusters of `clustering_custom`
+### "components": connected components of the thresholded similarity graph
+CLUSTER_MODES = ["leader", "components"]
+
+def cluster_leader(embeddings, similarity_threshold, block_size=CLUSTER_BLOCK_SIZE):
+    """
+    Each not yet clustered text, in order, becomes a leader and absorbs all later unclustered texts
+    with similarity >= `similarity_threshold`. Labels are the index of the leader.
+    """
+    n = len(embeddings)
+    labels = np.arange(n)
+    visited = np.zeros(n, dtype=bool)
+    for start in range(0, n, block_size):
+        finish = min(start + block_size, n)
+        rows = np.flatnonzero(~visited[start:finish]) + start
+        if len(rows) == 0:
+            continue
+        similarities = embeddings[rows] @ embeddings[start:].T
+        for row_index, i in enumerate(rows):
+            if visited[i]:
+                continue
+            visited[i] = True
+            members = np.flatnonzero(similarities[row_index, i - start + 1:] >= similarity_threshold) + i + 1
+            members = members[~visited[members]]
+            visited[members] = True
+            labels[members] = i
+    return labels.tolist()
+
+def cluster_components(embeddings, similarity_threshold, block_size=CLUSTER_BLOCK_SIZE):
+    """
+    Texts connected by a chain of similarities >= `similarity_threshold` share a cluster.
+    Labels are the smallest index in the cluster.
+    """
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    n = len(embeddings)
+    labels = np.arange(n)
+    for row_start in range(0, n, block_size):
+        row_finish = min(row_start + block_size, n)
+        for col_start in range(row_start, n, block_size):
+            col_finish = min(col_start + block_size, n)
+            similarities = embeddings[row_start:row_finish] @ embeddings[col_start:col_finish].T
+            rows, cols = np.nonzero(similarities >= similarity_threshold)
+            ### merge the current clusters of the endpoints instead of the endpoints, so the graph stays small
+            sources = labels[rows + row_start]
+            targets = labels[cols + col_start]
+            different = sources != targets
+            if not np.any(different):
+                continue
+            graph = coo_matrix(
+                (np.ones(np.count_nonzero(different), dtype=np.int8), (sources[different], targets[different])),
+                shape=(n, n),
+            )
+            _, components = connected_components(graph, directed=False)
+            ### clusters are labelled by their smallest index
+            representatives = np.full(components.max() + 1, n)
+            np.minimum.at(representatives, components, np.arange(n))
+            labels = representatives[components[labels]]
+    return labels.tolist()
+
+def cluster_embeddings(embeddings, similarity_threshold, mode="leader", block_size=CLUSTER_BLOCK_SIZE):
+    """
+    embeddings: (n, d) array
+    Returns a cluster label per row
+    """
+    if mode not in CLUSTER_MODES:
+        raise ValueError(f"Unknown clustering mode '{mode}', expected one of {CLUSTER_MODES}")
+    if len(embeddings) <= 1:
+        return [0 for _ in range(len(embeddings))]
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if mode == "leader":
+        return cluster_leader(embeddings, similarity_threshold, block_size)
+    return cluster_components(embeddings, similarity_threshold, block_size)
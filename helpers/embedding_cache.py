@@ -0,0 +1,109 @@
+import os
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+
+from collections import OrderedDict
+
+import numpy as np
+
+EMBEDDING_CACHE_PATH = "static/cache/embeddings.sqlite"
+### number of embeddings kept in memory
+EMBEDDING_CACHE_SIZE = 100000
+
+def normalize_text(text):
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+def text_key(model_name, text):
+    return hashlib.sha256(f"{model_name}\0{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """
+    Two-tier cache of text embeddings keyed by (model, normalized text hash):
+    an in-memory LRU on top of a persistent SQLite table
+    """
+    path = EMBEDDING_CACHE_PATH
+    size = EMBEDDING_CACHE_SIZE
+    persistent = True
+
+    memory_hits = 0
+    disk_hits = 0
+    misses = 0
+
+    def __init__(self, path=EMBEDDING_CACHE_PATH, size=EMBEDDING_CACHE_SIZE, persistent=True):
+        self.path = path
+        self.size = size
+        self.persistent = persistent
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.__memory = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__connection = None
+
+    def __get_connection(self):
+        if self.__connection is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self.__connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.__connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dtype TEXT, vector BLOB)")
+        return self.__connection
+
+    def __remember(self, key, vector):
+        self.__memory[key] = vector
+        self.__memory.move_to_end(key)
+        while len(self.__memory) > self.size:
+            self.__memory.popitem(last=False)
+
+    def get_many(self, keys):
+        """
+        Returns {key: vector} for the cached keys
+        """
+        found = {}
+        with self.__lock:
+            for key in keys:
+                if key in found:
+                    continue
+                if key in self.__memory:
+                    self.__memory.move_to_end(key)
+                    found[key] = self.__memory[key]
+                    self.memory_hits += 1
+
+            missing = [key for key in dict.fromkeys(keys) if key not in found]
+            if self.persistent and len(missing) > 0:
+                connection = self.__get_connection()
+                for i in range(0, len(missing), 500):
+                    chunk = missing[i:i + 500]
+                    rows = connection.execute(
+                        f"SELECT key, dtype, vector FROM embeddings WHERE key IN ({','.join(['?'] * len(chunk))})", chunk
+                    ).fetchall()
+                    for key, dtype, vector in rows:
+                        found[key] = np.frombuffer(vector, dtype=dtype)
+                        self.__remember(key, found[key])
+                        self.disk_hits += 1
+            self.misses += len([key for key in missing if key not in found])
+        return found
+
+    def put_many(self, vectors):
+        """
+        vectors: {key: vector}
+        """
+        with self.__lock:
+            for key, vector in vectors.items():
+                self.__remember(key, vector)
+            if self.persistent and len(vectors) > 0:
+                connection = self.__get_connection()
+                connection.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, dtype, vector) VALUES (?, ?, ?)",
+                    [(key, str(vector.dtype), vector.tobytes()) for key, vector in vectors.items()]
+                )
+                connection.commit()
+
+    def stats(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            "memory_hits": self.memory_hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.memory_hits + self.disk_hits) / total if total > 0 else 0,
+        }
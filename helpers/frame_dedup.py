@@ -0,0 +1,56 @@
+import io
+
+from PIL import Image
+
+from helpers.frame_store import read_frame
+
+### frames whose hashes differ in at most `FRAME_HASH_DISTANCE` bits are treated as visually identical
+FRAME_HASH_DISTANCE = 4
+DEDUP_FRAMES = True
+
+__frame_hashes = {}
+
+def compute_frame_hash(jpeg_bytes):
+    """
+    64-bit difference hash (dHash) of a JPEG as a hex string
+    """
+    image = Image.open(io.BytesIO(jpeg_bytes))
+    ### let the JPEG decoder downscale, we only need a 9x8 thumbnail
+    image.draft("L", (64, 64))
+    image = image.convert("L").resize((9, 8), Image.BILINEAR)
+    pixels = list(image.getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | int(pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return f"{value:016x}"
+
+def register_frame_hashes(frame_hashes):
+    """
+    frame_hashes: {frame_path: hash}, e.g. the hashes stored in `Video.frames`
+    """
+    __frame_hashes.update(frame_hashes)
+
+def get_frame_hash(frame_path):
+    if frame_path not in __frame_hashes:
+        __frame_hashes[frame_path] = compute_frame_hash(read_frame(frame_path))
+    return __frame_hashes[frame_path]
+
+def hash_distance(hash1, hash2):
+    return bin(int(hash1, 16) ^ int(hash2, 16)).count("1")
+
+def dedup_frame_paths(frame_paths, max_distance=FRAME_HASH_DISTANCE):
+    """
+    Collapse runs of visually identical frames into their first frame
+    """
+    if not DEDUP_FRAMES or len(frame_paths) <= 1:
+        return [*frame_paths]
+    result = []
+    last_hash = None
+    for frame_path in frame_paths:
+        cur_hash = get_frame_hash(frame_path)
+        if last_hash is not None and hash_distance(last_hash, cur_hash) <= max_distance:
+            continue
+        result.append(frame_path)
+        last_hash = cur_hash
+    return result
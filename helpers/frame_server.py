@@ -0,0 +1,82 @@
+import os
+import sys
+
+from helpers.frame_store import parse_frame_path, get_frame_store, unpack_frames
+
+def serve_frames(port, host="127.0.0.1", root="."):
+    """
+    Serve the files under `root` over HTTP, frame paths (`{video}.mp4_frames/{sec}.jpg`) are read from the frame stores,
+    so the frame paths of `output.json` resolve without unpacking the frames
+    """
+    from functools import partial
+    from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+    class FrameHandler(SimpleHTTPRequestHandler):
+        def __frame(self):
+            path = self.translate_path(self.path)
+            if os.path.exists(path):
+                return None
+            video_path, sec = parse_frame_path(os.path.relpath(path))
+            if video_path is None:
+                return None
+            store = get_frame_store(video_path)
+            if store is None or sec >= len(store):
+                return None
+            return store.read(sec)
+
+        def __send_frame(self, frame, include_body):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(frame)))
+            self.send_header("Cache-Control", "max-age=86400")
+            self.end_headers()
+            if include_body:
+                self.wfile.write(frame)
+
+        def do_GET(self):
+            frame = self.__frame()
+            if frame is None:
+                return super().do_GET()
+            self.__send_frame(frame, True)
+
+        def do_HEAD(self):
+            frame = self.__frame()
+            if frame is None:
+                return super().do_HEAD()
+            self.__send_frame(frame, False)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), partial(FrameHandler, directory=root))
+    print(f"Serving {os.path.abspath(root)} with packed frames at http://{host}:{server.server_address[1]}/")
+    return server
+
+def main(args):
+    """
+    python -m helpers.frame_server serve [--port PORT] [--root DIR]
+    python -m helpers.frame_server unpack VIDEO_PATH ...
+    """
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+    serve_parser = commands.add_parser("serve", help="Serve static files and the frames of the frame stores")
+    serve_parser.add_argument("--port", dest="port", type=int, default=8000)
+    serve_parser.add_argument("--host", dest="host", default="127.0.0.1")
+    serve_parser.add_argument("--root", dest="root", default=".", help="Directory the paths of `output.json` are relative to")
+    unpack_parser = commands.add_parser("unpack", help="Write the frames of videos as individual JPEG files")
+    unpack_parser.add_argument("video_paths", nargs="+", help="e.g. static/database/75p4UHRIMcU.mp4")
+    parsed_args = parser.parse_args(args)
+
+    if parsed_args.command == "serve":
+        server = serve_frames(parsed_args.port, parsed_args.host, parsed_args.root)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
+    else:
+        for video_path in parsed_args.video_paths:
+            print(f"Unpacked {len(unpack_frames(video_path))} frames of {video_path}")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
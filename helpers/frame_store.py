@@ -0,0 +1,146 @@
+import os
+import re
+
+import numpy as np
+
+### frames of `{video}.mp4` are packed into `{video}.mp4_frames.pack` (concatenated JPEGs) and
+### `{video}.mp4_frames.index.npy` (offsets of each second), frame paths stay `{video}.mp4_frames/{sec}.jpg`
+FRAME_PATH_PATTERN = re.compile(r"^(.*)_frames/(\d+)\.jpg$")
+
+def get_pack_path(video_path):
+    return f"{video_path}_frames.pack"
+
+def get_index_path(video_path):
+    return f"{video_path}_frames.index.npy"
+
+def get_frame_path(video_path, sec):
+    return f"{video_path}_frames/{sec}.jpg"
+
+def parse_frame_path(frame_path):
+    """
+    Returns (video_path, sec) of a frame path or (None, None)
+    """
+    match = FRAME_PATH_PATTERN.match(frame_path)
+    if match is None:
+        return None, None
+    return match.group(1), int(match.group(2))
+
+class FrameStoreWriter:
+    """
+    Appends JPEG-encoded frames of consecutive seconds to a frame store
+    """
+    video_path = ""
+    offsets = []
+
+    def __init__(self, video_path):
+        self.video_path = video_path
+        self.offsets = [0]
+        self.file = open(f"{get_pack_path(video_path)}.tmp", "wb")
+
+    def append(self, jpeg_bytes):
+        self.file.write(jpeg_bytes)
+        self.offsets.append(self.offsets[-1] + len(jpeg_bytes))
+        return get_frame_path(self.video_path, len(self.offsets) - 2)
+
+    def close(self):
+        self.file.close()
+        ### the index is written last, so a store without an index is incomplete
+        os.replace(f"{get_pack_path(self.video_path)}.tmp", get_pack_path(self.video_path))
+        with open(f"{get_index_path(self.video_path)}.tmp", "wb") as f:
+            np.save(f, np.array(self.offsets, dtype=np.int64))
+        os.replace(f"{get_index_path(self.video_path)}.tmp", get_index_path(self.video_path))
+
+class FrameStore:
+    """
+    Read-only, memory-mapped view of the frames of a video by second
+    """
+    video_path = ""
+    offsets = None
+    data = None
+    mtime = 0
+
+    def __init__(self, video_path):
+        self.video_path = video_path
+        self.offsets = np.load(get_index_path(video_path))
+        self.mtime = os.path.getmtime(get_index_path(video_path))
+        self.data = None
+        if self.offsets[-1] > 0:
+            self.data = np.memmap(get_pack_path(video_path), dtype=np.uint8, mode="r")
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def read(self, sec):
+        if sec < 0 or sec >= len(self):
+            raise IndexError(f"No frame at {sec}s in '{self.video_path}'")
+        return self.data[self.offsets[sec]:self.offsets[sec + 1]].tobytes()
+
+    def frame_paths(self):
+        return [get_frame_path(self.video_path, sec) for sec in range(len(self))]
+
+__stores = {}
+
+def frame_store_exists(video_path):
+    return os.path.exists(get_index_path(video_path))
+
+def get_frame_store(video_path):
+    """
+    Returns the (cached) frame store of a video or None if the video has no store
+    """
+    if video_path in __stores:
+        return __stores[video_path]
+    if not frame_store_exists(video_path):
+        return None
+    store = FrameStore(video_path)
+    __stores[video_path] = store
+    return store
+
+def read_frame(frame_path):
+    """
+    Returns the JPEG bytes of a frame, from the frame store if the video has one
+    """
+    video_path, sec = parse_frame_path(frame_path)
+    if video_path is not None:
+        store = get_frame_store(video_path)
+        if store is not None:
+            return store.read(sec)
+    with open(frame_path, "rb") as f:
+        return f.read()
+
+def get_frame_mtime(frame_path):
+    video_path, _ = parse_frame_path(frame_path)
+    if video_path is not None:
+        store = get_frame_store(video_path)
+        if store is not None:
+            return store.mtime
+    return os.path.getmtime(frame_path)
+
+def pack_frames(video_path):
+    """
+    Pack a legacy `{video}.mp4_frames/` directory of `{sec}.jpg` files into a frame store
+    """
+    frames_dir = f"{video_path}_frames"
+    secs = sorted([int(file.split(".")[0]) for file in os.listdir(frames_dir) if file.endswith(".jpg")])
+    writer = FrameStoreWriter(video_path)
+    for sec in secs:
+        with open(os.path.join(frames_dir, f"{sec}.jpg"), "rb") as f:
+            writer.append(f.read())
+    writer.close()
+    return get_frame_store(video_path)
+
+def unpack_frames(video_path):
+    """
+    Write the frames of a frame store as `{sec}.jpg` files, for consumers that cannot read the store
+    (`helpers.frame_server` serves them without unpacking). Frames that already exist are not rewritten
+    """
+    store = get_frame_store(video_path)
+    if store is None:
+        return []
+    os.makedirs(f"{video_path}_frames", exist_ok=True)
+    frame_paths = store.frame_paths()
+    for sec, frame_path in enumerate(frame_paths):
+        if os.path.exists(frame_path) and os.path.getmtime(frame_path) >= store.mtime:
+            continue
+        with open(frame_path, "wb") as f:
+            f.write(store.read(sec))
+    return frame_paths
@@ -0,0 +1,158 @@
+import io
+import os
+import time
+import base64
+import hashlib
+import threading
+
+from collections import OrderedDict
+
+from PIL import Image
+
+from helpers.frame_store import read_frame, get_frame_mtime
+
+IMAGE_CACHE_PATH = "static/cache/images"
+### frames are downscaled so that their longer edge is at most `IMAGE_MAX_EDGE` (None keeps the original)
+IMAGE_MAX_EDGE = 512
+IMAGE_JPEG_QUALITY = 85
+### number of data URLs kept in memory
+IMAGE_CACHE_SIZE = 2048
+### the least recently used downscaled JPEGs on disk are evicted above this size (bytes, None means unbounded)
+IMAGE_CACHE_MAX_DISK_SIZE = 512 * 1024 * 1024
+
+def downscale_jpeg(jpeg_bytes, max_edge, quality):
+    if max_edge is None:
+        return jpeg_bytes
+    image = Image.open(io.BytesIO(jpeg_bytes))
+    if max(image.size) <= max_edge:
+        return jpeg_bytes
+    image = image.convert("RGB")
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format="JPEG", quality=quality)
+    return output.getvalue()
+
+class ImageCache:
+    """
+    Bounded in-memory LRU of ready-to-send data URLs on top of an on-disk cache of downscaled JPEGs,
+    keyed by frame path, mtime and target size
+    """
+    path = IMAGE_CACHE_PATH
+    max_edge = IMAGE_MAX_EDGE
+    quality = IMAGE_JPEG_QUALITY
+    size = IMAGE_CACHE_SIZE
+    max_disk_size = IMAGE_CACHE_MAX_DISK_SIZE
+    max_age = None
+
+    hits = 0
+    disk_hits = 0
+    misses = 0
+    evictions = 0
+
+    def __init__(self, path=IMAGE_CACHE_PATH, max_edge=IMAGE_MAX_EDGE, quality=IMAGE_JPEG_QUALITY, size=IMAGE_CACHE_SIZE,
+        max_disk_size=IMAGE_CACHE_MAX_DISK_SIZE, max_age=None
+    ):
+        self.path = path
+        self.max_edge = max_edge
+        self.quality = quality
+        self.size = size
+        self.max_disk_size = max_disk_size
+        self.max_age = max_age
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__urls = OrderedDict()
+        ### {data URL: frame path} of the URLs in memory, to trace prompts without their images
+        self.__frame_paths = {}
+        self.__lock = threading.Lock()
+
+    def __key(self, frame_path):
+        key = f"{frame_path}|{get_frame_mtime(frame_path)}|{self.max_edge}|{self.quality}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def get_data_url(self, frame_path):
+        key = self.__key(frame_path)
+        with self.__lock:
+            if key in self.__urls:
+                self.__urls.move_to_end(key)
+                self.hits += 1
+                return self.__urls[key]
+
+        jpeg_bytes = None
+        entry_path = os.path.join(self.path, key[:2], f"{key}.jpg")
+        if os.path.exists(entry_path):
+            with open(entry_path, "rb") as f:
+                jpeg_bytes = f.read()
+            ### keep recently used entries from being evicted
+            os.utime(entry_path)
+            with self.__lock:
+                self.disk_hits += 1
+        else:
+            jpeg_bytes = downscale_jpeg(read_frame(frame_path), self.max_edge, self.quality)
+            os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+            tmp_path = f"{entry_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(jpeg_bytes)
+            os.replace(tmp_path, entry_path)
+            with self.__lock:
+                self.misses += 1
+
+        url = f"data:image/jpeg;base64,{base64.b64encode(jpeg_bytes).decode('utf-8')}"
+        with self.__lock:
+            self.__urls[key] = url
+            self.__frame_paths[url] = frame_path
+            while len(self.__urls) > self.size:
+                _, evicted_url = self.__urls.popitem(last=False)
+                self.__frame_paths.pop(evicted_url, None)
+        return url
+
+    def get_frame_path(self, url):
+        """
+        Frame path of a data URL returned by `get_data_url`, None if it is no longer in memory
+        """
+        with self.__lock:
+            return self.__frame_paths.get(url)
+
+    def evict(self):
+        """
+        Remove expired entries from disk, then the least recently used ones until they fit into `max_disk_size` bytes
+        """
+        if not os.path.exists(self.path):
+            return 0
+        entries = []
+        for root, _, files in os.walk(self.path):
+            for file in files:
+                if not file.endswith(".jpg"):
+                    continue
+                entry_path = os.path.join(root, file)
+                stat = os.stat(entry_path)
+                entries.append((stat.st_mtime, stat.st_size, entry_path))
+        entries = sorted(entries)
+
+        now = time.time()
+        total_size = sum([size for _, size, _ in entries])
+        removed = 0
+        for mtime, size, entry_path in entries:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            oversized = self.max_disk_size is not None and total_size > self.max_disk_size
+            if not expired and not oversized:
+                continue
+            try:
+                os.remove(entry_path)
+            except FileNotFoundError:
+                continue
+            total_size -= size
+            removed += 1
+        with self.__lock:
+            self.evictions += removed
+        return removed
+
+    def stats(self):
+        with self.__lock:
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
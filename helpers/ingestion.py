@@ -0,0 +1,112 @@
+import os
+import time
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor
+
+from helpers.pipeline import Stage, StagedPipeline
+from helpers.call_context import call_context
+from helpers.video_scripts import download_video, extract_frames, get_video_paths, get_transcription, transcript_from_response
+
+### simulated network / ASR time of the local stand-ins (seconds)
+LOCAL_FETCH_LATENCY = 0
+LOCAL_ASR_LATENCY = 0
+### length of the placeholder segments of `local_transcribe_audio`
+LOCAL_SEGMENT_SECONDS = 5
+
+def get_local_metadata(video_path):
+    """
+    The fields of the yt-dlp metadata that are used downstream, read from the video file
+    """
+    import cv2
+    video_cap = cv2.VideoCapture(video_path)
+    fps = video_cap.get(cv2.CAP_PROP_FPS)
+    frame_count = video_cap.get(cv2.CAP_PROP_FRAME_COUNT)
+    metadata = {
+        "id": os.path.splitext(os.path.basename(video_path))[0],
+        "title": os.path.splitext(os.path.basename(video_path))[0],
+        "duration": frame_count / fps if fps > 0 else 0,
+        "width": int(video_cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+        "height": int(video_cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+        "fps": fps,
+    }
+    video_cap.release()
+    return metadata
+
+def local_fetch_video(video_link):
+    """
+    Stand-in for `download_video` that only accepts videos already in the database
+    """
+    time.sleep(LOCAL_FETCH_LATENCY)
+    _, video_path, _ = get_video_paths(video_link)
+    if not os.path.exists(video_path):
+        raise FileNotFoundError(f"Video file '{video_path}' does not exist.")
+    return get_local_metadata(video_path)
+
+def local_transcribe_audio(audio_path, granularity=["segment"]):
+    """
+    Stand-in for `transcribe_audio`: serves the cached transcription if there is one,
+    otherwise placeholder segments over the duration of the video
+    """
+    time.sleep(LOCAL_ASR_LATENCY)
+    output_path = audio_path.replace(".mp3", f".{'_'.join(granularity)}.json")
+    if os.path.exists(output_path):
+        return get_transcription(audio_path)
+    duration = get_local_metadata(audio_path.replace(".mp3", ".mp4"))["duration"]
+    segments = []
+    for index, start in enumerate(range(0, int(duration), LOCAL_SEGMENT_SECONDS)):
+        segments.append({
+            "start": start,
+            "end": min(start + LOCAL_SEGMENT_SECONDS, duration),
+            "text": f" This is sentence {index} of the video.",
+        })
+    return {"segments": segments}
+
+def ingest_videos(video_links, workers=1, fetch_f=download_video, transcribe_f=None):
+    """
+    Fetch, extract frames, transcribe and split into sentences as a stream of videos, each stage with its own workers.
+    `transcribe_f(audio_path, granularity)` replaces the cached Whisper transcription, e.g. with `local_transcribe_audio`.
+    Returns ({video_link: (video_title, frame_paths, subtitles, metadata)} of the successful videos, pipeline)
+    """
+    ### the workers start from the stage threads once OpenCV is in use, forking them there can deadlock
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        def __fetch(video_link):
+            video_title, video_path, audio_path = get_video_paths(video_link)
+            return {
+                "video_title": video_title,
+                "video_path": video_path,
+                "audio_path": audio_path,
+                "metadata": fetch_f(video_link),
+            }
+
+        def __frames(video):
+            ### frame decoding is CPU-bound, the stage threads hand it to worker processes
+            video["frame_paths"] = executor.submit(extract_frames, video["video_path"]).result()
+            return video
+
+        def __transcribe(video):
+            with call_context(stage="transcribe"):
+                if transcribe_f is None:
+                    video["transcription"] = get_transcription(video["audio_path"])
+                else:
+                    video["transcription"] = transcribe_f(video["audio_path"], ["segment"])
+            return video
+
+        def __sentences(video):
+            video["subtitles"] = transcript_from_response(video["transcription"])
+            return video
+
+        pipeline = StagedPipeline([
+            Stage("fetch", __fetch, workers),
+            Stage("frames", __frames, workers),
+            Stage("transcribe", __transcribe, workers),
+            Stage("sentences", __sentences, 1),
+        ])
+        results = pipeline.run(video_links)
+
+    videos = {}
+    for video_link, video in zip(video_links, results):
+        if video is None:
+            continue
+        videos[video_link] = (video["video_title"], video["frame_paths"], video["subtitles"], video["metadata"])
+    return videos, pipeline
@@ -0,0 +1,140 @@
+import time
+import queue
+import threading
+
+from helpers.call_context import thread_target_with_context
+
+class Stage:
+    """
+    One step of a `StagedPipeline`: `f(value) -> value` run by `workers` threads
+    """
+    name = ""
+    f = None
+    workers = 1
+
+    def __init__(self, name, f, workers=1):
+        self.name = name
+        self.f = f
+        self.workers = max(1, workers)
+
+class StageTimings:
+    name = ""
+    count = 0
+    failures = 0
+    busy = 0
+    max = 0
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.failures = 0
+        self.busy = 0
+        self.max = 0
+
+    def add(self, elapsed, failed):
+        self.count += 1
+        self.failures += int(failed)
+        self.busy += elapsed
+        self.max = max(self.max, elapsed)
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "count": self.count,
+            "failures": self.failures,
+            "busy": self.busy,
+            "mean": self.busy / self.count if self.count > 0 else 0,
+            "max": self.max,
+        }
+
+### put on a stage queue to stop one of its workers
+_DONE = object()
+
+class StagedPipeline:
+    """
+    Items flow through the stages as a stream: every stage has its own bounded queue and worker threads,
+    so different items can be in different stages at the same time.
+    An item that fails in a stage is dropped from the later stages, the other items are not affected.
+    """
+    stages = []
+    queue_size = 0
+
+    def __init__(self, stages, queue_size=None):
+        self.stages = stages
+        ### by default a stage buffers at most two items per worker
+        self.queue_size = queue_size
+        self.timings = {}
+        self.errors = {}
+        self.wall_time = 0
+
+    def run(self, items):
+        """
+        Returns the results of the last stage in the order of `items`, None for the failed items
+        """
+        self.timings = {stage.name: StageTimings(stage.name) for stage in self.stages}
+        self.errors = {}
+        results = [None for _ in items]
+        lock = threading.Lock()
+        queues = [
+            queue.Queue(maxsize=self.queue_size if self.queue_size is not None else 2 * stage.workers)
+            for stage in self.stages
+        ]
+
+        def __work(stage_idx):
+            stage = self.stages[stage_idx]
+            while True:
+                task = queues[stage_idx].get()
+                if task is _DONE:
+                    break
+                item_idx, value = task
+                start = time.perf_counter()
+                failed = False
+                try:
+                    value = stage.f(value)
+                except Exception as e:
+                    failed = True
+                    print(f"Error in stage '{stage.name}': {items[item_idx]}")
+                    print(e)
+                    with lock:
+                        self.errors[item_idx] = (stage.name, e)
+                with lock:
+                    self.timings[stage.name].add(time.perf_counter() - start, failed)
+                if failed:
+                    continue
+                if stage_idx + 1 < len(self.stages):
+                    queues[stage_idx + 1].put((item_idx, value))
+                else:
+                    results[item_idx] = value
+
+        start = time.perf_counter()
+        threads = []
+        for stage_idx, stage in enumerate(self.stages):
+            stage_threads = [
+                threading.Thread(target=thread_target_with_context(__work), args=(stage_idx,), daemon=True)
+                for _ in range(stage.workers)
+            ]
+            for thread in stage_threads:
+                thread.start()
+            threads.append(stage_threads)
+
+        for item_idx, item in enumerate(items):
+            queues[0].put((item_idx, item))
+        ### shut the stages down in order, a stage is drained once all workers of the previous one exited
+        for stage_idx, stage in enumerate(self.stages):
+            for _ in range(stage.workers):
+                queues[stage_idx].put(_DONE)
+            for thread in threads[stage_idx]:
+                thread.join()
+        self.wall_time = time.perf_counter() - start
+        return results
+
+    def summary(self):
+        lines = [f"{'stage':12s} {'items':>6s} {'failed':>6s} {'busy':>9s} {'mean':>8s} {'max':>8s}"]
+        for stage in self.stages:
+            timings = self.timings.get(stage.name, StageTimings(stage.name))
+            lines.append(
+                f"{stage.name:12s} {timings.count:6d} {timings.failures:6d} "
+                f"{timings.busy:8.2f}s {timings.to_dict()['mean']:7.2f}s {timings.max:7.2f}s"
+            )
+        lines.append(f"{'wall':12s} {'':13s} {self.wall_time:8.2f}s")
+        return "\n".join(lines)
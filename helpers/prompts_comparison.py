@@ -1,10 +1,12 @@
 from pydantic_models.comparison import AlignmentsSchema4
 
 from helpers import get_response_pydantic, get_response_pydantic_with_message, extend_contents
+from helpers import get_response_pydantic_async, get_response_pydantic_with_message_async
+from helpers.call_context import prompt_call
 
 INCLUDE_IMAGES = True
 
-def get_subgoal_alignments_v4(contents1, contents2, subgoal, task):
+def get_subgoal_alignments_v4_request(contents1, contents2, subgoal, task):
     messages = [
         {
             "role": "system",
@@ -28,13 +30,26 @@ def get_subgoal_alignments_v4(contents1, contents2, subgoal, task):
             }] + extend_contents(contents2, include_images=INCLUDE_IMAGES),
         },
     ]
+    return messages, AlignmentsSchema4
 
-    response = get_response_pydantic(messages, AlignmentsSchema4)
+def get_subgoal_alignments_v4_response(response, contents1, contents2, subgoal, task):
     new_contents_in_1 = response["new_contents_in_1"]
     new_contents_in_2 = response["new_contents_in_2"]
     return new_contents_in_1, new_contents_in_2
 
-def get_steps_alignments_v4(steps1, steps2, task):
+@prompt_call
+def get_subgoal_alignments_v4(contents1, contents2, subgoal, task):
+    messages, response_format = get_subgoal_alignments_v4_request(contents1, contents2, subgoal, task)
+    response = get_response_pydantic(messages, response_format)
+    return get_subgoal_alignments_v4_response(response, contents1, contents2, subgoal, task)
+
+@prompt_call
+async def get_subgoal_alignments_v4_async(contents1, contents2, subgoal, task):
+    messages, response_format = get_subgoal_alignments_v4_request(contents1, contents2, subgoal, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return get_subgoal_alignments_v4_response(response, contents1, contents2, subgoal, task)
+
+def get_steps_alignments_v4_request(steps1, steps2, task):
     messages = [
         {
             "role": "system",
@@ -58,13 +73,26 @@ def get_steps_alignments_v4(steps1, steps2, task):
             }]
         },
     ]
+    return messages, AlignmentsSchema4
 
-    response = get_response_pydantic(messages, AlignmentsSchema4)
+def get_steps_alignments_v4_response(response, steps1, steps2, task):
     new_contents_in_1 = response["new_contents_in_1"]
     new_contents_in_2 = response["new_contents_in_2"]
     return new_contents_in_1, new_contents_in_2
 
-def get_transcript_alignments_v3(contents1, contents2, task):
+@prompt_call
+def get_steps_alignments_v4(steps1, steps2, task):
+    messages, response_format = get_steps_alignments_v4_request(steps1, steps2, task)
+    response = get_response_pydantic(messages, response_format)
+    return get_steps_alignments_v4_response(response, steps1, steps2, task)
+
+@prompt_call
+async def get_steps_alignments_v4_async(steps1, steps2, task):
+    messages, response_format = get_steps_alignments_v4_request(steps1, steps2, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return get_steps_alignments_v4_response(response, steps1, steps2, task)
+
+def get_transcript_alignments_v3_request(contents1, contents2, task):
     messages = [
         {
             "role": "system",
@@ -88,35 +116,61 @@ def get_transcript_alignments_v3(contents1, contents2, task):
             }] + extend_contents(contents1, INCLUDE_IMAGES),
         },
     ]
+    return messages, AlignmentsSchema4
 
+def get_transcript_alignments_v3_response(response, message, messages, alignments):
+    """
+    Collects the alignments of one round and extends `messages` for the next one; returns whether to continue
+    """
+    messages.append({
+        "role": "assistant",
+        "content": message
+    })
+    messages.append({
+        "role": "user",
+        "content": [{
+            "type": "text",
+            "text": "Provide additional supplementary and contradictory contents presented in the current video only. Do not repeat yourself, be specific, and focus on one point at a time."
+        }]
+    })
+
+    found_any = False
+    for alignment in response["supplementary_information"]:
+        alignment["classification"] = "supplementary_" + alignment["classification"]
+        alignments.append(alignment)
+        found_any = True
+    for alignment in response["contradictory_information"]:
+        alignment["classification"] = "contradictory_" + alignment["classification"]
+        alignments.append(alignment)
+        found_any = True
+    if found_any is False or response["more_information_exist"] is False:
+        return False
+    return True
+
+@prompt_call
+def get_transcript_alignments_v3(contents1, contents2, task):
+    messages, response_format = get_transcript_alignments_v3_request(contents1, contents2, task)
     alignments = []
 
     tries = 5
     while tries > 0:
         tries -= 1
-        response, message = get_response_pydantic_with_message(messages, AlignmentsSchema4)
+        response, message = get_response_pydantic_with_message(messages, response_format)
+        if not get_transcript_alignments_v3_response(response, message, messages, alignments):
+            break
 
-        messages.append({
-            "role": "assistant",
-            "content": message
-        })
-        messages.append({
-            "role": "user",
-            "content": [{
-                "type": "text",
-                "text": "Provide additional supplementary and contradictory contents presented in the current video only. Do not repeat yourself, be specific, and focus on one point at a time."
-            }]
-        })
-        
-        for alignment in response["supplementary_information"]:
-            alignment["classification"] = "supplementary_" + alignment["classification"]
-            alignments.append(alignment)
-            found_any = True
-        for alignment in response["contradictory_information"]:
-            alignment["classification"] = "contradictory_" + alignment["classification"]
-            alignments.append(alignment)
-            found_any = True
-        if found_any is False or response["more_information_exist"] is False:
+    return alignments
+
+@prompt_call
+async def get_transcript_alignments_v3_async(contents1, contents2, task):
+    messages, response_format = get_transcript_alignments_v3_request(contents1, contents2, task)
+    alignments = []
+
+    tries = 5
+    while tries > 0:
+        tries -= 1
+        response, message = await get_response_pydantic_with_message_async(messages, response_format)
+        if not get_transcript_alignments_v3_response(response, message, messages, alignments):
             break
 
     return alignments
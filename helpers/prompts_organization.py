@@ -1,8 +1,9 @@
-from helpers import get_response_pydantic, extend_contents
+from helpers import get_response_pydantic, get_response_pydantic_async, extend_contents
+from helpers.call_context import prompt_call
 
 from pydantic_models.organization import SummarizedAlignmentSchema2, GroupsSchema, GroupSchema
 
-def get_notable_v4(contents, subgoal, aspect, task):
+def get_notable_v4_request(contents, subgoal, aspect, task):
     messages = [
         {
             "role": "system",
@@ -16,11 +17,24 @@ def get_notable_v4(contents, subgoal, aspect, task):
             "content": extend_contents(contents),
         }
     ]
+    return messages, SummarizedAlignmentSchema2
 
-    response = get_response_pydantic(messages, SummarizedAlignmentSchema2)
+def get_notable_v4_response(response, contents, subgoal, aspect, task):
     return response
 
-def get_hook_v4(contents, subgoal, relation, aspect, task):
+@prompt_call
+def get_notable_v4(contents, subgoal, aspect, task):
+    messages, response_format = get_notable_v4_request(contents, subgoal, aspect, task)
+    response = get_response_pydantic(messages, response_format)
+    return get_notable_v4_response(response, contents, subgoal, aspect, task)
+
+@prompt_call
+async def get_notable_v4_async(contents, subgoal, aspect, task):
+    messages, response_format = get_notable_v4_request(contents, subgoal, aspect, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return get_notable_v4_response(response, contents, subgoal, aspect, task)
+
+def get_hook_v4_request(contents, subgoal, relation, aspect, task):
     messages = [
         {
             "role": "system",
@@ -34,11 +48,24 @@ def get_hook_v4(contents, subgoal, relation, aspect, task):
             "content": extend_contents(contents, include_ids=True),
         }
     ]
+    return messages, GroupSchema
 
-    response = get_response_pydantic(messages, GroupSchema)
+def get_hook_v4_response(response, contents, subgoal, relation, aspect, task):
     return response
 
-def get_hooks_v4(contents, subgoal, relation, aspect, task):
+@prompt_call
+def get_hook_v4(contents, subgoal, relation, aspect, task):
+    messages, response_format = get_hook_v4_request(contents, subgoal, relation, aspect, task)
+    response = get_response_pydantic(messages, response_format)
+    return get_hook_v4_response(response, contents, subgoal, relation, aspect, task)
+
+@prompt_call
+async def get_hook_v4_async(contents, subgoal, relation, aspect, task):
+    messages, response_format = get_hook_v4_request(contents, subgoal, relation, aspect, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return get_hook_v4_response(response, contents, subgoal, relation, aspect, task)
+
+def get_hooks_v4_request(contents, subgoal, relation, aspect, task):
     messages = [
         {
             "role": "system",
@@ -52,9 +79,9 @@ def get_hooks_v4(contents, subgoal, relation, aspect, task):
             "content": extend_contents(contents, include_ids=True),
         }
     ]
+    return messages, GroupsSchema
 
-    response = get_response_pydantic(messages, GroupsSchema)
-
+def get_hooks_v4_response(response, contents, subgoal, relation, aspect, task):
     groups = response["groups"]
     for group in groups:
         group["links"] = []
@@ -70,4 +97,16 @@ def get_hooks_v4(contents, subgoal, relation, aspect, task):
     for i in range(len(coverage)):
         if coverage[i] == 0:
             print(f"WARNING: Content {i} is not assigned to any group.")
-    return groups
\ No newline at end of file
+    return groups
+
+@prompt_call
+def get_hooks_v4(contents, subgoal, relation, aspect, task):
+    messages, response_format = get_hooks_v4_request(contents, subgoal, relation, aspect, task)
+    response = get_response_pydantic(messages, response_format)
+    return get_hooks_v4_response(response, contents, subgoal, relation, aspect, task)
+
+@prompt_call
+async def get_hooks_v4_async(contents, subgoal, relation, aspect, task):
+    messages, response_format = get_hooks_v4_request(contents, subgoal, relation, aspect, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return get_hooks_v4_response(response, contents, subgoal, relation, aspect, task)
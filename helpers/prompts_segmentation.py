@@ -1,8 +1,11 @@
-from helpers import get_response_pydantic, extend_contents
+import asyncio
+
+from helpers import get_response_pydantic, get_response_pydantic_async, extend_contents
+from helpers.call_context import prompt_call
 
 from pydantic_models.segmentation import StepsSchema, AggStepsSchema, TranscriptAssignmentsSchema, get_segmentation_schema_v4, AggSubgoalsSchema
 
-def assign_transcripts_v4(contents, subgoals, task):
+def assign_transcripts_v4_requests(contents, subgoals, task):
     messages = [
         {"role": "system", "content": "You are a helpful assistant specializing in analyzing tutorial video content. Given a narration of a tutorial video for the task `{task}` and a set of steps, analyze each sentence and find the steps it is talking about. You can specify multiple steps per sentence or leave it empty if it does not belong to any of the steps. Additionally, specify relevance of the sentence to the task at hand.".format(task=task)},
         {
@@ -21,8 +24,8 @@ def assign_transcripts_v4(contents, subgoals, task):
         },
     ]
 
-    
-    total_assignments = []
+
+    requests = []
     for i in range(0, len(contents), 20):
         message = {
             "role": "user",
@@ -31,7 +34,12 @@ def assign_transcripts_v4(contents, subgoals, task):
                 "text": f"Assign steps to the sentences between {i} and {min(i + 19, len(contents) - 1)}:\n"
             }]
         }
-        response = get_response_pydantic(messages + [message], TranscriptAssignmentsSchema)
+        requests.append((messages + [message], TranscriptAssignmentsSchema))
+    return requests
+
+def assign_transcripts_v4_response(responses, contents, subgoals, task):
+    total_assignments = []
+    for response in responses:
         total_assignments += response["assignments"]
 
     segments = []
@@ -58,7 +66,22 @@ def assign_transcripts_v4(contents, subgoals, task):
 
     return segments
 
-def segment_video_v4(contents, steps, task):
+@prompt_call
+def assign_transcripts_v4(contents, subgoals, task):
+    responses = []
+    for messages, response_format in assign_transcripts_v4_requests(contents, subgoals, task):
+        responses.append(get_response_pydantic(messages, response_format))
+    return assign_transcripts_v4_response(responses, contents, subgoals, task)
+
+@prompt_call
+async def assign_transcripts_v4_async(contents, subgoals, task):
+    responses = await asyncio.gather(*[
+        get_response_pydantic_async(messages, response_format)
+        for messages, response_format in assign_transcripts_v4_requests(contents, subgoals, task)
+    ])
+    return assign_transcripts_v4_response(responses, contents, subgoals, task)
+
+def segment_video_v4_request(contents, steps, task):
     messages = [
         {"role": "system", "content": "You are a helpful assistant specializing in analyzing tutorial video content. Given a narration of a tutorial video for the task `{task}` and a set of steps, segment the entire video based on the steps. Start from the beginning of the video (i.e., 0-th sentence) and sequentially assign matching relevant step label to each subsequent segment of the narration. Make sure that the all the procedurally important parts of the narration are covered.".format(task=task)},
         {
@@ -78,9 +101,9 @@ def segment_video_v4(contents, steps, task):
     ]
 
     SegmentationSchema = get_segmentation_schema_v4(None)
+    return messages, SegmentationSchema
 
-    response = get_response_pydantic(messages, SegmentationSchema)
-
+def segment_video_v4_response(response, contents, steps, task):
     contents_coverage = [""] * len(contents)
     response["segments"] = sorted(response["segments"], key=lambda x: x["start_index"])
 
@@ -117,7 +140,19 @@ def segment_video_v4(contents, steps, task):
             })
     return segments
 
-def define_steps_v4(contents, task):
+@prompt_call
+def segment_video_v4(contents, steps, task):
+    messages, response_format = segment_video_v4_request(contents, steps, task)
+    response = get_response_pydantic(messages, response_format)
+    return segment_video_v4_response(response, contents, steps, task)
+
+@prompt_call
+async def segment_video_v4_async(contents, steps, task):
+    messages, response_format = segment_video_v4_request(contents, steps, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return segment_video_v4_response(response, contents, steps, task)
+
+def define_steps_v4_request(contents, task):
     messages = [
         {"role": "system", "content": "You are a helpful assistant specializing in analyzing tutorial video content. Given a narration of a tutorial video for the task `{task}`, analyze it and generate a comprehensive list of steps presented in the video. Focus on the essence of the steps and avoid including unnecessary details. Ensure that the steps are clear, concise, and cover all the critical procedural information.".format(task=task)},
         {
@@ -128,12 +163,25 @@ def define_steps_v4(contents, task):
             }] + extend_contents(contents),
         },
     ]
-    
-    response = get_response_pydantic(messages, StepsSchema)
+    return messages, StepsSchema
+
+def define_steps_v4_response(response, contents, task):
     steps = response["steps"]
     return steps
 
-def align_steps_v4(sequence1, sequence2, task):
+@prompt_call
+def define_steps_v4(contents, task):
+    messages, response_format = define_steps_v4_request(contents, task)
+    response = get_response_pydantic(messages, response_format)
+    return define_steps_v4_response(response, contents, task)
+
+@prompt_call
+async def define_steps_v4_async(contents, task):
+    messages, response_format = define_steps_v4_request(contents, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return define_steps_v4_response(response, contents, task)
+
+def align_steps_v4_request(sequence1, sequence2, task):
     sequence1_str = "\n".join(sequence1)
     sequence2_str = "\n".join(sequence2)
     messages = [
@@ -141,8 +189,9 @@ def align_steps_v4(sequence1, sequence2, task):
         {"role": "user", "content": f"## Video 1:\n{sequence1_str}"},
         {"role": "user", "content": f"## Video 2:\n{sequence2_str}"}
     ]
-    
-    response = get_response_pydantic(messages, AggStepsSchema)
+    return messages, AggStepsSchema
+
+def align_steps_v4_response(response, sequence1, sequence2, task):
     if len(response["assignments_1"]) != len(sequence1) or len(response["assignments_2"]) != len(sequence2):
         print("ERROR: Length of assignments_1 does not match the length of sequence1")
 
@@ -170,7 +219,19 @@ def align_steps_v4(sequence1, sequence2, task):
                 print("ERROR: Original step from sequence found in multiple agg_steps")
     return steps
 
-def extract_subgoals_v4(steps, task):
+@prompt_call
+def align_steps_v4(sequence1, sequence2, task):
+    messages, response_format = align_steps_v4_request(sequence1, sequence2, task)
+    response = get_response_pydantic(messages, response_format)
+    return align_steps_v4_response(response, sequence1, sequence2, task)
+
+@prompt_call
+async def align_steps_v4_async(sequence1, sequence2, task):
+    messages, response_format = align_steps_v4_request(sequence1, sequence2, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return align_steps_v4_response(response, sequence1, sequence2, task)
+
+def extract_subgoals_v4_request(steps, task):
     messages = [
         {"role": "system", "content": "You are a helpful assistant specializing in analyzing tutorial content. You are given a set of generalized steps to perform the task `{task}`. Identify and extract subgoals within this procedure. Each subgoal should represent a distinct, meaningful intermediate stage or outcome within the procedure. Label each subgoal concisely in 1 to 3 words, ensuring each term is both informative and distinct.”".format(task=task)},
         {
@@ -178,8 +239,9 @@ def extract_subgoals_v4(steps, task):
             "content": "## Generalized Steps:\n" + "\n".join(steps)
         }
     ]
-    
-    response = get_response_pydantic(messages, AggSubgoalsSchema)
+    return messages, AggSubgoalsSchema
+
+def extract_subgoals_v4_response(response, steps, task):
     subgoals = response["subgoals"]
     assignments = response["assignments"]
     for subgoal in subgoals:
@@ -191,4 +253,16 @@ def extract_subgoals_v4(steps, task):
                 found += 1
         if found == 0:
             print("ERROR: Subgoal not found in assignments")
-    return subgoals
\ No newline at end of file
+    return subgoals
+
+@prompt_call
+def extract_subgoals_v4(steps, task):
+    messages, response_format = extract_subgoals_v4_request(steps, task)
+    response = get_response_pydantic(messages, response_format)
+    return extract_subgoals_v4_response(response, steps, task)
+
+@prompt_call
+async def extract_subgoals_v4_async(steps, task):
+    messages, response_format = extract_subgoals_v4_request(steps, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return extract_subgoals_v4_response(response, steps, task)
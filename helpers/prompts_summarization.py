@@ -1,10 +1,9 @@
-from helpers import get_response_pydantic, extend_contents
+from helpers import get_response_pydantic, get_response_pydantic_async, extend_contents
+from helpers.call_context import prompt_call
 
 from pydantic_models.summarization import StepSummarySchema
 
-def get_step_summary_v4(contents, steps, task):
-    if len(steps) == 0:
-        return None
+def get_step_summary_v4_request(contents, steps, task):
     if len(steps) == 1:
         steps = f"step `{steps[0]}`"
     else: 
@@ -23,9 +22,26 @@ def get_step_summary_v4(contents, steps, task):
             }] + extend_contents(contents, include_ids=True),
         }
     ]
-    response = get_response_pydantic(messages, StepSummarySchema)
+    return messages, StepSummarySchema
 
+def get_step_summary_v4_response(response, contents, steps, task):
     response["frame_paths"] = []
     for content in contents:
         response["frame_paths"] = response["frame_paths"] + content["frame_paths"]        
-    return response
\ No newline at end of file
+    return response
+
+@prompt_call
+def get_step_summary_v4(contents, steps, task):
+    if len(steps) == 0:
+        return None
+    messages, response_format = get_step_summary_v4_request(contents, steps, task)
+    response = get_response_pydantic(messages, response_format)
+    return get_step_summary_v4_response(response, contents, steps, task)
+
+@prompt_call
+async def get_step_summary_v4_async(contents, steps, task):
+    if len(steps) == 0:
+        return None
+    messages, response_format = get_step_summary_v4_request(contents, steps, task)
+    response = await get_response_pydantic_async(messages, response_format)
+    return get_step_summary_v4_response(response, contents, steps, task)
@@ -0,0 +1,46 @@
+import numpy as np
+
+def normalize_embeddings(embeddings):
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.maximum(norms, 1e-12)
+
+def top_k_similar(embeddings, query_embeddings, k=1, mask=None, normalize=False):
+    """
+    embeddings: (n, d) rows to search
+    query_embeddings: (q, d)
+    mask: optional boolean (n,) for all queries or (q, n) per query, only `True` rows are candidates
+    Returns (indexes, scores), both (q, k) and sorted by decreasing score;
+    slots without a candidate have index -1 and score -inf
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    query_embeddings = np.asarray(query_embeddings, dtype=np.float32)
+    if query_embeddings.ndim == 1:
+        query_embeddings = query_embeddings[None, :]
+    n = len(embeddings)
+    q = len(query_embeddings)
+    if n == 0 or q == 0:
+        return np.full((q, k), -1), np.full((q, k), -np.inf, dtype=np.float32)
+    if normalize:
+        embeddings = normalize_embeddings(embeddings)
+        query_embeddings = normalize_embeddings(query_embeddings)
+
+    scores = query_embeddings @ embeddings.T
+    if mask is not None:
+        scores = np.where(np.broadcast_to(np.asarray(mask, dtype=bool), scores.shape), scores, -np.inf)
+
+    top_k = min(k, n)
+    if top_k < n:
+        candidates = np.argpartition(scores, n - top_k, axis=1)[:, n - top_k:]
+    else:
+        candidates = np.broadcast_to(np.arange(n), (q, n))
+    candidate_scores = np.take_along_axis(scores, candidates, axis=1)
+    order = np.argsort(-candidate_scores, axis=1, kind="stable")
+    indexes = np.take_along_axis(candidates, order, axis=1)
+    top_scores = np.take_along_axis(candidate_scores, order, axis=1)
+
+    indexes = np.where(np.isneginf(top_scores), -1, indexes)
+    if top_k < k:
+        indexes = np.pad(indexes, ((0, 0), (0, k - top_k)), constant_values=-1)
+        top_scores = np.pad(top_scores, ((0, 0), (0, k - top_k)), constant_values=-np.inf)
+    return indexes, top_scores
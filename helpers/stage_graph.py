@@ -0,0 +1,134 @@
+import json
+import time
+import hashlib
+import inspect
+import threading
+
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from helpers.call_context import call_context, submit_with_context
+
+def fingerprint(*parts):
+    """
+    Stable hash of JSON-serializable `parts`
+    """
+    data = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+__prompt_versions = {}
+__prompt_versions_lock = threading.Lock()
+
+def prompt_version(*objects):
+    """
+    Version of a prompt: hash of the model settings, the source of the prompt functions and the JSON schema of the response models,
+    so editing a prompt or its schema changes its version
+    """
+    from helpers import MODEL_NAME, SEED, TEMPERATURE
+    key = tuple(id(obj) for obj in objects)
+    with __prompt_versions_lock:
+        if key in __prompt_versions:
+            return __prompt_versions[key]
+    parts = [MODEL_NAME, SEED, TEMPERATURE]
+    for obj in objects:
+        if hasattr(obj, "model_json_schema"):
+            parts.append(obj.model_json_schema())
+        else:
+            parts.append(inspect.getsource(obj))
+    version = fingerprint(*parts)
+    with __prompt_versions_lock:
+        __prompt_versions[key] = version
+    return version
+
+class GraphStage:
+    """
+    One node of a `StageGraph`: `f()` runs once all stages in `deps` finished
+    """
+    name = ""
+    f = None
+    deps = []
+
+    def __init__(self, name, f, deps=[]):
+        self.name = name
+        self.f = f
+        self.deps = list(deps)
+
+class StageGraph:
+    """
+    Runs the stages in dependency order, stages whose dependencies finished run concurrently.
+    A failed stage skips all stages that depend on it, the error is raised once the other stages finished.
+    Whether a stage has to recompute anything is up to the stage itself (see `fingerprint`).
+    """
+    stages = []
+    workers = 1
+
+    def __init__(self, stages, workers=None):
+        self.stages = stages
+        names = set([stage.name for stage in stages])
+        for stage in stages:
+            for dep in stage.deps:
+                if dep not in names:
+                    raise ValueError(f"Stage `{stage.name}` depends on unknown stage `{dep}`")
+        self.workers = workers if workers is not None else len(stages)
+        self.timings = {}
+        self.errors = {}
+        self.wall_time = 0
+
+    def run(self):
+        self.timings = {}
+        self.errors = {}
+        done = set()
+        skipped = set()
+        pending = list(self.stages)
+        running = {}
+
+        def __run_stage(stage):
+            start = time.perf_counter()
+            try:
+                ### the LLM calls of the stage are attributed to it (see `helpers.telemetry`)
+                with call_context(stage=stage.name):
+                    stage.f()
+            finally:
+                self.timings[stage.name] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max(1, self.workers)) as executor:
+            while len(pending) > 0 or len(running) > 0:
+                for stage in list(pending):
+                    if any(dep in skipped for dep in stage.deps):
+                        pending.remove(stage)
+                        skipped.add(stage.name)
+                        print(f"WARNING: skipping stage `{stage.name}`, a stage it depends on failed")
+                        continue
+                    if all(dep in done for dep in stage.deps):
+                        pending.remove(stage)
+                        running[submit_with_context(executor, __run_stage, stage)] = stage
+                if len(running) == 0:
+                    if len(pending) > 0:
+                        raise ValueError("Stage graph has a cycle: " + ", ".join([stage.name for stage in pending]))
+                    break
+                finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    try:
+                        future.result()
+                        done.add(stage.name)
+                    except Exception as e:
+                        print(f"Error in stage `{stage.name}`")
+                        print(e)
+                        self.errors[stage.name] = e
+                        skipped.add(stage.name)
+        self.wall_time = time.perf_counter() - start
+        if len(self.errors) > 0:
+            raise list(self.errors.values())[0]
+
+    def summary(self):
+        lines = [f"{'stage':24s} {'time':>9s}"]
+        for stage in self.stages:
+            if stage.name in self.errors:
+                lines.append(f"{stage.name:24s} {'failed':>9s}")
+            elif stage.name in self.timings:
+                lines.append(f"{stage.name:24s} {self.timings[stage.name]:8.2f}s")
+            else:
+                lines.append(f"{stage.name:24s} {'skipped':>9s}")
+        lines.append(f"{'wall':24s} {self.wall_time:8.2f}s")
+        return "\n".join(lines)
@@ -0,0 +1,337 @@
+import os
+import sys
+import json
+import sqlite3
+import hashlib
+import threading
+
+from urllib.parse import quote
+
+### records of the pool (subgoals, alignment sets, hooks, stages) are stored under this scope, the videos under their id
+POOL_SCOPE = ""
+STATE_STORES = ["json", "sqlite", "msgpack"]
+
+def encode_record(value):
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+def record_digest(data):
+    return hashlib.sha1(data).hexdigest()
+
+def value_digest(value):
+    """
+    Digest of a record, as returned by the `digest` of the state stores
+    """
+    return record_digest(encode_record(value))
+
+class JsonStateStore:
+    """
+    The JSON files of a task directory (`video_data.json`, `subgoal_data.json`, `alignment_sets.json`, `hooks.json`, `stages.json`)
+    as a state store; everything is read at once and every `sync` rewrites all files
+    """
+    path = ""
+
+    def __init__(self, path):
+        self.path = path
+        self.__records = None
+        self.__lock = threading.Lock()
+
+    def __read(self, filename, default):
+        file_path = os.path.join(self.path, filename)
+        if not os.path.exists(file_path):
+            return default
+        with open(file_path, "r") as file:
+            return json.load(file)
+
+    def __load(self):
+        if self.__records is not None:
+            return self.__records
+        records = {}
+        video_ids = []
+        for data in self.__read("video_data.json", []):
+            video_ids.append(data["video_id"])
+            for name, value in data.items():
+                records[(data["video_id"], name)] = value
+        if len(video_ids) > 0:
+            records[(POOL_SCOPE, "videos")] = video_ids
+        if os.path.exists(os.path.join(self.path, "subgoal_data.json")):
+            records[(POOL_SCOPE, "subgoals")] = self.__read("subgoal_data.json", [])
+        for approach, alignment_sets in self.__read("alignment_sets.json", {}).items():
+            records[(POOL_SCOPE, f"alignment_sets/{approach}")] = alignment_sets
+        for key, hooks in self.__read("hooks.json", {}).items():
+            records[(POOL_SCOPE, f"hooks/{key}")] = hooks
+        for name, value in self.__read("stages.json", {}).items():
+            records[(POOL_SCOPE, name)] = value
+        self.__records = records
+        return records
+
+    def scopes(self):
+        with self.__lock:
+            return list(dict.fromkeys([scope for scope, _ in self.__load()]))
+
+    def names(self, scope):
+        with self.__lock:
+            return [name for cur_scope, name in self.__load() if cur_scope == scope]
+
+    def get(self, scope, name, default=None):
+        with self.__lock:
+            return self.__load().get((scope, name), default)
+
+    def digest(self, scope, name):
+        with self.__lock:
+            records = self.__load()
+            if (scope, name) not in records:
+                return None
+            return value_digest(records[(scope, name)])
+
+    def sync(self, records, keep=()):
+        """
+        Make the store hold exactly `records` ({(scope, name): value}) and the current records in `keep`
+        Returns the number of records written
+        """
+        with self.__lock:
+            current = self.__load()
+            new_records = dict(records)
+            for key in keep:
+                if key in current and key not in new_records:
+                    new_records[key] = current[key]
+
+            video_data = []
+            for video_id in new_records.get((POOL_SCOPE, "videos"), []):
+                video_data.append({
+                    name: value for (scope, name), value in new_records.items() if scope == video_id
+                })
+            alignment_sets = {}
+            hooks = {}
+            stages = {}
+            for (scope, name), value in new_records.items():
+                if scope != POOL_SCOPE:
+                    continue
+                if name.startswith("alignment_sets/"):
+                    alignment_sets[name[len("alignment_sets/"):]] = value
+                elif name.startswith("hooks/"):
+                    hooks[name[len("hooks/"):]] = value
+                elif name not in ["videos", "subgoals"]:
+                    stages[name] = value
+
+            os.makedirs(self.path, exist_ok=True)
+            for filename, value in [
+                ("video_data.json", video_data),
+                ("subgoal_data.json", new_records.get((POOL_SCOPE, "subgoals"), [])),
+                ("alignment_sets.json", alignment_sets),
+                ("hooks.json", hooks),
+                ("stages.json", stages),
+            ]:
+                with open(os.path.join(self.path, filename), "w") as file:
+                    json.dump(value, file, indent=2)
+            self.__records = new_records
+            return len(new_records)
+
+    def close(self):
+        pass
+
+class SQLiteStateStore:
+    """
+    One row per (scope, name) record in a SQLite database; `sync` is one transaction that only writes the changed records
+    """
+    path = ""
+
+    def __init__(self, path):
+        self.path = path
+        self.__lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.__connection = sqlite3.connect(path, check_same_thread=False)
+        self.__connection.execute("PRAGMA journal_mode=WAL")
+        self.__connection.execute(
+            "CREATE TABLE IF NOT EXISTS records (scope TEXT, name TEXT, value BLOB, digest TEXT, PRIMARY KEY (scope, name))"
+        )
+        self.__connection.commit()
+
+    def scopes(self):
+        with self.__lock:
+            rows = self.__connection.execute("SELECT scope FROM records GROUP BY scope ORDER BY MIN(rowid)").fetchall()
+        return [row[0] for row in rows]
+
+    def names(self, scope):
+        with self.__lock:
+            rows = self.__connection.execute("SELECT name FROM records WHERE scope = ? ORDER BY rowid", (scope,)).fetchall()
+        return [row[0] for row in rows]
+
+    def get(self, scope, name, default=None):
+        with self.__lock:
+            row = self.__connection.execute("SELECT value FROM records WHERE scope = ? AND name = ?", (scope, name)).fetchone()
+        if row is None:
+            return default
+        return json.loads(row[0])
+
+    def digest(self, scope, name):
+        with self.__lock:
+            row = self.__connection.execute("SELECT digest FROM records WHERE scope = ? AND name = ?", (scope, name)).fetchone()
+        return row[0] if row is not None else None
+
+    def sync(self, records, keep=()):
+        """
+        Make the store hold exactly `records` ({(scope, name): value}) and the current records in `keep`
+        Returns the number of records written
+        """
+        keep = set(keep)
+        written = 0
+        with self.__lock:
+            with self.__connection:
+                digests = {
+                    (scope, name): digest for scope, name, digest
+                    in self.__connection.execute("SELECT scope, name, digest FROM records").fetchall()
+                }
+                for (scope, name), value in records.items():
+                    data = encode_record(value)
+                    digest = record_digest(data)
+                    if digests.get((scope, name)) == digest:
+                        continue
+                    ### update in place, so the row keeps its position (the order of `names`)
+                    cursor = self.__connection.execute(
+                        "UPDATE records SET value = ?, digest = ? WHERE scope = ? AND name = ?", (data, digest, scope, name)
+                    )
+                    if cursor.rowcount == 0:
+                        self.__connection.execute(
+                            "INSERT INTO records (scope, name, value, digest) VALUES (?, ?, ?, ?)", (scope, name, data, digest)
+                        )
+                    written += 1
+                for key in digests:
+                    if key not in records and key not in keep:
+                        self.__connection.execute("DELETE FROM records WHERE scope = ? AND name = ?", key)
+        return written
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+class MsgpackStateStore:
+    """
+    One msgpack file per record in `{path}/{scope}/`; `sync` only writes the changed records
+    and replaces the index of the records last, so an interrupted sync keeps the previous index
+    """
+    path = ""
+    INDEX_FILENAME = "index.json"
+
+    def __init__(self, path):
+        try:
+            import msgpack
+        except ImportError:
+            raise ImportError("The msgpack state store needs the `msgpack` package: pip install msgpack")
+        self.__msgpack = msgpack
+        self.path = path
+        self.__lock = threading.Lock()
+        index_path = os.path.join(path, self.INDEX_FILENAME)
+        ### {(scope, name): digest} in the order of the records, stored as [[scope, name, digest]]
+        self.__index = {}
+        if os.path.exists(index_path):
+            with open(index_path, "r") as file:
+                for scope, name, digest in json.load(file):
+                    self.__index[(scope, name)] = digest
+
+    def __get_record_path(self, scope, name):
+        return os.path.join(self.path, quote(scope or "_pool", safe=""), quote(name, safe="") + ".msgpack")
+
+    def scopes(self):
+        with self.__lock:
+            return list(dict.fromkeys([scope for scope, _ in self.__index]))
+
+    def names(self, scope):
+        with self.__lock:
+            return [name for cur_scope, name in self.__index if cur_scope == scope]
+
+    def get(self, scope, name, default=None):
+        with self.__lock:
+            if (scope, name) not in self.__index:
+                return default
+            with open(self.__get_record_path(scope, name), "rb") as file:
+                return self.__msgpack.unpackb(file.read(), strict_map_key=False)
+
+    def digest(self, scope, name):
+        with self.__lock:
+            return self.__index.get((scope, name))
+
+    def sync(self, records, keep=()):
+        """
+        Make the store hold exactly `records` ({(scope, name): value}) and the current records in `keep`
+        Returns the number of records written
+        """
+        keep = set(keep)
+        written = 0
+        with self.__lock:
+            new_index = {}
+            for key in self.__index:
+                if key in keep and key not in records:
+                    new_index[key] = self.__index[key]
+            for (scope, name), value in records.items():
+                data = self.__msgpack.packb(value)
+                ### the digest of the JSON record, like the other stores, so it does not depend on the store
+                digest = value_digest(value)
+                new_index[(scope, name)] = digest
+                if self.__index.get((scope, name)) == digest:
+                    continue
+                record_path = self.__get_record_path(scope, name)
+                os.makedirs(os.path.dirname(record_path), exist_ok=True)
+                with open(record_path + ".tmp", "wb") as file:
+                    file.write(data)
+                os.replace(record_path + ".tmp", record_path)
+                written += 1
+
+            index_path = os.path.join(self.path, self.INDEX_FILENAME)
+            os.makedirs(self.path, exist_ok=True)
+            with open(index_path + ".tmp", "w") as file:
+                json.dump([[scope, name, digest] for (scope, name), digest in new_index.items()], file)
+            os.replace(index_path + ".tmp", index_path)
+
+            for key in self.__index:
+                if key not in new_index:
+                    record_path = self.__get_record_path(*key)
+                    if os.path.exists(record_path):
+                        os.remove(record_path)
+            self.__index = new_index
+        return written
+
+    def close(self):
+        pass
+
+def get_state_store(kind, task_path):
+    """
+    The state store `kind` (see `STATE_STORES`) of the task directory `task_path`
+    """
+    if kind == "json":
+        return JsonStateStore(task_path)
+    if kind == "sqlite":
+        return SQLiteStateStore(os.path.join(task_path, "state.sqlite"))
+    if kind == "msgpack":
+        return MsgpackStateStore(os.path.join(task_path, "state"))
+    raise ValueError(f"Unknown state store `{kind}`, expected one of {STATE_STORES}")
+
+def migrate_state(source, target):
+    """
+    Copy all records of the state store `source` into `target`
+    Returns the number of records written
+    """
+    records = {}
+    for scope in source.scopes():
+        for name in source.names(scope):
+            records[(scope, name)] = source.get(scope, name)
+    return target.sync(records)
+
+def main(args):
+    """
+    python -m helpers.state_store TASK_PATH [sqlite|msgpack]
+    Imports the JSON results of a task directory (e.g. static/results/test/) into a SQLite or msgpack state store
+    """
+    from argparse import ArgumentParser
+    parser = ArgumentParser()
+    parser.add_argument("task_path", help="Task directory with the JSON results, e.g. static/results/test/")
+    parser.add_argument("store", nargs="?", default="sqlite", choices=STATE_STORES[1:], help="Target state store")
+    parsed_args = parser.parse_args(args)
+
+    source = get_state_store("json", parsed_args.task_path)
+    target = get_state_store(parsed_args.store, parsed_args.task_path)
+    written = migrate_state(source, target)
+    target.close()
+    print(f"Imported {written} records from {parsed_args.task_path} into the {parsed_args.store} state store")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,99 @@
+import json
+import time
+import asyncio
+import typing
+
+from pydantic import BaseModel
+
+def stub_instance(response_format):
+    """
+    Build the smallest valid instance of a pydantic `response_format`
+    """
+    values = {}
+    for name, field in response_format.model_fields.items():
+        values[name] = __stub_value(field.annotation)
+    return response_format(**values)
+
+def __stub_value(annotation):
+    origin = typing.get_origin(annotation)
+    if origin is typing.Literal:
+        return typing.get_args(annotation)[0]
+    if origin is list:
+        return []
+    if isinstance(annotation, type) and issubclass(annotation, BaseModel):
+        return stub_instance(annotation)
+    if annotation is int:
+        return 0
+    if annotation is float:
+        return 0.0
+    if annotation is bool:
+        return False
+    return ""
+
+class StubMessage:
+    refusal = None
+    parsed = None
+    content = ""
+
+    def __init__(self, parsed):
+        self.refusal = None
+        self.parsed = parsed
+        self.content = parsed.model_dump_json()
+
+class StubChoice:
+    message = None
+
+    def __init__(self, message):
+        self.message = message
+
+class StubCompletion:
+    choices = []
+
+    def __init__(self, parsed):
+        self.choices = [StubChoice(StubMessage(parsed))]
+
+class StubNamespace:
+    pass
+
+class StubOpenAI:
+    """
+    Local stand-in for `OpenAI` that answers `beta.chat.completions.parse` without network.
+    `respond(messages, response_format)` may return a dict for the response, otherwise a stub instance is used.
+    """
+    respond = None
+    latency = 0
+    calls = 0
+
+    def __init__(self, respond=None, latency=0):
+        self.respond = respond
+        self.latency = latency
+        self.calls = 0
+        self.beta = StubNamespace()
+        self.beta.chat = StubNamespace()
+        self.beta.chat.completions = StubNamespace()
+        self.beta.chat.completions.parse = self.parse
+
+    def _build(self, messages, response_format):
+        self.calls += 1
+        parsed = None
+        if self.respond is not None:
+            response = self.respond(messages, response_format)
+            if response is not None:
+                parsed = response_format(**response)
+        if parsed is None:
+            parsed = stub_instance(response_format)
+        return StubCompletion(parsed)
+
+    def parse(self, model, messages, response_format, **kwargs):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return self._build(json.loads(json.dumps(messages)), response_format)
+
+class StubAsyncOpenAI(StubOpenAI):
+    """
+    Async twin of `StubOpenAI`; `latency` is awaited so concurrent calls overlap
+    """
+    async def parse(self, model, messages, response_format, **kwargs):
+        if self.latency > 0:
+            await asyncio.sleep(self.latency)
+        return self._build(json.loads(json.dumps(messages)), response_format)
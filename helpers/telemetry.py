@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import threading
+
+from uuid import uuid4
+
+from helpers.call_context import get_call_context
+
+### one JSON record per LLM call, appended across runs (`run_id` tells the runs apart)
+METRICS_PATH = "static/cache/metrics.jsonl"
+### labels of the call context that are copied into every call record
+RECORD_LABELS = ["task", "stage", "prompt", "video_id", "other_video_id", "subgoal"]
+### latency buckets of the Prometheus histogram (seconds)
+LATENCY_BUCKETS = [0.1, 0.5, 1, 2, 5, 10, 30, 60, 120]
+
+def count_images(messages):
+    count = 0
+    for message in messages:
+        if not isinstance(message.get("content"), list):
+            continue
+        for content in message["content"]:
+            if content.get("type") == "image_url":
+                count += 1
+    return count
+
+def get_usage(completion):
+    """
+    Returns (prompt_tokens, completion_tokens, cached_tokens) of a completion, 0 if it has no usage
+    """
+    usage = getattr(completion, "usage", None)
+    if usage is None:
+        return 0, 0, 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", 0) if details is not None else 0
+    return usage.prompt_tokens or 0, usage.completion_tokens or 0, cached_tokens or 0
+
+class Telemetry:
+    """
+    Records every LLM call with the labels of its call context, appends the records to a JSONL file (if `path` is set)
+    and keeps per-label totals for `summary` and `prometheus_text`
+    """
+    path = None
+
+    def __init__(self, path=None):
+        self.path = path
+        self.run_id = str(uuid4())
+        self.__lock = threading.Lock()
+        self.__file = None
+        ### {(task, stage, prompt): totals}
+        self.__totals = {}
+
+    def configure(self, path=None):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+            self.path = path
+
+    def record(self, latency, messages=None, completion=None, response_cached=False, retries=0, queue_time=0, error=None):
+        context = get_call_context()
+        prompt_tokens, completion_tokens, cached_tokens = get_usage(completion)
+        record = {
+            "ts": time.time(),
+            "run_id": self.run_id,
+            **{label: context.get(label) for label in RECORD_LABELS},
+            "latency": latency,
+            "queue_time": queue_time,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "cached_tokens": cached_tokens,
+            "images": count_images(messages) if messages is not None else 0,
+            "retries": retries,
+            "response_cached": response_cached,
+            "error": error,
+        }
+        with self.__lock:
+            key = (record["task"] or "", record["stage"] or "", record["prompt"] or "")
+            if key not in self.__totals:
+                self.__totals[key] = {
+                    "calls": 0, "response_cached": 0, "errors": 0, "latency": 0, "retries": 0, "images": 0,
+                    "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+                    "buckets": [0 for _ in LATENCY_BUCKETS],
+                }
+            totals = self.__totals[key]
+            totals["calls"] += 1
+            totals["response_cached"] += int(response_cached)
+            totals["errors"] += int(error is not None)
+            for name in ["latency", "retries", "images", "prompt_tokens", "completion_tokens", "cached_tokens"]:
+                totals[name] += record[name]
+            for index, bucket in enumerate(LATENCY_BUCKETS):
+                if latency <= bucket:
+                    totals["buckets"][index] += 1
+            if self.path is not None:
+                if self.__file is None:
+                    os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                    self.__file = open(self.path, "a")
+                self.__file.write(json.dumps(record) + "\n")
+                self.__file.flush()
+        return record
+
+    def totals(self, task=None):
+        """
+        Returns {stage: totals} summed over the prompts, only of `task` if given
+        """
+        per_stage = {}
+        with self.__lock:
+            for (cur_task, stage, _), totals in self.__totals.items():
+                if task is not None and cur_task != task:
+                    continue
+                if stage not in per_stage:
+                    per_stage[stage] = {name: 0 for name in totals if name != "buckets"}
+                for name in per_stage[stage]:
+                    per_stage[stage][name] += totals[name]
+        return per_stage
+
+    def summary(self, task=None):
+        lines = [
+            f"{'stage':24s} {'calls':>6s} {'cached':>6s} {'errors':>6s} {'retries':>7s} {'latency':>9s} {'mean':>7s} "
+            f"{'prompt':>9s} {'complet.':>9s} {'cached t':>9s} {'images':>6s}"
+        ]
+        per_stage = self.totals(task)
+        for stage in sorted(per_stage):
+            totals = per_stage[stage]
+            sent = totals["calls"] - totals["response_cached"]
+            lines.append(
+                f"{stage or '-':24s} {totals['calls']:6d} {totals['response_cached']:6d} {totals['errors']:6d} {totals['retries']:7d} "
+                f"{totals['latency']:8.2f}s {totals['latency'] / max(sent, 1):6.2f}s "
+                f"{totals['prompt_tokens']:9d} {totals['completion_tokens']:9d} {totals['cached_tokens']:9d} {totals['images']:6d}"
+            )
+        return "\n".join(lines)
+
+    def prometheus_text(self):
+        """
+        The totals in the Prometheus text exposition format
+        """
+        with self.__lock:
+            totals = {key: dict(value, buckets=list(value["buckets"])) for key, value in self.__totals.items()}
+
+        def __labels(key, **extra):
+            task, stage, prompt = key
+            labels = {"task": task, "stage": stage, "prompt": prompt, **extra}
+            return "{" + ",".join([
+                name + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"' for name, value in labels.items()
+            ]) + "}"
+
+        lines = []
+        counters = [
+            ("llm_calls_total", "calls", "LLM calls, including the ones served from the response cache"),
+            ("llm_response_cache_hits_total", "response_cached", "LLM calls served from the response cache"),
+            ("llm_errors_total", "errors", "LLM calls that failed"),
+            ("llm_retries_total", "retries", "Retries of LLM requests"),
+            ("llm_images_total", "images", "Images sent to the LLM"),
+        ]
+        for metric, name, help_text in counters:
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} counter")
+            for key, value in totals.items():
+                lines.append(f"{metric}{__labels(key)} {value[name]}")
+
+        lines.append("# HELP llm_tokens_total Tokens of the LLM requests")
+        lines.append("# TYPE llm_tokens_total counter")
+        for key, value in totals.items():
+            for kind in ["prompt", "completion", "cached"]:
+                lines.append(f"llm_tokens_total{__labels(key, kind=kind)} {value[kind + '_tokens']}")
+
+        lines.append("# HELP llm_latency_seconds Wall latency of the LLM calls")
+        lines.append("# TYPE llm_latency_seconds histogram")
+        for key, value in totals.items():
+            for bucket, count in zip(LATENCY_BUCKETS, value["buckets"]):
+                lines.append(f"llm_latency_seconds_bucket{__labels(key, le=bucket)} {count}")
+            lines.append(f"llm_latency_seconds_bucket{__labels(key, le='+Inf')} {value['calls']}")
+            lines.append(f"llm_latency_seconds_sum{__labels(key)} {value['latency']}")
+            lines.append(f"llm_latency_seconds_count{__labels(key)} {value['calls']}")
+        return "\n".join(lines) + "\n"
+
+    def serve_prometheus(self, port, host="127.0.0.1"):
+        """
+        Serve `prometheus_text` at http://{host}:{port}/metrics from a daemon thread, for long-running jobs;
+        only on this machine unless `host` says otherwise
+        """
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        telemetry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = telemetry.prometheus_text().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def close(self):
+        with self.__lock:
+            if self.__file is not None:
+                self.__file.close()
+                self.__file = None
+
+### process-wide telemetry, `configure` sets the JSONL metrics file
+TELEMETRY = Telemetry()
@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+
+from helpers.call_context import get_call_context
+from helpers.telemetry import TELEMETRY, RECORD_LABELS
+
+### one subdirectory per run, `{time}-{run id}`, only the latest `TRACE_MAX_RUNS` are kept
+TRACE_PATH = "static/cache/traces"
+TRACE_MAX_RUNS = 20
+### off: nothing; summary: one stdout line and one `calls.jsonl` record per call; full: also the prompts and responses
+TRACE_LEVELS = ["off", "summary", "full"]
+TRACE_LEVEL = "summary"
+### labels of the call context shown in the stdout line
+LINE_LABELS = ["task", "stage", "video_id", "other_video_id", "subgoal"]
+
+def content_hash(value):
+    return hashlib.sha256(json.dumps(value, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def format_label(value):
+    ### quoted if it has spaces, e.g. subgoal titles
+    value = str(value)
+    return json.dumps(value, ensure_ascii=False) if " " in value else value
+
+def strip_images(messages, resolve_image=None):
+    """
+    Copy of `messages` with the image data URLs replaced by their frame path (`resolve_image(url)`) or their hash
+    """
+    result = []
+    for message in messages:
+        if not isinstance(message.get("content"), list):
+            result.append(message)
+            continue
+        content = []
+        for part in message["content"]:
+            if part.get("type") != "image_url":
+                content.append(part)
+                continue
+            url = part["image_url"]["url"]
+            frame_path = resolve_image(url) if resolve_image is not None else None
+            if frame_path is not None:
+                image = {"path": frame_path}
+            else:
+                image = {"sha256": hashlib.sha256(url.encode("utf-8")).hexdigest(), "size": len(url)}
+            content.append({"type": "image_url", "image_url": image})
+        result.append({**message, "content": content})
+    return result
+
+class Tracer:
+    """
+    Traces the structured LLM calls: one line per call on stdout and, per run, a `calls.jsonl` index in a rotating
+    trace directory; at the `full` level the prompts (images stripped) and responses are written once each,
+    as `prompts/{key}.json` (the response cache key) and `responses/{hash}.json`
+    """
+    path = TRACE_PATH
+    level = TRACE_LEVEL
+    max_runs = TRACE_MAX_RUNS
+
+    def __init__(self, path=TRACE_PATH, level=TRACE_LEVEL, max_runs=TRACE_MAX_RUNS, run_id=None):
+        self.path = path
+        self.level = level
+        self.max_runs = max_runs
+        self.run_id = run_id if run_id is not None else TELEMETRY.run_id
+        self.__lock = threading.Lock()
+        self.__run_path = None
+        self.__index = None
+        self.__written = set()
+
+    def configure(self, level=None, path=None, max_runs=None):
+        if level is not None and level not in TRACE_LEVELS:
+            raise ValueError(f"Unknown trace level `{level}`, expected one of {TRACE_LEVELS}")
+        with self.__lock:
+            self.__close()
+            if level is not None:
+                self.level = level
+            if path is not None:
+                self.path = path
+            if max_runs is not None:
+                self.max_runs = max_runs
+
+    def get_run_path(self):
+        """
+        The trace directory of this run, created (and the oldest runs removed) on the first call
+        """
+        if self.__run_path is None:
+            self.__run_path = os.path.join(self.path, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.run_id[:8]}")
+            os.makedirs(self.__run_path, exist_ok=True)
+            self.__rotate()
+        return self.__run_path
+
+    def __rotate(self):
+        runs = sorted([name for name in os.listdir(self.path) if os.path.isdir(os.path.join(self.path, name))])
+        for name in runs[:max(0, len(runs) - self.max_runs)]:
+            if os.path.join(self.path, name) != self.__run_path:
+                shutil.rmtree(os.path.join(self.path, name), ignore_errors=True)
+
+    def __write_once(self, kind, key, value):
+        if (kind, key) in self.__written:
+            return
+        self.__written.add((kind, key))
+        entry_path = os.path.join(self.get_run_path(), kind, f"{key}.json")
+        if os.path.exists(entry_path):
+            return
+        os.makedirs(os.path.dirname(entry_path), exist_ok=True)
+        with open(entry_path, "w") as f:
+            json.dump(value, f, indent=2, ensure_ascii=False)
+
+    def trace(self, key, messages, response_format, response=None, latency=0, response_cached=False, retries=0, error=None, resolve_image=None):
+        """
+        `key` is the response cache key of the request, it addresses the prompt
+        """
+        if self.level == "off":
+            return None
+        context = get_call_context()
+        response_key = content_hash(response) if response is not None else None
+        record = {
+            "ts": time.time(),
+            "run_id": self.run_id,
+            **{label: context.get(label) for label in RECORD_LABELS},
+            "response_format": getattr(response_format, "__name__", str(response_format)),
+            "prompt_key": key,
+            "response_key": response_key,
+            "latency": latency,
+            "response_cached": response_cached,
+            "retries": retries,
+            "error": error,
+        }
+        with self.__lock:
+            if self.level == "full":
+                self.__write_once("prompts", key, {
+                    "response_format": record["response_format"],
+                    "messages": strip_images(messages, resolve_image),
+                })
+                if response is not None:
+                    self.__write_once("responses", response_key, response)
+            if self.__index is None:
+                self.__index = open(os.path.join(self.get_run_path(), "calls.jsonl"), "a")
+            self.__index.write(json.dumps(record) + "\n")
+            self.__index.flush()
+
+        line = ["LLM", context.get("prompt") or record["response_format"]]
+        line += [f"{label}={format_label(context[label])}" for label in LINE_LABELS if context.get(label) is not None]
+        line.append("cached" if response_cached else f"{latency:.2f}s")
+        if retries > 0:
+            line.append(f"retries={retries}")
+        if error is not None:
+            line.append(f"error={error}")
+        line.append(f"prompt={key[:12]}")
+        if response_key is not None:
+            line.append(f"response={response_key[:12]}")
+        print(" ".join(line))
+        return record
+
+    def __close(self):
+        if self.__index is not None:
+            self.__index.close()
+            self.__index = None
+        self.__run_path = None
+        self.__written = set()
+
+    def close(self):
+        with self.__lock:
+            self.__close()
+
+TRACER = Tracer()
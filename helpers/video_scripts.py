@@ -2,17 +2,18 @@ import os
 
 import json
 
-import cv2
-
 import re
 
-from yt_dlp import YoutubeDL
+from concurrent.futures import ProcessPoolExecutor
 
 from helpers import transcribe_audio, segment_into_sentences
+from helpers.frame_store import FrameStoreWriter, get_frame_store, pack_frames
 
 DATABASE = "static/database"
 
 def download_video(video_link):
+    from yt_dlp import YoutubeDL
+
     # Download video 480p or, if short, whatever is available
     options = {
         'format': 'bv[height<=?480][ext=mp4]+ba[ext=mp3]/best',
@@ -45,36 +46,75 @@ def download_video(video_link):
 
 def extract_frames(video_path):
     frame_paths = []
+    store = get_frame_store(video_path)
+    if store is not None:
+        print(f"Frames for video '{video_path}' already exist.")
+        return store.frame_paths()
+
+    if os.path.exists(f"{video_path}_frames"):
+        print(f"Packing existing frames for video '{video_path}'.")
+        return pack_frames(video_path).frame_paths()
+
     if not os.path.exists(video_path):
         print(f"Video file '{video_path}' does not exist.")
         return frame_paths
 
-    if not os.path.exists(f"{video_path}_frames"):
-        os.makedirs(f"{video_path}_frames")
-    else:
-        print(f"Frames for video '{video_path}' already exist.")
-        for file in os.listdir(f"{video_path}_frames"):
-            frame_paths.append(f"{video_path}_frames/{file}")
-        frame_paths = sorted(frame_paths, key=lambda x: int(x.split("/")[-1].split(".")[0]))
-        return frame_paths
+    import cv2
     video_cap = cv2.VideoCapture(video_path)
+    fps = video_cap.get(cv2.CAP_PROP_FPS)
+    writer = FrameStoreWriter(video_path)
 
-    ### save frame at each second
+    ### save frame at each second: decode the file once, `grab` every frame and only
+    ### `retrieve` the first frame at or after the middle of each second
     seconds = 0
+    frame_idx = 0
     while True:
-        video_cap.set(cv2.CAP_PROP_POS_MSEC, seconds * 1000 + 500)
-        res, frame = video_cap.read()
+        if video_cap.grab() == False:
+            break
+        if fps > 0:
+            timestamp = frame_idx / fps
+        else:
+            timestamp = video_cap.get(cv2.CAP_PROP_POS_MSEC) / 1000
+        frame_idx += 1
+        if timestamp < seconds + 0.5:
+            continue
+        res, frame = video_cap.retrieve()
         if (res == False):
             break
-        frame_path = f"{video_path}_frames/{seconds}.jpg"
-        cv2.imwrite(frame_path, frame)
-        frame_paths.append(frame_path)
-        seconds += 1
+        res, jpeg = cv2.imencode(".jpg", frame)
+        while timestamp >= seconds + 0.5:
+            frame_paths.append(writer.append(jpeg.tobytes()))
+            seconds += 1
 
     video_cap.release()
+    writer.close()
     return frame_paths
 
+def extract_frames_parallel(video_paths, workers=None):
+    """
+    Extract frames of several videos in a process pool, returns {video_path: frame_paths}
+    """
+    if len(video_paths) == 0:
+        return {}
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(extract_frames, video_path) for video_path in video_paths]
+        for video_path, future in zip(video_paths, futures):
+            try:
+                results[video_path] = future.result()
+            except Exception as e:
+                print(f"Error extracting frames: {video_path}")
+                print(e)
+                results[video_path] = []
+    return results
+
 def extract_transcript_from_audio_openai(audio_path):
+    return transcript_from_response(get_transcription(audio_path))
+
+def get_transcription(audio_path, transcribe_f=transcribe_audio):
+    """
+    Returns the (cached) segment-level transcription of the audio, `transcribe_f(audio_path, granularity)` is only called on a cache miss
+    """
     granularity = ["segment"]
     output_path = audio_path.replace(".mp3", f".{'_'.join(granularity)}.json")
     response = None
@@ -82,10 +122,15 @@ def extract_transcript_from_audio_openai(audio_path):
         with open(output_path, 'r') as f:
             response = json.load(f)
     else:
-        response = transcribe_audio(audio_path, granularity)
+        response = transcribe_f(audio_path, granularity)
         with open(output_path, 'w') as f:
             json.dump(response, f, indent=2)
-    
+    return response
+
+def transcript_from_response(response):
+    """
+    Split a segment-level transcription into sentences with interpolated start and finish times
+    """
     if response is None:
         return []
     
@@ -129,10 +174,14 @@ def extract_transcript_from_audio_openai(audio_path):
         
     return transcript
 
-def process_video(video_link):
+def get_video_paths(video_link):
     video_title = re.split(r"[/=]", video_link)[-1]
     video_path = os.path.join(DATABASE, f'{video_title}.mp4')
     audio_path = os.path.join(DATABASE, f'{video_title}.mp3')
+    return video_title, video_path, audio_path
+
+def process_video(video_link):
+    video_title, video_path, audio_path = get_video_paths(video_link)
 
     metadata = download_video(video_link)
 
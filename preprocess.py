@@ -1,50 +1,81 @@
 import sys
 import os
 import json
+import time
 
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
 
 from helpers import APPROACHES, BASELINES
-
-from src import PATH
-
-from src.Video import Video
+from helpers import LOCAL_CACHE_PATH, configure_response_cache, configure_image_cache, set_max_concurrent_requests, get_request_counts
+from helpers.call_context import call_context, get_call_context, submit_with_context
+from helpers.telemetry import TELEMETRY, METRICS_PATH
+from helpers.tracing import TRACER, TRACE_LEVELS, TRACE_LEVEL, TRACE_PATH
+from helpers.batch import BatchRunner, OpenAIBatchBackend, LocalBatchBackend, LOCAL_BATCH_PATH
+from helpers.ingestion import ingest_videos, local_fetch_video, local_transcribe_audio
+from helpers.bert import get_embedding_cache_stats
+from helpers.stage_graph import GraphStage, StageGraph, fingerprint
+from helpers.state_store import POOL_SCOPE, STATE_STORES, get_state_store, value_digest
+
+from src import PATH, LOCAL_PATH
+
+from src.Video import Video, LAZY_FIELDS
 from src.VideoPool import VideoPool
 
-def save_data(task_id, ds):
-    videos = ds.videos
-    subgoals = ds.subgoals
-    alignment_sets = ds.alignment_sets
-    hooks = ds.hooks
-
-    ### save all the video objects
-    save_dict = []
-
-    for video in videos:
-        save_dict.append(video.to_dict())
-    
-    if os.path.exists(f"{PATH}{task_id}") is False:
-        os.mkdir(f"{PATH}{task_id}")
-
-    with open(f"{PATH}{task_id}/video_data.json", "w") as file:
-        json.dump(save_dict, file, indent=2)
-
-    ### save all the subgoal objects
-    with open(f"{PATH}{task_id}/subgoal_data.json", "w") as file:
-        json.dump(subgoals, file, indent=2)
-
-    ### save all the information alignments
-    with open(f"{PATH}{task_id}/alignment_sets.json", "w") as file:
-        json.dump(alignment_sets, file, indent=2)
-
-    ### save all the hooks
-    with open(f"{PATH}{task_id}/hooks.json", "w") as file:
-        json.dump(hooks, file, indent=2)
-
-
-def export(task_id, ds):    
-    save_data(task_id, ds)
-
+def get_state_records(ds):
+    """
+    Returns ({(scope, name): value} of the state of the pool, keys of the lazy video fields that were never loaded)
+    """
+    records = {
+        (POOL_SCOPE, "videos"): [video.video_id for video in ds.videos],
+    }
+    keep = []
+    for video in ds.videos:
+        for name, value in video.to_dict(skip_unloaded=True).items():
+            records[(video.video_id, name)] = value
+        for field in LAZY_FIELDS:
+            if not video.is_field_loaded(field):
+                keep.append((video.video_id, field))
+    records[(POOL_SCOPE, "subgoals")] = ds.subgoals
+    for approach, alignment_sets in ds.alignment_sets.items():
+        records[(POOL_SCOPE, f"alignment_sets/{approach}")] = alignment_sets
+    for key, hooks in ds.hooks.items():
+        records[(POOL_SCOPE, f"hooks/{key}")] = hooks
+    records[(POOL_SCOPE, "aggregated_steps")] = ds.aggregated_steps
+    records[(POOL_SCOPE, "fingerprints")] = ds.fingerprints
+    return records, keep
+
+def save_data(task_id, ds, path=PATH, store=None):
+    if store is None:
+        store = get_state_store("json", f"{path}{task_id}")
+
+    for video in ds.videos:
+        ### frames loaded from an older `video_data.json` may not have their hashes yet
+        if video.is_field_loaded("frames"):
+            video.calculate_frame_hashes()
+        video.save_sentence_embeddings(f"{path}{task_id}/embeddings")
+
+    ### only the records that changed are written (all files for the JSON store)
+    records, keep = get_state_records(ds)
+    store.sync(records, keep)
+
+
+def get_output_fingerprint(ds):
+    """
+    Fingerprint of the inputs of `output.json`, from the digests of the videos so their lazy fields are not loaded
+    """
+    hooks = {key: value for key, value in ds.hooks.items() if key.startswith("hooks_") or key.startswith("notables_")}
+    return fingerprint(ds.task, [video.get_digest() for video in ds.videos], ds.subgoals, sorted(ds.alignment_sets), hooks)
+
+def export(task_id, ds, path=PATH):
+    ### `output.json` is only rewritten when its inputs changed; the state is saved by `setup_ds`, also when a stage failed
+    filename = f"{path}{task_id}/output.json"
+    cur_fingerprint = get_output_fingerprint(ds)
+    if not os.path.exists(filename) or ds.fingerprints.get("export", {}).get("output") != cur_fingerprint:
+        write_output(filename, ds)
+        ds.fingerprints["export"] = {"output": cur_fingerprint}
+
+def write_output(filename, ds):
     videos = [video.to_dict(short_metadata=True, fixed_subgoals=True) for video in ds.videos]
 
     output = {
@@ -70,16 +101,30 @@ def export(task_id, ds):
             if f"notables_{baseline}" in ds.hooks:
                 output["hooks"][baseline] += ds.hooks[f"notables_{baseline}"]
 
-    filename = f"{PATH}{task_id}/output.json"
     with open(filename, "w") as file:
         json.dump(output, file, indent=2)
         
-def pre_process_videos(video_links):
+def pre_process_videos(video_links, workers=1, local_ingest=False, transcribe_f=None):
+    """
+    `transcribe_f(audio_path, granularity)` replaces the transcription (default: `local_transcribe_audio` with `local_ingest`,
+    otherwise the cached Whisper transcription)
+    """
+    ### fetch, frames, transcription and sentences overlap across videos
+    if local_ingest:
+        processed, pipeline = ingest_videos(video_links, workers, fetch_f=local_fetch_video, transcribe_f=transcribe_f or local_transcribe_audio)
+    else:
+        processed, pipeline = ingest_videos(video_links, workers, transcribe_f=transcribe_f)
+    print("Ingestion:")
+    print(pipeline.summary())
+
     videos = []
     for video_link in video_links:
+        if video_link not in processed:
+            continue
         video = Video(video_link)
         try:
-            video.process()
+            video.set_processed_video(*processed[video_link])
+            video.process_subtitles()
             videos.append(video)
         except Exception as e:
             print(f"Error processing video: {video_link}")
@@ -87,7 +132,37 @@ def pre_process_videos(video_links):
             continue
     return videos
 
-def setup_ds(task_id):
+### the stage after which the alignments of each approach can be generated
+ALIGNMENT_INPUT_STAGES = {
+    APPROACHES[0]: "summaries",
+    BASELINES[0]: "segmentation",
+}
+
+def get_stage_graph(task_id, ds, path=PATH):
+    """
+    steps -> step_aggregation -> subgoals -> segmentation -> summaries -> alignments -> notables -> hooks -> export,
+    the approaches are independent of each other
+    """
+    stages = [
+        GraphStage("steps", ds.generate_steps),
+        GraphStage("step_aggregation", ds.aggregate_steps, ["steps"]),
+        GraphStage("subgoals", ds.define_subgoals, ["step_aggregation"]),
+        GraphStage("segmentation", ds.segment_videos, ["subgoals"]),
+        GraphStage("summaries", ds.summarize_subgoals, ["segmentation"]),
+    ]
+    hook_stages = []
+    for approach in APPROACHES + BASELINES:
+        stages.append(GraphStage(f"alignments_{approach}",
+            lambda approach=approach: ds.generate_alignments([approach]), [ALIGNMENT_INPUT_STAGES[approach]]))
+        stages.append(GraphStage(f"notables_{approach}",
+            lambda approach=approach: ds.find_notables([approach]), [f"alignments_{approach}"]))
+        stages.append(GraphStage(f"hooks_{approach}",
+            lambda approach=approach: ds.generate_hooks([approach]), [f"notables_{approach}"]))
+        hook_stages.append(f"hooks_{approach}")
+    stages.append(GraphStage("export", lambda: export(task_id, ds, path), hook_stages))
+    return StageGraph(stages)
+
+def setup_ds(task_id, workers=1, batch_runner=None, local_ingest=False, path=PATH, store_kind="json", transcribe_f=None):
     metadata_path = "./metadata.json"
     task_desc = None
     video_pool = None
@@ -101,70 +176,203 @@ def setup_ds(task_id):
         raise Exception("No video pool found for task")
 
     # get the video data
+    store = get_state_store(store_kind, f"{path}{task_id}")
+    if store_kind != "json" and len(store.scopes()) == 0 and os.path.exists(f"{path}{task_id}/video_data.json"):
+        print(f"WARNING: the {store_kind} state store is empty, import the JSON results with `python -m helpers.state_store {path}{task_id} {store_kind}`")
     videos = []
-    subgoals = []
-    video_data_path = f"{PATH}{task_id}/video_data.json"
-    subgoal_data_path = f"{PATH}{task_id}/subgoal_data.json"
-    alignment_sets = f"{PATH}{task_id}/alignment_sets.json"
-    hooks_path = f"{PATH}{task_id}/hooks.json"
-
-    if os.path.exists(video_data_path):
-        with open(video_data_path, "r") as file:
-            video_data = json.load(file)
-            videos = []
-            for data in video_data:
-                if data["video_link"] not in video_pool:
-                    continue
-                video = Video(data["video_link"])
-                video.from_dict(**data)
-                videos.append(video)
-    if len(videos) == 0 or len(videos[0].subtitles) == 0:
-        videos = pre_process_videos(video_pool)
-
-    if os.path.exists(subgoal_data_path):
-        with open(subgoal_data_path, "r") as file:
-            subgoals = json.load(file)
-        ds = VideoPool(task_desc, videos, subgoals)
-    else:
-        ds = VideoPool(task_desc, videos)
-
-    if os.path.exists(alignment_sets):
-        with open(alignment_sets, "r") as file:
-            alignment_sets = json.load(file)
-            ds.alignment_sets = alignment_sets
-    else:
-        ds.alignment_sets = {}
-
-    if os.path.exists(hooks_path):
-        with open(hooks_path, "r") as file:
-            hooks = json.load(file)
-            ds.hooks = hooks
-    else:
-        ds.hooks = {}
-
-    ds.process_videos()
-    
-    ds.generate_alignments()
-
-    ds.find_notables()
-
-    ds.generate_hooks()
-
-    export(task_id, ds)
+    for video_id in store.get(POOL_SCOPE, "videos", []):
+        names = store.names(video_id)
+        data = {name: store.get(video_id, name) for name in names if name not in LAZY_FIELDS}
+        if data["video_link"] not in video_pool:
+            continue
+        video = Video(data["video_link"])
+        video.from_dict(**data)
+        ### frames, subtitles and sentences are read when they are first needed
+        video.set_field_loader(
+            lambda field, video_id=video_id: store.get(video_id, field),
+            [field for field in LAZY_FIELDS if field in names],
+            {field: store.digest(video_id, field) for field in LAZY_FIELDS if field in names}
+        )
+        video.load_sentence_embeddings(f"{path}{task_id}/embeddings")
+        videos.append(video)
+    ### by the digest, so the subtitles are not loaded for the check
+    if len(videos) == 0 or videos[0].get_field_digest("subtitles") == value_digest([]):
+        videos = pre_process_videos(video_pool, workers, local_ingest, transcribe_f)
+
+    ds = VideoPool(task_desc, videos, store.get(POOL_SCOPE, "subgoals", []), workers=workers, batch_runner=batch_runner)
+
+    ds.alignment_sets = {}
+    ds.hooks = {}
+    for name in store.names(POOL_SCOPE):
+        if name.startswith("alignment_sets/"):
+            ds.alignment_sets[name[len("alignment_sets/"):]] = store.get(POOL_SCOPE, name)
+        elif name.startswith("hooks/"):
+            ds.hooks[name[len("hooks/"):]] = store.get(POOL_SCOPE, name)
+    ds.aggregated_steps = store.get(POOL_SCOPE, "aggregated_steps", [])
+    ds.fingerprints = store.get(POOL_SCOPE, "fingerprints", {})
+
+    ### every stage only recomputes the outputs whose inputs or prompt changed
+    graph = get_stage_graph(task_id, ds, path)
+    try:
+        graph.run()
+    finally:
+        ### the outputs of the stages that finished are kept even if another stage failed
+        try:
+            save_data(task_id, ds, path, store)
+        finally:
+            store.close()
+    print("Stages:")
+    print(graph.summary())
+    print("LLM calls:")
+    print(TELEMETRY.summary(get_call_context().get("task")))
     return ds
 
+def run_tasks(task_ids, workers=1, batch_runner=None, local_ingest=False, path=PATH, store_kind="json"):
+    """
+    Run `setup_ds` for all tasks at once in this process; they share the models, the response cache and the request budget
+    Returns {task_id: {"videos", "requests", "cached", "wall", "error"}}
+    """
+    reports = {}
+
+    def __run_task(task_id):
+        with call_context(task=task_id):
+            start = time.perf_counter()
+            videos = 0
+            error = None
+            try:
+                ds = setup_ds(task_id, workers=workers, batch_runner=batch_runner, local_ingest=local_ingest, path=path, store_kind=store_kind)
+                videos = len(ds.videos)
+            except Exception as e:
+                print(f"Error processing task: {task_id}")
+                print(e)
+                error = str(e)
+            counts = get_request_counts(task_id)
+            reports[task_id] = {
+                "videos": videos,
+                "requests": counts["requests"],
+                "cached": counts["cached"],
+                "wall": time.perf_counter() - start,
+                "error": error,
+            }
+
+    with ThreadPoolExecutor(max_workers=max(1, len(task_ids))) as executor:
+        futures = [submit_with_context(executor, __run_task, task_id) for task_id in task_ids]
+        for future in futures:
+            future.result()
+    return reports
+
+def throughput_summary(reports, wall_time):
+    """
+    Per-task and aggregate table of LLM requests (sent and served from the cache) per second
+    """
+    lines = [f"{'task':16s} {'videos':>6s} {'requests':>8s} {'cached':>7s} {'wall':>9s} {'req/s':>7s}  status"]
+    for task_id, report in reports.items():
+        lines.append(
+            f"{task_id:16s} {report['videos']:6d} {report['requests']:8d} {report['cached']:7d} "
+            f"{report['wall']:8.2f}s {report['requests'] / max(report['wall'], 1e-9):7.2f}  "
+            + ("ok" if report["error"] is None else "failed")
+        )
+    videos = sum([report["videos"] for report in reports.values()])
+    requests = sum([report["requests"] for report in reports.values()])
+    cached = sum([report["cached"] for report in reports.values()])
+    lines.append(
+        f"{'all':16s} {videos:6d} {requests:8d} {cached:7d} "
+        f"{wall_time:8.2f}s {requests / max(wall_time, 1e-9):7.2f}"
+    )
+    return "\n".join(lines)
+
 def parse_args(args):
     """
     python preprocess.py [-t TASKID]
     """
     parser = ArgumentParser()
     parser.add_argument("-t", "--task", dest="task_id", help="Task ID")
-    return parser.parse_args(args)
+    parser.add_argument("--tasks", dest="task_ids", default=None, help="Comma-separated task IDs to run at once, e.g. carbonara,muffins")
+    parser.add_argument("--all", dest="all_tasks", action="store_true", help="Run all tasks of metadata.json at once")
+    parser.add_argument("-w", "--workers", dest="workers", type=int, default=1, help="Number of concurrent LLM calls")
+    parser.add_argument("--batch", dest="batch", nargs="?", const="openai", choices=["openai", "local"], default=None, help="Submit whole stages through the Batch API (`local` uses a file-based stand-in)")
+    parser.add_argument("--local-ingest", dest="local_ingest", action="store_true", help="Use local stand-ins for downloading and transcribing videos (videos must be in static/database)")
+    parser.add_argument("--image-max-edge", dest="image_max_edge", type=int, default=None, help="Downscale frames sent to the LLM to this longer edge in pixels (0 keeps the original size)")
+    parser.add_argument("--image-quality", dest="image_quality", type=int, default=None, help="JPEG quality of downscaled frames sent to the LLM")
+    parser.add_argument("--image-cache-max-size", dest="image_cache_max_size", type=float, default=None, help="Evict the least recently used downscaled frames above this size (MB, default: 512)")
+    parser.add_argument("--store", dest="store", choices=STATE_STORES, default="json", help="Where the results are kept (sqlite/msgpack only write changed records, see `python -m helpers.state_store`)")
+    parser.add_argument("--no-cache", dest="no_cache", action="store_true", help="Do not read or write the LLM response cache")
+    parser.add_argument("--offline", dest="offline", action="store_true", help="Replay cached LLM responses only, fail on a cache miss")
+    parser.add_argument("--cache-max-size", dest="cache_max_size", type=float, default=None, help="Evict the oldest cached responses above this size (MB)")
+    parser.add_argument("--cache-max-age", dest="cache_max_age", type=float, default=None, help="Evict cached responses older than this (days)")
+    parser.add_argument("--metrics-file", dest="metrics_file", default=METRICS_PATH, help="Append one JSON record per LLM call to this file (empty to disable)")
+    parser.add_argument("--metrics-port", dest="metrics_port", type=int, default=None, help="Serve the LLM call metrics for Prometheus at http://localhost:PORT/metrics")
+    parser.add_argument("--metrics-host", dest="metrics_host", default="127.0.0.1", help="Address to serve the metrics on, e.g. 0.0.0.0 for a Prometheus on another machine")
+    parser.add_argument("--trace", dest="trace_level", choices=TRACE_LEVELS, default=TRACE_LEVEL, help="Trace the LLM calls: one line per call (summary), also the prompts and responses (full) or nothing (off)")
+    parser.add_argument("--trace-dir", dest="trace_dir", default=TRACE_PATH, help="Directory of the traces, one subdirectory per run")
+    parsed_args = parser.parse_args(args)
+    ### without the cache there is nothing to replay, every call would go to the API
+    if parsed_args.no_cache and parsed_args.offline:
+        parser.error("--offline replays the response cache, it cannot be combined with --no-cache")
+    return parsed_args
 
 def main(args=["-t", "test"]):
     parsed_args = parse_args(args)
-    task_id = parsed_args.task_id
-    ds = setup_ds(task_id)
+    if parsed_args.all_tasks:
+        with open("./metadata.json", "r") as file:
+            task_ids = list(json.load(file).keys())
+    elif parsed_args.task_ids is not None:
+        task_ids = [task_id.strip() for task_id in parsed_args.task_ids.split(",") if task_id.strip() != ""]
+    else:
+        task_ids = [parsed_args.task_id]
+
+    ### runs with local stand-ins keep their results and responses apart from the real ones
+    local_run = parsed_args.local_ingest or parsed_args.batch == "local"
+    path = LOCAL_PATH if local_run else PATH
+
+    max_size = None
+    if parsed_args.cache_max_size is not None:
+        max_size = int(parsed_args.cache_max_size * 1024 * 1024)
+    max_age = None
+    if parsed_args.cache_max_age is not None:
+        max_age = parsed_args.cache_max_age * 24 * 60 * 60
+    response_cache = configure_response_cache(
+        enabled=not parsed_args.no_cache,
+        offline=parsed_args.offline,
+        max_size=max_size,
+        max_age=max_age,
+        path=LOCAL_CACHE_PATH if local_run else None,
+    )
+
+    image_max_disk_size = None
+    if parsed_args.image_cache_max_size is not None:
+        image_max_disk_size = int(parsed_args.image_cache_max_size * 1024 * 1024)
+    image_cache = configure_image_cache(parsed_args.image_max_edge, parsed_args.image_quality, image_max_disk_size)
+
+    batch_runner = None
+    if parsed_args.batch == "openai":
+        batch_runner = BatchRunner(OpenAIBatchBackend())
+    elif parsed_args.batch == "local":
+        batch_runner = BatchRunner(LocalBatchBackend(), path=LOCAL_BATCH_PATH)
+
+    TELEMETRY.configure(parsed_args.metrics_file or None)
+    if parsed_args.metrics_port is not None:
+        TELEMETRY.serve_prometheus(parsed_args.metrics_port, parsed_args.metrics_host)
+    TRACER.configure(parsed_args.trace_level, parsed_args.trace_dir)
+
+    ### the budget is shared by all tasks
+    set_max_concurrent_requests(parsed_args.workers)
+    if len(task_ids) == 1:
+        with call_context(task=task_ids[0]):
+            setup_ds(task_ids[0], workers=parsed_args.workers, batch_runner=batch_runner, local_ingest=parsed_args.local_ingest, path=path, store_kind=parsed_args.store)
+    else:
+        start = time.perf_counter()
+        reports = run_tasks(task_ids, workers=parsed_args.workers, batch_runner=batch_runner, local_ingest=parsed_args.local_ingest, path=path, store_kind=parsed_args.store)
+        print("Throughput:")
+        print(throughput_summary(reports, time.perf_counter() - start))
+
+    response_cache.evict()
+    print("Response cache:", response_cache.stats())
+    image_cache.evict()
+    print("Image cache:", image_cache.stats())
+    print("Embedding cache:", get_embedding_cache_stats())
+    TELEMETRY.close()
+    TRACER.close()
 
 if __name__ == "__main__":
     args = sys.argv[1:]
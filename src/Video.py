@@ -1,21 +1,35 @@
+import os
+import glob
+import hashlib
+import threading
+
 import numpy as np
 
+from src import SENTENCE_EMBEDDINGS_DTYPE
+
 from helpers.video_scripts import process_video
 
-from helpers.bert import bert_embedding, find_most_similar
+from helpers.bert import BERT_MODEL_NAME, bert_embedding
+from helpers.similarity import top_k_similar
+from helpers.frame_store import read_frame
+from helpers.frame_dedup import get_frame_hash, register_frame_hashes
+from helpers.state_store import value_digest
+
+### heavy fields a state store can load on their first access, see `Video.set_field_loader`
+LAZY_FIELDS = ["frames", "subtitles", "sentences"]
 
 class Video:
     video_link = ""
     metadata = {}
     video_id = None
-    ### list of frames in base64 sec: {"path": "", caption: ""}
-    frames = {}
+    ### list of frames in base64 sec: {"path": "", caption: "", "hash": ""}
+    _frames = {}
     ### {"start": 0, "finish": 0, "text": ""}
-    subtitles = []
+    _subtitles = []
     ### list of strings
     steps = []
     ### {"start": 0, "finish": 0, "title": "", "text": ""}
-    sentences = []
+    _sentences = []
     ### {"start": 0, "finish": 0, "title": "", "text": ""}
     subgoals = []
 
@@ -26,6 +40,10 @@ class Video:
 
 
     def __init__(self, video_link):
+        self.__field_loader = None
+        self.__unloaded_fields = set()
+        self.__field_digests = {}
+        self.__field_lock = threading.Lock()
         self.video_link = video_link
         self.video_id = video_link.split("/")[-1]
         self.subtitles = []
@@ -38,12 +56,91 @@ class Video:
         self.metadata = {}
         self.sentence_embeddings = []
 
+    def set_field_loader(self, loader, fields=LAZY_FIELDS, digests=None):
+        """
+        Load `fields` with `loader(field)` on their first access instead of now;
+        `digests` ({field: digest}) are their digests in the store, used until they are loaded
+        """
+        self.__field_loader = loader
+        self.__unloaded_fields = set(fields)
+        self.__field_digests = dict(digests or {})
+
+    def is_field_loaded(self, field):
+        return field not in self.__unloaded_fields
+
+    def get_field_digest(self, field):
+        """
+        Digest of `field` (see `helpers.state_store.value_digest`), from the store if it was not loaded yet
+        """
+        if not self.is_field_loaded(field) and self.__field_digests.get(field) is not None:
+            return self.__field_digests[field]
+        return value_digest(getattr(self, field))
+
+    def get_contents_digest(self):
+        """
+        Digest of the inputs of `get_all_contents`
+        """
+        return self.get_field_digest("sentences")
+
+    def get_digest(self):
+        """
+        Digest of `to_dict`, the lazy fields that were not loaded are not loaded for it
+        """
+        return value_digest({
+            **self.to_dict(skip_unloaded=True),
+            **{field: self.get_field_digest(field) for field in LAZY_FIELDS},
+        })
+
+    def __get_field(self, field):
+        if field in self.__unloaded_fields:
+            ### stages on different threads may access the same video
+            with self.__field_lock:
+                if field in self.__unloaded_fields:
+                    value = self.__field_loader(field)
+                    if field == "frames":
+                        register_frame_hashes({
+                            frame["path"]: frame["hash"] for frame in value.values() if "hash" in frame
+                        })
+                    setattr(self, "_" + field, value)
+                    self.__unloaded_fields.discard(field)
+        return getattr(self, "_" + field)
+
+    def __set_field(self, field, value):
+        self.__unloaded_fields.discard(field)
+        setattr(self, "_" + field, value)
+
+    @property
+    def frames(self):
+        return self.__get_field("frames")
+
+    @frames.setter
+    def frames(self, value):
+        self.__set_field("frames", value)
+
+    @property
+    def subtitles(self):
+        return self.__get_field("subtitles")
+
+    @subtitles.setter
+    def subtitles(self, value):
+        self.__set_field("subtitles", value)
+
+    @property
+    def sentences(self):
+        return self.__get_field("sentences")
+
+    @sentences.setter
+    def sentences(self, value):
+        self.__set_field("sentences", value)
+
     def process(self):
         self.process_video()
         self.process_subtitles()
 
     def process_video(self):
-        video_title, video_frame_paths, subtitles, metadata = process_video(self.video_link)
+        self.set_processed_video(*process_video(self.video_link))
+
+    def set_processed_video(self, video_title, video_frame_paths, subtitles, metadata):
         self.metadata = metadata
         self.video_id = video_title
         self.frames = {}
@@ -53,6 +150,7 @@ class Video:
                 "path": frame_path,
                 "caption": "",
             }
+        self.calculate_frame_hashes()
         
         self.subtitles = []    
         for subtitle in subtitles:
@@ -81,6 +179,33 @@ class Video:
                 sentence["frame_paths"].append(self.frames[frame_sec]["path"])
             sentence["id"] = f"{self.video_id}-{index}"
     
+    def calculate_frame_hashes(self):
+        """
+        Fill in the missing perceptual hashes of the frames, reusing the hashes computed lazily during deduplication
+        """
+        frame_hashes = {}
+        missing = 0
+        for frame in self.frames.values():
+            if "hash" not in frame:
+                try:
+                    frame["hash"] = get_frame_hash(frame["path"])
+                except (OSError, IndexError):
+                    missing += 1
+                    continue
+            frame_hashes[frame["path"]] = frame["hash"]
+        register_frame_hashes(frame_hashes)
+        if missing > 0:
+            print(f"WARNING: {missing} frames of {self.video_id} could not be read for hashing")
+
+    def get_frame(self, sec):
+        """
+        Returns the JPEG bytes of the frame at `sec`
+        """
+        frame = self.frames.get(sec, self.frames.get(str(sec)))
+        if frame is None:
+            return None
+        return read_frame(frame["path"])
+
     def get_subgoals(self, title):
         subgoals = []
         for subgoal in self.subgoals:
@@ -165,8 +290,8 @@ class Video:
         content_ids = []
         quotes_embeddings = bert_embedding(quotes)
 
-        indexes, scores = find_most_similar(self.sentence_embeddings, quotes_embeddings)
-        for idx in indexes:
+        indexes, scores = top_k_similar(self.sentence_embeddings, quotes_embeddings)
+        for idx in indexes[:, 0]:
             content_ids.append(self.sentences[idx]["id"])
 
         return content_ids
@@ -176,41 +301,66 @@ class Video:
         Return the time in seconds of the best match of the alignment
         Search only within the subgoal titles and return the finish time of the best match
         """
+        seconds, _ = self.get_alignments_seconds([alignment])
+        return seconds[0]
+
+    def get_subgoal_masks(self, titles):
+        """
+        Returns {title: boolean mask over `self.sentences`} of the sentences of the subgoals with each title
+        """
+        content_rows = {sentence["id"]: index for index, sentence in enumerate(self.sentences)}
+        masks = {}
+        for title in titles:
+            mask = np.zeros(len(self.sentences), dtype=bool)
+            for subgoal in self.get_subgoals(title):
+                rows = [content_rows[content_id] for content_id in subgoal["content_ids"] if content_id in content_rows]
+                mask[rows] = True
+            masks[title] = mask
+        return masks
+
+    def get_alignments_seconds(self, alignments):
+        """
+        Batch version of `get_alignment_seconds`: one encode of all descriptions and one matrix product
+        Returns (seconds, scores), score is None if the alignment could not be grounded
+        """
+        if len(alignments) == 0:
+            return [], []
         if len(self.subgoals) == 0:
-            return 0
+            return [0 for _ in alignments], [None for _ in alignments]
+
+        seconds = [self.subgoals[-1]["finish"] for _ in alignments]
+        scores = [None for _ in alignments]
+
+        queries = []
+        for index, alignment in enumerate(alignments):
+            cur_subgoals = self.get_subgoals(alignment["subgoal_title"])
+            if len(cur_subgoals) == 0:
+                print("WARNING: no such subgoal:", alignment['subgoal_title'])
+                continue
+            seconds[index] = cur_subgoals[-1]["start"]
+            queries.append(index)
+        if len(queries) == 0:
+            return seconds, scores
 
         if len(self.sentence_embeddings) == 0:
             self.calculate_sentence_embeddings()
-        query_embeddings = bert_embedding([alignment["alignment_description"]])
-        cur_subgoals = self.get_subgoals(alignment["subgoal_title"])
+        query_embeddings = bert_embedding([alignments[index]["alignment_description"] for index in queries])
+        subgoal_masks = self.get_subgoal_masks(set([alignments[index]["subgoal_title"] for index in queries]))
+        mask = np.array([subgoal_masks[alignments[index]["subgoal_title"]] for index in queries])
 
-        seconds = self.subgoals[-1]["finish"]
-        if len(cur_subgoals) == 0:
-            print("WARNING: no such subgoal:", alignment['subgoal_title'])
-            return seconds
-        
-        all_content_ids = []
-        for subgoal in cur_subgoals:
-            all_content_ids += subgoal["content_ids"]
-        seconds = cur_subgoals[-1]["start"]
+        indexes, top_scores = top_k_similar(self.sentence_embeddings, query_embeddings, mask=mask)
+        for query_index, index in enumerate(queries):
+            sentence_index = indexes[query_index][0]
+            if sentence_index < 0:
+                print("WARNING: no sentences in subgoal:", alignments[index]['subgoal_title'])
+                continue
+            score = float(top_scores[query_index][0])
+            if score < 0.8:
+                print(f"WARNING: Low alignment score {self.sentences[sentence_index]['id']}:", alignments[index]["alignment_description"], self.sentences[sentence_index]["text"])
+            seconds[index] = self.sentences[sentence_index]["start"]
+            scores[index] = score
+        return seconds, scores
 
-        cur_sentence_embeddings = []
-        cur_sentence_indexes = []
-        for index, sentence in enumerate(self.sentences):
-            if sentence["id"] in all_content_ids:
-                cur_sentence_embeddings.append(self.sentence_embeddings[index])
-                cur_sentence_indexes.append(index)
-        
-        cur_sentence_embeddings = np.array(cur_sentence_embeddings)
-        indexes, scores = find_most_similar(cur_sentence_embeddings, query_embeddings)
-        index = cur_sentence_indexes[indexes[0]]
-        score = scores[0]
-        if score < 0.8:
-            print(f"WARNING: Low alignment score {self.sentences[index]['id']}:", alignment["alignment_description"], self.sentences[index]["text"])
-        seconds = self.sentences[index]["start"]
-        return seconds
-
-                        
     def calculate_sentence_embeddings(self):
         """
         Calculate the embeddings of the custom subgoals
@@ -218,6 +368,34 @@ class Video:
         texts = [sentence["text"] for sentence in self.sentences]
         self.sentence_embeddings = bert_embedding(texts)
 
+    def get_sentence_embeddings_path(self, directory):
+        """
+        The sidecar file is keyed by the embedding model and the sentences, so it is invalidated when either changes
+        """
+        key = hashlib.sha256(f"{BERT_MODEL_NAME}\n{self.get_field_digest('sentences')}".encode("utf-8")).hexdigest()[:16]
+        return os.path.join(directory, f"{self.video_id}.sentences.{key}.npy")
+
+    def save_sentence_embeddings(self, directory):
+        if len(self.sentence_embeddings) == 0:
+            return
+        path = self.get_sentence_embeddings_path(directory)
+        if os.path.exists(path):
+            return
+        os.makedirs(directory, exist_ok=True)
+        for stale_path in glob.glob(os.path.join(directory, f"{glob.escape(self.video_id)}.sentences.*.npy")):
+            os.remove(stale_path)
+        np.save(path, np.asarray(self.sentence_embeddings, dtype=SENTENCE_EMBEDDINGS_DTYPE))
+
+    def load_sentence_embeddings(self, directory):
+        """
+        Memory-map the persisted sentence embeddings if they match the current sentences
+        """
+        path = self.get_sentence_embeddings_path(directory)
+        if not os.path.exists(path):
+            return False
+        self.sentence_embeddings = np.load(path, mmap_mode="r")
+        return True
+
     def get_most_similar_content_ids(self, texts):
         """
         Returns the content ids of the most similar texts
@@ -228,26 +406,32 @@ class Video:
             self.calculate_sentence_embeddings()
         text_embeddings = bert_embedding(texts)
 
-        indexes, scores = find_most_similar(self.sentence_embeddings, text_embeddings)
+        indexes, scores = top_k_similar(self.sentence_embeddings, text_embeddings)
 
         content_ids = []
-        for idx in indexes:
+        for idx in indexes[:, 0]:
                 content_ids.append(self.sentences[idx]["id"])
         return content_ids
 
-    def to_dict(self, short_metadata=False, fixed_subgoals=False):
+    def to_dict(self, short_metadata=False, fixed_subgoals=False, skip_unloaded=False):
+        """
+        With `skip_unloaded` the lazy fields that were never loaded are left out
+        """
         result = {
             "video_id": self.video_id,
             "video_link": self.video_link,
-            "frames": self.frames,
-            "subtitles": self.subtitles,
-            "sentences": self.sentences,
+        }
+        for field in LAZY_FIELDS:
+            if skip_unloaded and not self.is_field_loaded(field):
+                continue
+            result[field] = getattr(self, field)
+        result.update({
             "steps": self.steps,
             "subgoals": self.subgoals,
             "meta_summary": self.meta_summary,
             "subgoal_summaries": self.subgoal_summaries,
             "metadata": self.metadata
-        }
+        })
         if short_metadata:
             result["metadata"] = {
                 "title": self.metadata["title"],
@@ -258,6 +442,9 @@ class Video:
             }
         
         if fixed_subgoals:
+            ### copies, the titles of the video itself are kept
+            result["subgoals"] = [dict(subgoal) for subgoal in result["subgoals"]]
+            result["subgoal_summaries"] = [dict(subgoal_summary) for subgoal_summary in result["subgoal_summaries"]]
             for index, subgoal in enumerate(result["subgoals"]):
                 subgoal["original_title"] = subgoal["title"]
                 subgoal["title"] = subgoal["original_title"] + "-" + str(index)
@@ -282,6 +469,9 @@ class Video:
             self.subtitles = subtitles
         if frames is not None:
             self.frames = frames
+            register_frame_hashes({
+                frame["path"]: frame["hash"] for frame in self.frames.values() if "hash" in frame
+            })
         if sentences is not None:
             self.sentences = sentences
         if steps is not None:
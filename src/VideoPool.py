@@ -1,21 +1,62 @@
 import json
+import asyncio
+import hashlib
+
+from concurrent.futures import ThreadPoolExecutor
 
 from src import META_TITLE, SIMILARITY_THRESHOLD_NOTABLE, SIMILARITY_THRESHOLD_HOOK
 
 from helpers import APPROACHES, BASELINES
 from helpers import random_uid
 
-from helpers.prompts_segmentation import define_steps_v4, extract_subgoals_v4, align_steps_v4, segment_video_v4
+from helpers.prompts_segmentation import define_steps_v4_async, extract_subgoals_v4_async, align_steps_v4_async, segment_video_v4_async
+from helpers.prompts_segmentation import define_steps_v4_request, define_steps_v4_response
+from helpers.prompts_segmentation import segment_video_v4_request, segment_video_v4_response
 
-from helpers.prompts_summarization import get_step_summary_v4
+from helpers.prompts_summarization import get_step_summary_v4_async
+from helpers.prompts_summarization import get_step_summary_v4_request, get_step_summary_v4_response
 
 from helpers.prompts_comparison import get_transcript_alignments_v3
 from helpers.prompts_comparison import get_subgoal_alignments_v4, get_steps_alignments_v4
+from helpers.prompts_comparison import get_subgoal_alignments_v4_request, get_subgoal_alignments_v4_response
+from helpers.prompts_comparison import get_steps_alignments_v4_request, get_steps_alignments_v4_response
+
+from helpers.prompts_organization import get_notable_v4_async, get_hooks_v4_async, get_hook_v4_async
 
-from helpers.prompts_organization import get_notable_v4, get_hooks_v4, get_hook_v4
+from helpers.prompts_segmentation import align_steps_v4_request, align_steps_v4_response
+from helpers.prompts_segmentation import extract_subgoals_v4_request, extract_subgoals_v4_response
+from helpers.prompts_comparison import get_transcript_alignments_v3_request, get_transcript_alignments_v3_response
+from helpers.prompts_organization import get_notable_v4_request, get_notable_v4_response
+from helpers.prompts_organization import get_hook_v4_request, get_hook_v4_response
 
 from helpers.clip import clip_similar_per_text
 from helpers.bert import clustering_custom
+from helpers.stage_graph import fingerprint, prompt_version
+from helpers.call_context import submit_with_context, call_with_labels, call_with_labels_async
+
+from pydantic_models.segmentation import StepsSchema, AggStepsSchema, AggSubgoalsSchema, get_segmentation_schema_v4
+from pydantic_models.summarization import StepSummarySchema
+from pydantic_models.comparison import AlignmentsSchema4
+from pydantic_models.organization import SummarizedAlignmentSchema2, GroupSchema
+
+def get_prompt_versions():
+    """
+    Prompt version of each stage, a changed prompt invalidates the outputs of its stage
+    """
+    return {
+        "steps": prompt_version(define_steps_v4_request, define_steps_v4_response, StepsSchema),
+        "step_aggregation": prompt_version(align_steps_v4_request, align_steps_v4_response, AggStepsSchema),
+        "subgoals": prompt_version(extract_subgoals_v4_request, extract_subgoals_v4_response, AggSubgoalsSchema),
+        "segmentation": prompt_version(segment_video_v4_request, segment_video_v4_response, get_segmentation_schema_v4),
+        "summaries": prompt_version(get_step_summary_v4_request, get_step_summary_v4_response, StepSummarySchema),
+        APPROACHES[0]: prompt_version(
+            get_subgoal_alignments_v4_request, get_subgoal_alignments_v4_response,
+            get_steps_alignments_v4_request, get_steps_alignments_v4_response, AlignmentsSchema4
+        ),
+        BASELINES[0]: prompt_version(get_transcript_alignments_v3_request, get_transcript_alignments_v3_response, AlignmentsSchema4),
+        "notables": prompt_version(get_notable_v4_request, get_notable_v4_response, SummarizedAlignmentSchema2),
+        "hooks": prompt_version(get_hook_v4_request, get_hook_v4_response, GroupSchema),
+    }
 
 class VideoPool:
     task = ""
@@ -23,11 +64,23 @@ class VideoPool:
     subgoals = []
     alignment_sets = {}
     hooks = {}
+    ### number of worker threads for the alignment stage
+    workers = 1
+    ### `helpers.batch.BatchRunner` to submit whole stages through the Batch API
+    batch_runner = None
+    ### steps aggregated over the videos, the input of the subgoals
+    aggregated_steps = []
+    ### {stage: {key: fingerprint of the inputs of the output}}
+    fingerprints = {}
 
-    def __init__(self, task, videos, subgoals=[]):
+    def __init__(self, task, videos, subgoals=[], workers=1, batch_runner=None):
         self.task = task
         self.videos = videos
         self.subgoals = subgoals
+        self.workers = workers
+        self.batch_runner = batch_runner
+        self.aggregated_steps = []
+        self.fingerprints = {}
 
     def get_video(self, video_id):
         for video in self.videos:
@@ -35,145 +88,311 @@ class VideoPool:
                 return video
         return None
 
+    def __batch(self, stage, request_f, response_f, calls):
+        """
+        Submit `request_f(*args)` for all `calls` as one batch and post-process with `response_f`
+        Returns (results, indexes of the calls that failed or were refused in the batch)
+        """
+        requests = [request_f(*args) for args in calls]
+        responses = self.batch_runner.run(stage, requests)
+        results = []
+        failed = []
+        for index, (response, args) in enumerate(zip(responses, calls)):
+            if response is None:
+                results.append(None)
+                failed.append(index)
+            else:
+                results.append(response_f(response, *args))
+        if len(failed) > 0:
+            print(f"WARNING: {len(failed)} requests of stage `{stage}` failed in the batch, retrying them directly")
+        return results, failed
+
+    def __batch_with_fallback(self, stage, f, request_f, response_f, calls, labels=None):
+        """
+        `__batch` where the failed calls are retried with the regular `f(*args)` on `self.workers` threads
+        """
+        results, failed = self.__batch(stage, request_f, response_f, calls)
+        retried = self.__map(f, [calls[index] for index in failed], [labels[index] for index in failed] if labels else None)
+        for index, result in zip(failed, retried):
+            results[index] = result
+        return results
+
+    async def __prompt_all(self, stage, async_f, request_f, response_f, calls, labels=None):
+        """
+        Run the prompt for all `calls`, concurrently or as one batch in batch mode
+        `labels` are the call context labels of each call (e.g. its video id), see `helpers.telemetry`
+        """
+        if len(calls) == 0:
+            return []
+        if labels is None:
+            labels = [{} for _ in calls]
+        if self.batch_runner is not None:
+            results, failed = self.__batch(stage, request_f, response_f, calls)
+            retried = await asyncio.gather(*[call_with_labels_async(labels[index], async_f, *calls[index]) for index in failed])
+            for index, result in zip(failed, retried):
+                results[index] = result
+            return results
+        return await asyncio.gather(*[call_with_labels_async(cur_labels, async_f, *args) for args, cur_labels in zip(calls, labels)])
+
+    def __get_fingerprint(self, stage, key):
+        return self.fingerprints.get(stage, {}).get(key)
+
+    def __set_fingerprint(self, stage, key, cur_fingerprint):
+        self.fingerprints.setdefault(stage, {})[key] = cur_fingerprint
+
+    def __is_fresh(self, stage, key, cur_fingerprint, has_output):
+        """
+        Whether the output of `stage` for `key` was generated from the inputs with `cur_fingerprint`;
+        outputs from before the fingerprints were recorded are kept
+        """
+        records = self.fingerprints.setdefault(stage, {})
+        if key not in records and has_output:
+            records[key] = cur_fingerprint
+        return has_output and records.get(key) == cur_fingerprint
+
+    def __get_contents_fingerprint(self, video):
+        ### from the stored digest of the sentences, so they are not loaded for fresh outputs
+        return fingerprint(video.video_id, video.get_contents_digest())
+
     def process_videos(self):
-        self.__process_videos_v4()
+        self.generate_steps()
+        self.aggregate_steps()
+        self.define_subgoals()
+        self.segment_videos()
+        self.summarize_subgoals()
 
-    def __process_videos_v4(self):
+    def generate_steps(self):
+        asyncio.run(self.__generate_steps())
+
+    async def __generate_steps(self):
         ### Extract steps per video
+        version = get_prompt_versions()["steps"]
+        pending_videos = []
         for video in self.videos:
-            if len(video.steps) == 0:
-                video.steps = define_steps_v4(video.get_all_contents(), self.task)
+            cur_fingerprint = fingerprint(version, self.task, self.__get_contents_fingerprint(video))
+            if self.__is_fresh("steps", video.video_id, cur_fingerprint, len(video.steps) > 0):
+                continue
+            video.steps = []
+            pending_videos.append((video, cur_fingerprint))
+        all_steps = await self.__prompt_all("steps",
+            define_steps_v4_async, define_steps_v4_request, define_steps_v4_response,
+            [(video.get_all_contents(), self.task) for video, _ in pending_videos],
+            [{"video_id": video.video_id} for video, _ in pending_videos]
+        )
+        for (video, cur_fingerprint), steps in zip(pending_videos, all_steps):
+            video.steps = steps
+            self.__set_fingerprint("steps", video.video_id, cur_fingerprint)
+
+    def aggregate_steps(self):
+        asyncio.run(self.__aggregate_steps())
 
+    async def __aggregate_steps(self):
         ### Cluster steps ands define subgoals
-        if len(self.subgoals) == 0:
-            sequences = []
-            for video in self.videos:
-                sequences.append(video.steps)
-                
-            ## ASSUMPTION: as we go over all videos, the steps will get calibrated
-            agg_steps = []
-            for step in sequences[0]:
-                agg_steps.append({
-                    "step": step,
-                    "original_steps": [step],
-                })
-            for new_sequence in sequences[1:]:
-                old_sequence = []
-                for step in agg_steps:
-                    old_sequence.append(step["step"])
-                
-                agg_sequence = align_steps_v4(old_sequence, new_sequence, self.task)
+        if len(self.videos) == 0:
+            return
+        version = get_prompt_versions()["step_aggregation"]
+        ### the subgoals are defined once, a later video is segmented into them and does not invalidate the aggregation
+        record = self.fingerprints.get("step_aggregation", {})
+        video_ids = record.get("video_ids", [video.video_id for video in self.videos])
+        cur_fingerprint = fingerprint(version, self.task, [self.__get_fingerprint("steps", video_id) for video_id in video_ids])
+        has_output = len(self.aggregated_steps) > 0 or len(self.subgoals) > 0
+        if "fingerprint" not in record and has_output:
+            record = {"fingerprint": cur_fingerprint, "video_ids": video_ids}
+            self.fingerprints["step_aggregation"] = record
+        if has_output and record.get("fingerprint") == cur_fingerprint:
+            return
+
+        sequences = []
+        for video in self.videos:
+            sequences.append(video.steps)
+            
+        ## ASSUMPTION: as we go over all videos, the steps will get calibrated
+        agg_steps = []
+        for step in sequences[0]:
+            agg_steps.append({
+                "step": step,
+                "original_steps": [step],
+            })
+        for new_sequence in sequences[1:]:
+            old_sequence = []
+            for step in agg_steps:
+                old_sequence.append(step["step"])
+            
+            agg_sequence = await align_steps_v4_async(old_sequence, new_sequence, self.task)
+            
+            new_agg_steps = []
+            for new_agg_step in agg_sequence:
+                original_steps = new_agg_step["original_list_2"]
                 
-                new_agg_steps = []
-                for new_agg_step in agg_sequence:
-                    original_steps = new_agg_step["original_list_2"]
-                    
-                    for old_step in new_agg_step["original_list_1"]:
-                        for agg_step in agg_steps:
-                            if agg_step["step"] == old_step:
-                                original_steps += agg_step["original_steps"]
-                                break
-                    new_agg_steps.append({
-                        "step": new_agg_step["aggregated"],
-                        "original_steps": original_steps,
-                    })
-                agg_steps = new_agg_steps
-            ### TODO: Turn the sequence of aggregated steps into subgoals
-            subgoals = extract_subgoals_v4([s["step"] for s in agg_steps], self.task)
-            self.subgoals = []
-            for subgoal in subgoals:
-                original_steps = []
-                for step in subgoal["original_steps"]:
+                for old_step in new_agg_step["original_list_1"]:
                     for agg_step in agg_steps:
-                        if agg_step["step"] == step:
-                            original_steps.extend(agg_step["original_steps"])
+                        if agg_step["step"] == old_step:
+                            original_steps += agg_step["original_steps"]
                             break
-
-                self.subgoals.append({
-                    "title": subgoal["title"],
-                    "description": subgoal["description"],
+                new_agg_steps.append({
+                    "step": new_agg_step["aggregated"],
                     "original_steps": original_steps,
                 })
-        
+            agg_steps = new_agg_steps
+        self.aggregated_steps = agg_steps
+
+        video_ids = [video.video_id for video in self.videos]
+        self.fingerprints["step_aggregation"] = {
+            "fingerprint": fingerprint(version, self.task, [self.__get_fingerprint("steps", video_id) for video_id in video_ids]),
+            "video_ids": video_ids,
+        }
+
+    def define_subgoals(self):
+        asyncio.run(self.__define_subgoals())
+
+    async def __define_subgoals(self):
+        version = get_prompt_versions()["subgoals"]
+        cur_fingerprint = fingerprint(version, self.task, self.fingerprints.get("step_aggregation", {}).get("fingerprint"))
+        if self.__is_fresh("subgoals", self.task, cur_fingerprint, len(self.subgoals) > 0):
+            return
+        if len(self.aggregated_steps) == 0:
+            return
+        agg_steps = self.aggregated_steps
+        ### TODO: Turn the sequence of aggregated steps into subgoals
+        subgoals = await extract_subgoals_v4_async([s["step"] for s in agg_steps], self.task)
+        self.subgoals = []
+        for subgoal in subgoals:
+            original_steps = []
+            for step in subgoal["original_steps"]:
+                for agg_step in agg_steps:
+                    if agg_step["step"] == step:
+                        original_steps.extend(agg_step["original_steps"])
+                        break
+
+            self.subgoals.append({
+                "title": subgoal["title"],
+                "description": subgoal["description"],
+                "original_steps": original_steps,
+            })
+        self.__set_fingerprint("subgoals", self.task, cur_fingerprint)
+
+    def segment_videos(self):
+        asyncio.run(self.__segment_videos())
+
+    async def __segment_videos(self):
         ### Segment each video based on the appropriate subgoals --> does not work too well...
+        version = get_prompt_versions()["segmentation"]
+        subgoals_fingerprint = self.__get_fingerprint("subgoals", self.task)
+        pending_videos = []
         for video in self.videos:
+            cur_fingerprint = fingerprint(version, self.task, self.__get_fingerprint("steps", video.video_id), subgoals_fingerprint)
+            if self.__is_fresh("segmentation", video.video_id, cur_fingerprint, len(video.subgoals) > 0):
+                continue
+            video.subgoals = []
+            pending_videos.append((video, cur_fingerprint))
+        all_segments = await self.__prompt_all("segmentation",
+            segment_video_v4_async, segment_video_v4_request, segment_video_v4_response,
+            [(video.get_all_contents(), video.steps, self.task) for video, _ in pending_videos],
+            [{"video_id": video.video_id} for video, _ in pending_videos]
+        )
+        for (video, cur_fingerprint), segments in zip(pending_videos, all_segments):
             ## initial subgoals
-            if len(video.subgoals) == 0:
-                segments = segment_video_v4(video.get_all_contents(), video.steps, self.task)
-                for index, subgoal in enumerate(segments):
-                    video.subgoals.append({
-                        "id": f"{video.video_id}-subgoal-{index}",
-                        "title": subgoal["title"],
-                        "start": subgoal["start"],
-                        "finish": subgoal["finish"],
-                        "text": subgoal["text"],
-                        "frame_paths": subgoal["frame_paths"],
-                        "content_ids": subgoal["content_ids"],
+            for index, subgoal in enumerate(segments):
+                video.subgoals.append({
+                    "id": f"{video.video_id}-subgoal-{index}",
+                    "title": subgoal["title"],
+                    "start": subgoal["start"],
+                    "finish": subgoal["finish"],
+                    "text": subgoal["text"],
+                    "frame_paths": subgoal["frame_paths"],
+                    "content_ids": subgoal["content_ids"],
+                })
+            ## re-segment based on the new subgoals TODO: move under if
+            subgoal_assignment = [""] * len(video.subgoals)
+            for index, step in enumerate(video.subgoals):
+                for subgoal in self.subgoals:
+                    if step["title"] in subgoal["original_steps"]:
+                        if subgoal_assignment[index] != "":
+                            print(f"Warning: {video.video_id} - {step['title']} is assigned to {subgoal_assignment[index]} and {subgoal['title']}")
+                        subgoal_assignment[index] = subgoal["title"]
+            new_video_subgoals = []
+            for index, step in enumerate(video.subgoals):
+                if len(new_video_subgoals) > 0 and (new_video_subgoals[-1]["title"] == subgoal_assignment[index] or subgoal_assignment[index] == ""):
+                    new_video_subgoals[-1]["finish"] = step["finish"]
+                    new_video_subgoals[-1]["text"] += " " + step["text"]
+                    new_video_subgoals[-1]["frame_paths"] += step["frame_paths"]
+                    new_video_subgoals[-1]["content_ids"] += step["content_ids"]
+                    new_video_subgoals[-1]["original_steps"].append(step["title"])
+                else:
+                    new_video_subgoals.append({
+                        "id": step["id"],
+                        "title": subgoal_assignment[index],
+                        "start": step["start"],
+                        "finish": step["finish"],
+                        "text": step["text"],
+                        "frame_paths": step["frame_paths"],
+                        "content_ids": step["content_ids"],
+                        "original_steps": [step["title"]],
                     })
-                ## re-segment based on the new subgoals TODO: move under if
-                subgoal_assignment = [""] * len(video.subgoals)
-                for index, step in enumerate(video.subgoals):
-                    for subgoal in self.subgoals:
-                        if step["title"] in subgoal["original_steps"]:
-                            if subgoal_assignment[index] != "":
-                                print(f"Warning: {video.video_id} - {step['title']} is assigned to {subgoal_assignment[index]} and {subgoal['title']}")
-                            subgoal_assignment[index] = subgoal["title"]
-                new_video_subgoals = []
-                for index, step in enumerate(video.subgoals):
-                    if len(new_video_subgoals) > 0 and (new_video_subgoals[-1]["title"] == subgoal_assignment[index] or subgoal_assignment[index] == ""):
-                        new_video_subgoals[-1]["finish"] = step["finish"]
-                        new_video_subgoals[-1]["text"] += " " + step["text"]
-                        new_video_subgoals[-1]["frame_paths"] += step["frame_paths"]
-                        new_video_subgoals[-1]["content_ids"] += step["content_ids"]
-                        new_video_subgoals[-1]["original_steps"].append(step["title"])
-                    else:
-                        new_video_subgoals.append({
-                            "id": step["id"],
-                            "title": subgoal_assignment[index],
-                            "start": step["start"],
-                            "finish": step["finish"],
-                            "text": step["text"],
-                            "frame_paths": step["frame_paths"],
-                            "content_ids": step["content_ids"],
-                            "original_steps": [step["title"]],
-                        })
-                video.subgoals = new_video_subgoals
-
-            ### extract useful information for each step
-            if len(video.subgoal_summaries) == 0:
-                video.subgoal_summaries = []
-                for subgoal in video.subgoals:
-                    if subgoal["title"] == "":
-                        continue
-                    summary = get_step_summary_v4(video.get_all_contents(),
-                        subgoal["original_steps"], self.task)
-                    for key in summary:
-                        if not key.endswith("_content_ids"):
-                            continue
-                        new_content_ids = []
-                        for id in summary[key]:
-                            new_content_ids.append(f"{video.video_id}-{id}")
-                        summary[key] = new_content_ids
-                    summary = {
-                        "title": subgoal["title"],
-                        **summary,
-                        "outcome_frame_paths": [],
-                        "materials_frame_paths": [],
-                        "tools_frame_paths": [],
-                    }
-                    if len(summary["outcome"]) > 0:
-                        summary["outcome_frame_paths"] = clip_similar_per_text([*summary["outcome"]], summary["frame_paths"])
-                    if len(summary["materials"]) > 0:
-                        summary["materials_frame_paths"] = clip_similar_per_text([*summary["materials"]], summary["frame_paths"])
-                    if len(summary["tools"]) > 0:
-                        summary["tools_frame_paths"] = clip_similar_per_text([*summary["tools"]], summary["frame_paths"])
-                    video.subgoal_summaries.append(summary)
+            video.subgoals = new_video_subgoals
+            self.__set_fingerprint("segmentation", video.video_id, cur_fingerprint)
+
+    def summarize_subgoals(self):
+        asyncio.run(self.__summarize_subgoals())
+
+    async def __summarize_subgoals(self):
+        ### extract useful information for each step
+        version = get_prompt_versions()["summaries"]
+        pending_videos = []
+        pending_subgoals = []
+        for video in self.videos:
+            cur_fingerprint = fingerprint(version, self.task, self.__get_fingerprint("segmentation", video.video_id))
+            if self.__is_fresh("summaries", video.video_id, cur_fingerprint, len(video.subgoal_summaries) > 0):
+                continue
+            video.subgoal_summaries = []
+            pending_videos.append((video, cur_fingerprint))
+            for subgoal in video.subgoals:
+                if subgoal["title"] == "":
+                    continue
+                ### same guard as `get_step_summary_v4`, so batch and regular runs send the same requests
+                if len(subgoal["original_steps"]) == 0:
+                    continue
+                pending_subgoals.append((video, subgoal))
+        summaries = await self.__prompt_all("summaries",
+            get_step_summary_v4_async, get_step_summary_v4_request, get_step_summary_v4_response,
+            [(video.get_all_contents(), subgoal["original_steps"], self.task) for video, subgoal in pending_subgoals],
+            [{"video_id": video.video_id, "subgoal": subgoal["title"]} for video, subgoal in pending_subgoals]
+        )
+        for (video, subgoal), summary in zip(pending_subgoals, summaries):
+            if summary is None:
+                continue
+            for key in summary:
+                if not key.endswith("_content_ids"):
+                    continue
+                new_content_ids = []
+                for id in summary[key]:
+                    new_content_ids.append(f"{video.video_id}-{id}")
+                summary[key] = new_content_ids
+            summary = {
+                "title": subgoal["title"],
+                **summary,
+                "outcome_frame_paths": [],
+                "materials_frame_paths": [],
+                "tools_frame_paths": [],
+            }
+            ### match the outcome, materials and tools against the frames of the subgoal at once
+            visual_keys = ["outcome", "materials", "tools"]
+            texts = [text for key in visual_keys for text in summary[key]]
+            if len(texts) > 0:
+                frame_paths = await asyncio.to_thread(clip_similar_per_text, texts, summary["frame_paths"])
+                for key in visual_keys:
+                    summary[f"{key}_frame_paths"] = frame_paths[:len(summary[key])]
+                    frame_paths = frame_paths[len(summary[key]):]
+            video.subgoal_summaries.append(summary)
 
+        for video in self.videos:
             cannot_be_empty = ["instructions", "explanation", "tips"]
             for subgoal_summary in video.subgoal_summaries:
                 for key in cannot_be_empty:
                     if len(subgoal_summary[key+"_content_ids"]) == 0:
                         subgoal_summary[key] = ""
+        for video, cur_fingerprint in pending_videos:
+            self.__set_fingerprint("summaries", video.video_id, cur_fingerprint)
 
     def __reformat_alignments_v2(self, alignments, video1, video2):
         for alignment in alignments:
@@ -183,13 +402,144 @@ class VideoPool:
             alignment["alignment_description"] = alignment["description"]
             alignment["alignment_reasoning"] = alignment["reasoning"]
             alignment["alignment_comparison"] = alignment["comparison"]
-            alignment["seconds"] = video1.get_alignment_seconds(alignment)
             del alignment["comparison"]
             del alignment["reasoning"]
             del alignment["title"]
             del alignment["description"]
         return alignments
 
+    def __ground_alignments(self, approach):
+        """
+        Set the `seconds` of the alignments of `approach` that have none yet, grounding all alignments of a video in one batch
+        """
+        alignments_per_video = {}
+        for alignment_set in self.alignment_sets[approach]:
+            if alignment_set["video_id"] not in alignments_per_video:
+                alignments_per_video[alignment_set["video_id"]] = []
+            alignments_per_video[alignment_set["video_id"]] += [
+                alignment for alignment in alignment_set["alignments"] if "seconds" not in alignment
+            ]
+
+        for video in self.videos:
+            alignments = alignments_per_video.get(video.video_id, [])
+            if len(alignments) == 0:
+                continue
+            seconds, _ = video.get_alignments_seconds(alignments)
+            for alignment, cur_seconds in zip(alignments, seconds):
+                alignment["seconds"] = cur_seconds
+
+    def __get_alignment_keys(self, approach, subgoal_titles, pair_fingerprints, ordered):
+        """
+        Keys (video_id, other_video_id, subgoal_title) of the alignment sets of `approach` that were already generated.
+        Sets of videos that left the pool are dropped, sets in the older per-video format are split per key
+        and all pairs of their videos count as generated for `subgoal_titles`.
+        Sets of a pair whose inputs changed since (`pair_fingerprints` {(video_id, other_video_id): fingerprint})
+        are dropped as well, in both directions unless the pair is `ordered`.
+        """
+        video_ids = set([video.video_id for video in self.videos])
+        alignment_sets = []
+        legacy_video_ids = []
+        for alignment_set in self.alignment_sets.get(approach, []):
+            if alignment_set["video_id"] not in video_ids:
+                continue
+            if "other_video_id" in alignment_set:
+                if alignment_set["other_video_id"] in video_ids:
+                    alignment_sets.append(alignment_set)
+                continue
+            legacy_video_ids.append(alignment_set["video_id"])
+            per_key = {}
+            for alignment in alignment_set["alignments"]:
+                key = (alignment["other_video_id"], alignment["subgoal_title"])
+                if key not in per_key:
+                    per_key[key] = []
+                per_key[key].append(alignment)
+            for (other_video_id, subgoal_title), alignments in per_key.items():
+                if other_video_id not in video_ids:
+                    continue
+                alignment_sets.append({
+                    "video_id": alignment_set["video_id"],
+                    "other_video_id": other_video_id,
+                    "subgoal_title": subgoal_title,
+                    "alignments": alignments,
+                })
+        self.alignment_sets[approach] = alignment_sets
+
+        keys = set()
+        for alignment_set in alignment_sets:
+            keys.add((alignment_set["video_id"], alignment_set["other_video_id"], alignment_set["subgoal_title"]))
+        for video_id1 in legacy_video_ids:
+            for video_id2 in legacy_video_ids:
+                if video_id1 == video_id2:
+                    continue
+                for subgoal_title in subgoal_titles:
+                    if (video_id1, video_id2, subgoal_title) in keys:
+                        continue
+                    ### keep an empty set, so the key stays generated after the conversion
+                    keys.add((video_id1, video_id2, subgoal_title))
+                    alignment_sets.append({
+                        "video_id": video_id1,
+                        "other_video_id": video_id2,
+                        "subgoal_title": subgoal_title,
+                        "alignments": [],
+                    })
+
+        generated_pairs = set([(key[0], key[1]) for key in keys])
+        stale_pairs = set()
+        for (video_id1, video_id2), cur_fingerprint in pair_fingerprints.items():
+            pair_key = f"{video_id1}+{video_id2}"
+            has_output = (video_id1, video_id2) in generated_pairs or (not ordered and (video_id2, video_id1) in generated_pairs)
+            if self.__is_fresh(f"alignments_{approach}", pair_key, cur_fingerprint, has_output):
+                continue
+            stale_pairs.add((video_id1, video_id2))
+            if not ordered:
+                stale_pairs.add((video_id2, video_id1))
+        if len(stale_pairs) > 0:
+            self.alignment_sets[approach] = [
+                alignment_set for alignment_set in alignment_sets
+                if (alignment_set["video_id"], alignment_set["other_video_id"]) not in stale_pairs
+            ]
+            keys = set([key for key in keys if (key[0], key[1]) not in stale_pairs])
+        return keys
+
+    def __set_pair_fingerprints(self, approach, pair_fingerprints):
+        for (video_id1, video_id2), cur_fingerprint in pair_fingerprints.items():
+            self.__set_fingerprint(f"alignments_{approach}", f"{video_id1}+{video_id2}", cur_fingerprint)
+
+    def __add_alignment_set(self, approach, video1, video2, subgoal_title, alignments):
+        self.alignment_sets[approach].append({
+            "video_id": video1.video_id,
+            "other_video_id": video2.video_id,
+            "subgoal_title": subgoal_title,
+            "alignments": alignments,
+        })
+
+    def __get_link_sets(self, approach):
+        """
+        Fingerprint of the alignment ids per video of `approach`, the input of the notables of the video
+        """
+        ids_per_video = {}
+        for alignment_set in self.alignment_sets.get(approach, []):
+            if alignment_set["video_id"] not in ids_per_video:
+                ids_per_video[alignment_set["video_id"]] = []
+            ids_per_video[alignment_set["video_id"]] += [alignment["id"] for alignment in alignment_set["alignments"]]
+        return {
+            video_id: hashlib.sha1("\n".join(sorted(ids)).encode("utf-8")).hexdigest()
+            for video_id, ids in ids_per_video.items()
+        }
+
+    def __map(self, f, calls, labels=None):
+        """
+        Run `f(*args)` for all `calls` on `self.workers` threads, results are in the order of `calls`
+        `labels` are the call context labels of each call, as in `__prompt_all`
+        """
+        if labels is None:
+            labels = [{} for _ in calls]
+        if self.workers <= 1 or len(calls) <= 1:
+            return [call_with_labels(cur_labels, f, *args) for args, cur_labels in zip(calls, labels)]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [submit_with_context(executor, call_with_labels, cur_labels, f, *args) for args, cur_labels in zip(calls, labels)]
+            return [future.result() for future in futures]
+
     ### APPROACH 1 (CLASSIFICATION + IMPORTANCE + AGGREGATION_PER_RELATION_AND_CLASS)
     def __generate_alignments_1(self):
         approach = APPROACHES[0]
@@ -197,116 +547,179 @@ class VideoPool:
             return
         if len(self.subgoals) == 0:
             return
-        if approach in self.alignment_sets and len(self.alignment_sets[approach]) > 0:
-            return
-        self.alignment_sets[approach] = []
+        pairs = []
         for v1_idx, video1 in enumerate(self.videos):
             for v2_idx, video2 in enumerate(self.videos):
-                # TODO: check one-by-one generation!
                 if v1_idx >= v2_idx:
                     continue
-                alignments_1 = []
-                alignments_2 = []
-                ### between subgoals
-                for subgoal_def in self.subgoals:
-                    contents1 = video1.get_subgoal_summary_multimodal_contents(subgoal_def["title"])
-                    contents2 = video2.get_subgoal_summary_multimodal_contents(subgoal_def["title"])
-                    if len(contents1) == 0 or len(contents2) == 0:
-                        continue
-                    subgoal_alignments_1, subgoal_alignments_2 = get_subgoal_alignments_v4(
-                        contents1, contents2, subgoal_def["title"], self.task
-                    )
-                    for alignment in [*subgoal_alignments_1, *subgoal_alignments_2]:
-                        alignment["subgoal_title"] = subgoal_def["title"]
-                    alignments_1.extend(self.__reformat_alignments_v2(
-                        subgoal_alignments_1, video1, video2
-                    ))
-                    alignments_2.extend(self.__reformat_alignments_v2(
-                        subgoal_alignments_2, video2, video1
-                    ))
-                
-                ### between meta
-                meta_alignments_1, meta_alignments_2 = get_steps_alignments_v4(
-                    contents1, contents2, self.task
-                )
-                for alignment in [*meta_alignments_1, *meta_alignments_2]:
-                    alignment["subgoal_title"] = META_TITLE
-                
-                alignments_1.extend(self.__reformat_alignments_v2(
-                    meta_alignments_1, video1, video2
-                ))
-                alignments_2.extend(self.__reformat_alignments_v2(
-                    meta_alignments_2, video2, video1
-                ))
-                    
-                self.alignment_sets[approach].append({
-                    "alignments": alignments_1,
-                    "video_id": video1.video_id,
-                })
-                self.alignment_sets[approach].append({
-                    "alignments": alignments_2,
-                    "video_id": video2.video_id,
-                })
+                pairs.append((video1, video2))
+
+        ### only the (pair, subgoal) keys that were not generated before or whose summaries changed, e.g. the pairs of a new video
+        version = get_prompt_versions()[approach]
+        subgoals_fingerprint = self.__get_fingerprint("subgoals", self.task)
+        pair_fingerprints = {}
+        for video1, video2 in pairs:
+            pair_fingerprints[(video1.video_id, video2.video_id)] = fingerprint(version, self.task, subgoals_fingerprint,
+                self.__get_fingerprint("summaries", video1.video_id), self.__get_fingerprint("summaries", video2.video_id))
+        done_keys = self.__get_alignment_keys(approach, [subgoal_def["title"] for subgoal_def in self.subgoals] + [META_TITLE],
+            pair_fingerprints, ordered=False)
+
+        ### collect the independent (pair, subgoal) calls
+        subgoal_calls = []
+        subgoal_labels = []
+        subgoal_calls_per_pair = []
+        meta_calls = []
+        meta_labels = []
+        meta_call_per_pair = []
+        for video1, video2 in pairs:
+            cur_subgoal_calls = []
+            ### between subgoals
+            for subgoal_def in self.subgoals:
+                contents1 = video1.get_subgoal_summary_multimodal_contents(subgoal_def["title"])
+                contents2 = video2.get_subgoal_summary_multimodal_contents(subgoal_def["title"])
+                if len(contents1) == 0 or len(contents2) == 0:
+                    continue
+                if (video1.video_id, video2.video_id, subgoal_def["title"]) in done_keys:
+                    continue
+                cur_subgoal_calls.append((subgoal_def["title"], len(subgoal_calls)))
+                subgoal_calls.append((contents1, contents2, subgoal_def["title"], self.task))
+                subgoal_labels.append({"video_id": video1.video_id, "other_video_id": video2.video_id, "subgoal": subgoal_def["title"]})
+            subgoal_calls_per_pair.append(cur_subgoal_calls)
+            ### between meta
+            if (video1.video_id, video2.video_id, META_TITLE) in done_keys:
+                meta_call_per_pair.append(None)
+                continue
+            meta_call_per_pair.append(len(meta_calls))
+            meta_calls.append((contents1, contents2, self.task))
+            meta_labels.append({"video_id": video1.video_id, "other_video_id": video2.video_id, "subgoal": META_TITLE})
+
+        if len(subgoal_calls) == 0 and len(meta_calls) == 0:
+            self.__set_pair_fingerprints(approach, pair_fingerprints)
+            return
+
+        if self.batch_runner is not None:
+            subgoal_results = self.__batch_with_fallback("subgoal_alignments", get_subgoal_alignments_v4,
+                get_subgoal_alignments_v4_request, get_subgoal_alignments_v4_response, subgoal_calls, subgoal_labels)
+            meta_results = self.__batch_with_fallback("steps_alignments", get_steps_alignments_v4,
+                get_steps_alignments_v4_request, get_steps_alignments_v4_response, meta_calls, meta_labels)
+        else:
+            subgoal_results = self.__map(get_subgoal_alignments_v4, subgoal_calls, subgoal_labels)
+            meta_results = self.__map(get_steps_alignments_v4, meta_calls, meta_labels)
+
+        ### gather the results in the order of the pairs, one alignment set per (video, other video, subgoal)
+        for pair_idx, (video1, video2) in enumerate(pairs):
+            for subgoal_title, call_idx in subgoal_calls_per_pair[pair_idx]:
+                subgoal_alignments_1, subgoal_alignments_2 = subgoal_results[call_idx]
+                for alignment in [*subgoal_alignments_1, *subgoal_alignments_2]:
+                    alignment["subgoal_title"] = subgoal_title
+                self.__add_alignment_set(approach, video1, video2, subgoal_title,
+                    self.__reformat_alignments_v2(subgoal_alignments_1, video1, video2))
+                self.__add_alignment_set(approach, video2, video1, subgoal_title,
+                    self.__reformat_alignments_v2(subgoal_alignments_2, video2, video1))
+
+            if meta_call_per_pair[pair_idx] is None:
+                continue
+            meta_alignments_1, meta_alignments_2 = meta_results[meta_call_per_pair[pair_idx]]
+            for alignment in [*meta_alignments_1, *meta_alignments_2]:
+                alignment["subgoal_title"] = META_TITLE
+            self.__add_alignment_set(approach, video1, video2, META_TITLE,
+                self.__reformat_alignments_v2(meta_alignments_1, video1, video2))
+            self.__add_alignment_set(approach, video2, video1, META_TITLE,
+                self.__reformat_alignments_v2(meta_alignments_2, video2, video1))
+        self.__ground_alignments(approach)
+        self.__set_pair_fingerprints(approach, pair_fingerprints)
     
     ## BASELINE 1
     def __generate_alignments_baseline_1(self):
         approach = BASELINES[0]
         if len(self.videos) < 2:
             return
-        if approach in self.alignment_sets and len(self.alignment_sets[approach]) > 0:
-            return
-        
-        self.alignment_sets[approach] = []
+        ### the alignments are grounded in the segments of the first video
+        version = get_prompt_versions()[approach]
+        contents_fingerprints = {video.video_id: self.__get_contents_fingerprint(video) for video in self.videos}
+        pair_fingerprints = {}
+        for video1 in self.videos:
+            for video2 in self.videos:
+                if video1 is video2:
+                    continue
+                pair_fingerprints[(video1.video_id, video2.video_id)] = fingerprint(version, self.task,
+                    contents_fingerprints[video1.video_id], contents_fingerprints[video2.video_id],
+                    self.__get_fingerprint("segmentation", video1.video_id))
+        done_keys = self.__get_alignment_keys(approach, [META_TITLE], pair_fingerprints, ordered=True)
+
+        pairs = []
+        calls = []
         for v1_idx, video1 in enumerate(self.videos):
             for v2_idx, video2 in enumerate(self.videos):
                 if v1_idx == v2_idx:
                     continue
+                if (video1.video_id, video2.video_id, META_TITLE) in done_keys:
+                    continue
                 ### between meta
                 contents1 = video1.get_all_contents()
                 contents2 = video2.get_all_contents()
                 if len(contents1) == 0 or len(contents2) == 0:
                     continue
-                meta_alignments = get_transcript_alignments_v3(
-                    contents1, contents2, self.task
-                )
-                for alignment in meta_alignments:
-                    alignment["subgoal_title"] = META_TITLE
-
-                self.alignment_sets[approach].append({
-                    "alignments": self.__reformat_alignments(meta_alignments, video1, video2),
-                    "video_id": video1.video_id,
-                })
+                pairs.append((video1, video2))
+                calls.append((contents1, contents2, self.task))
+
+        if len(calls) == 0:
+            self.__set_pair_fingerprints(approach, pair_fingerprints)
+            return
 
-    def generate_alignments(self):
-        self.__generate_alignments_1()
-        self.__generate_alignments_baseline_1()
+        results = self.__map(get_transcript_alignments_v3, calls,
+            [{"video_id": video1.video_id, "other_video_id": video2.video_id, "subgoal": META_TITLE} for video1, video2 in pairs])
 
-    def __cluster_v2(self, items, similarity_threshold, item_to_text_f, summarization_f):
+        for (video1, video2), meta_alignments in zip(pairs, results):
+            for alignment in meta_alignments:
+                alignment["subgoal_title"] = META_TITLE
+            self.__add_alignment_set(approach, video1, video2, META_TITLE,
+                self.__reformat_alignments_v2(meta_alignments, video1, video2))
+        self.__ground_alignments(approach)
+        self.__set_pair_fingerprints(approach, pair_fingerprints)
+
+    def generate_alignments(self, approaches=None):
+        if approaches is None:
+            approaches = APPROACHES + BASELINES
+        ### notables generated before the link sets were tracked were built from the current alignments
+        for approach in approaches:
+            if f"notables_{approach}" in self.hooks and f"link_sets_{approach}" not in self.hooks:
+                self.hooks[f"link_sets_{approach}"] = self.__get_link_sets(approach)
+        if APPROACHES[0] in approaches:
+            self.__generate_alignments_1()
+        if BASELINES[0] in approaches:
+            self.__generate_alignments_baseline_1()
+
+    async def __cluster_v2(self, items, similarity_threshold, item_to_text_f, summarization_f):
         if len(items) == 0:
             return []
         texts = []
         for item in items:
             texts.append(item_to_text_f(item))
-        cluster_labels = clustering_custom(texts, similarity_threshold)
+        ### embedding and clustering are CPU-bound, keep the event loop free for the pending calls
+        cluster_labels = await asyncio.to_thread(clustering_custom, texts, similarity_threshold)
         clusters = {}
         for index, label in enumerate(cluster_labels):
             if label not in clusters:
                 clusters[label] = []
             clusters[label].append(index)
         
+        clusters = [cluster for cluster in clusters.values() if len(cluster) > 0]
+        summaries = await asyncio.gather(*[
+            summarization_f([items[index] for index in cluster]) for cluster in clusters
+        ])
         results = []
-        for cluster in clusters.values():
-            if len(cluster) < 1:
-                continue
-            cur_items = [items[index] for index in cluster]
-            summary = summarization_f(cur_items)
+        for cluster, summary in zip(clusters, summaries):
             results.append({
                 **summary,
                 "links": cluster,
             })
         return results
 
-    def __generate_notable_v2(self, root_alignments):
+    async def __generate_notable_v2(self, root_alignments, video_ids=None):
+        """
+        Notables of the videos in `video_ids` (all videos if None) from their alignments
+        """
         if len(root_alignments) < 1:
             return []
         notables = []
@@ -348,9 +761,12 @@ class VideoPool:
         def __link_to_text(link):
             return link["title"] + ": " + link["description"]
 
+        groups = []
         for video_id, all_alignments in alignments_per_video.items():
             if len(all_alignments) < 1:
                 continue
+            if video_ids is not None and video_id not in video_ids:
+                continue
 
             video = self.get_video(video_id)
             if video is None:
@@ -378,102 +794,177 @@ class VideoPool:
 
             ### cluster alignments per aspect
             for subgoal_aspect, alignments in alignments_per_subgoal_aspect.items():
-                new_notables = []
                 if len(alignments) < 1:
                     continue
-                subgoal = subgoal_aspect.split("+")[0]
-                aspect = subgoal_aspect.split("+")[1]
-                ### clustering
-                def __get_notable(links):
-                    if len(links) < 1:
-                        return None
+                groups.append((video_id, subgoal_aspect, alignments))
 
-                    if len(links) == 1:
-                        return {
-                            "title": links[0]["title"],
-                            "description": links[0]["description"],
-                            "reasoning": links[0]["reasoning"],
-                            "comparison": links[0]["comparison"],
-                        }
+        async def __get_group_notables(video_id, subgoal_aspect, alignments):
+            group_notables = []
+            subgoal = subgoal_aspect.split("+")[0]
+            aspect = subgoal_aspect.split("+")[1]
+            ### clustering
+            async def __get_notable(links):
+                if len(links) < 1:
+                    return None
 
-                    contents = __get_notable_links_contents(links)
-                    summary = get_notable_v4(contents, subgoal, aspect, self.task)
-                    return summary
-                new_notables = self.__cluster_v2(alignments, SIMILARITY_THRESHOLD_NOTABLE, __link_to_text, __get_notable)
-
-                for notable in new_notables:
-                    cur_links = [alignments[index] for index in notable["links"]]
-                    ### merge links with the same video_id
-                    cur_links_dict = {}
-                    for link in cur_links:
-                        key = link["other_video_id"] + "+" + link["relation"]
-                        if key not in cur_links_dict:
-                            cur_links_dict[key] = []
-                        cur_links_dict[key].append(link)
-                    merged_links = []
-                    for key, links in cur_links_dict.items():
-                        other_video_id = key.split('+')[0]
-                        relation = key.split('+')[1]
-                        new_link = __get_notable(links)
-                        merged_links.append({
-                            "id": links[0]["id"],
-                            "other_video_id": other_video_id,
-                            "title": new_link["title"],
-                            "description": new_link["description"],
-                            "reasoning": new_link["reasoning"],
-                            "comparison": new_link["comparison"],
-                            "aspect": aspect,
-                            "subgoal": subgoal,
-                            "relation": relation,
-                            "importance": __calculate_notable_importance(links),
-                            "seconds": __calculate_notable_seconds(links),
-                        })
-
-                    notables.append({
-                        "id": f"notable-{video_id}-{random_uid()}",
-                        "video_id": video_id,
-                        "title": notable["title"],
-                        "description": notable["description"],
-                        "reasoning": notable["reasoning"],
-                        "comparison": notable["comparison"],
-                        "subgoal": subgoal,
+                if len(links) == 1:
+                    return {
+                        "title": links[0]["title"],
+                        "description": links[0]["description"],
+                        "reasoning": links[0]["reasoning"],
+                        "comparison": links[0]["comparison"],
+                    }
+
+                contents = __get_notable_links_contents(links)
+                summary = await get_notable_v4_async(contents, subgoal, aspect, self.task)
+                return summary
+            new_notables = await self.__cluster_v2(alignments, SIMILARITY_THRESHOLD_NOTABLE, __link_to_text, __get_notable)
+
+            for notable in new_notables:
+                cur_links = [alignments[index] for index in notable["links"]]
+                ### merge links with the same video_id
+                cur_links_dict = {}
+                for link in cur_links:
+                    key = link["other_video_id"] + "+" + link["relation"]
+                    if key not in cur_links_dict:
+                        cur_links_dict[key] = []
+                    cur_links_dict[key].append(link)
+                new_links = await asyncio.gather(*[
+                    __get_notable(links) for links in cur_links_dict.values()
+                ])
+                merged_links = []
+                for (key, links), new_link in zip(cur_links_dict.items(), new_links):
+                    other_video_id = key.split('+')[0]
+                    relation = key.split('+')[1]
+                    merged_links.append({
+                        "id": links[0]["id"],
+                        "other_video_id": other_video_id,
+                        "title": new_link["title"],
+                        "description": new_link["description"],
+                        "reasoning": new_link["reasoning"],
+                        "comparison": new_link["comparison"],
                         "aspect": aspect,
-                        "links": merged_links,
-                        "importance": __calculate_notable_importance(cur_links),
-                        "step_aspect_complexity": len(new_notables),
-                        "uniqueness": 0,
-                        "seconds": __calculate_notable_seconds(cur_links),
+                        "subgoal": subgoal,
+                        "relation": relation,
+                        "importance": __calculate_notable_importance(links),
+                        "seconds": __calculate_notable_seconds(links),
                     })
+
+                group_notables.append({
+                    "id": f"notable-{video_id}-{random_uid()}",
+                    "video_id": video_id,
+                    "title": notable["title"],
+                    "description": notable["description"],
+                    "reasoning": notable["reasoning"],
+                    "comparison": notable["comparison"],
+                    "subgoal": subgoal,
+                    "aspect": aspect,
+                    "links": merged_links,
+                    "importance": __calculate_notable_importance(cur_links),
+                    "step_aspect_complexity": len(new_notables),
+                    "uniqueness": 0,
+                    "seconds": __calculate_notable_seconds(cur_links),
+                })
+            return group_notables
+
+        all_group_notables = await asyncio.gather(*[
+            call_with_labels_async({"video_id": video_id, "subgoal": subgoal_aspect.split("+")[0]},
+                __get_group_notables, video_id, subgoal_aspect, alignments)
+            for video_id, subgoal_aspect, alignments in groups
+        ])
+        for group_notables in all_group_notables:
+            notables.extend(group_notables)
         
         ### sort links of notables by importance
         for notable in notables:
             notable["links"] = sorted(notable["links"], key=lambda x: x["importance"], reverse=True)
 
+        self.__set_notables_uniqueness(notables, root_alignments)
+        return notables
+
+    def __set_notables_uniqueness(self, notables, root_alignments):
         ### calculate uniquness of each notable
-        video_cnt = len(alignments_per_video.keys())
+        video_cnt = len(set([alignment["video_id"] for alignment in root_alignments]))
         if video_cnt < 1:
             video_cnt = 1
         for notable in notables:
             notable["uniqueness"] = len(notable["links"]) / video_cnt
-        return notables
     
-    def find_notables(self):
-        for approach in APPROACHES:
+    def find_notables(self, approaches=None):
+        asyncio.run(self.__find_notables(approaches))
+
+    async def __find_notables(self, approaches=None):
+        """
+        (Re)generate the notables of the videos whose link sets changed since the notables were generated,
+        all of them if the notable prompt changed
+        """
+        if approaches is None:
+            approaches = APPROACHES + BASELINES
+        version = get_prompt_versions()["notables"]
+        keys = []
+        affected_per_approach = []
+        for approach in approaches:
             if approach not in self.alignment_sets:
                 continue
-            if f"notables_{approach}" not in self.hooks:
-                self.hooks[f"notables_{approach}"] = self.__generate_notable_v2(self.alignment_sets[approach])
+            ### hooks generated before their inputs were tracked were built from the current notables
+            if f"hooks_{approach}" in self.hooks and f"hook_inputs_{approach}" not in self.hooks:
+                self.hooks[f"hook_inputs_{approach}"] = self.__get_hook_inputs(self.hooks.get(f"notables_{approach}", []))
+            if not self.__is_fresh("notables", approach, version, f"notables_{approach}" in self.hooks):
+                self.hooks.pop(f"notables_{approach}", None)
+                self.hooks.pop(f"link_sets_{approach}", None)
 
-        for baseline in BASELINES:
-            if baseline not in self.alignment_sets:
-                continue
-            if f"notables_{baseline}" not in self.hooks:
-                self.hooks[f"notables_{baseline}"] = self.__generate_notable_v2(self.alignment_sets[baseline])
+            link_sets = self.__get_link_sets(approach)
+            if f"notables_{approach}" not in self.hooks or f"link_sets_{approach}" not in self.hooks:
+                affected = None
+            else:
+                previous_link_sets = self.hooks[f"link_sets_{approach}"]
+                affected = set()
+                for video_id in set(link_sets.keys()) | set(previous_link_sets.keys()):
+                    if link_sets.get(video_id) != previous_link_sets.get(video_id):
+                        affected.add(video_id)
+                if len(affected) == 0:
+                    continue
+            keys.append(approach)
+            affected_per_approach.append(affected)
+
+        all_notables = await asyncio.gather(*[
+            self.__generate_notable_v2(self.alignment_sets[approach], affected)
+            for approach, affected in zip(keys, affected_per_approach)
+        ])
+        for approach, affected, notables in zip(keys, affected_per_approach, all_notables):
+            if affected is not None:
+                ### keep the notables of the videos whose links did not change
+                kept_notables = [
+                    notable for notable in self.hooks[f"notables_{approach}"] if notable["video_id"] not in affected
+                ]
+                notables = kept_notables + notables
+                ### the number of videos may have changed
+                self.__set_notables_uniqueness(notables, self.alignment_sets[approach])
+            self.hooks[f"notables_{approach}"] = notables
+            self.hooks[f"link_sets_{approach}"] = self.__get_link_sets(approach)
+            self.__set_fingerprint("notables", approach, version)
+
+    def __get_hook_inputs(self, notables):
+        """
+        Fingerprint of the ids of the notables linking to each video, the input of the hooks of the video
+        """
+        ids_per_video = {}
+        for notable in notables:
+            for link in notable["links"]:
+                if link["other_video_id"] not in ids_per_video:
+                    ids_per_video[link["other_video_id"]] = set()
+                ids_per_video[link["other_video_id"]].add(notable["id"])
+        return {
+            video_id: hashlib.sha1("\n".join(sorted(ids)).encode("utf-8")).hexdigest()
+            for video_id, ids in ids_per_video.items()
+        }
 
-    def __generate_hooks_v2(self, root_notables, approach="cluster"): #llm
+    async def __generate_hooks_v2(self, root_notables, approach="cluster", video_ids=None): #llm
         links_to = {}
         for notable in root_notables:
             for link in notable["links"]:
+                if video_ids is not None and link["other_video_id"] not in video_ids:
+                    continue
                 key = link["other_video_id"] + "+" + link["subgoal"] + "+" + link["relation"] + "+" + link["aspect"]
                 if key not in links_to:
                     links_to[key] = []
@@ -516,8 +1007,8 @@ class VideoPool:
         def __link_to_text(link):
             return link["comparison"]
         
-        all_hooks = []
-        for key, links in links_to.items():
+        async def __get_key_hooks(key, links):
+            key_hooks = []
             video_id = key.split("+")[0]
             subgoal = key.split("+")[1]
             relation = key.split("+")[2]
@@ -525,14 +1016,14 @@ class VideoPool:
 
             video = self.get_video(video_id)
             if video is None or len(links) < 1:
-                continue
+                return key_hooks
             new_hooks = []
             if approach == "llm":
                 contents = __get_hook_links_contents(links)
-                new_hooks = get_hooks_v4(contents, subgoal, relation, aspect, self.task)
+                new_hooks = await get_hooks_v4_async(contents, subgoal, relation, aspect, self.task)
             else:
                 ### clustering
-                def __get_hook(links):
+                async def __get_hook(links):
                     if len(links) < 1:
                         return None
 
@@ -543,9 +1034,9 @@ class VideoPool:
                             "comparison": links[0]["comparison"],
                         }
                     contents = __get_hook_links_contents(links)
-                    summary = get_hook_v4(contents, subgoal, relation, aspect, self.task)
+                    summary = await get_hook_v4_async(contents, subgoal, relation, aspect, self.task)
                     return summary
-                new_hooks = self.__cluster_v2(links, SIMILARITY_THRESHOLD_HOOK, __link_to_text, __get_hook)
+                new_hooks = await self.__cluster_v2(links, SIMILARITY_THRESHOLD_HOOK, __link_to_text, __get_hook)
 
             new_hooks_dict = {}
             for hook in new_hooks:
@@ -571,7 +1062,7 @@ class VideoPool:
 
             for hook in merged_hooks:
                 cur_links = [links[index] for index in hook["links"]]
-                all_hooks.append({
+                key_hooks.append({
                     "id": f"hook-{video_id}-{random_uid()}",
                     "video_id": video_id,
                     "subgoal": subgoal,
@@ -583,19 +1074,68 @@ class VideoPool:
                     "links": cur_links,
                     "importance": __calculate_hook_importance(cur_links),
                 })
+            return key_hooks
+
+        all_hooks = []
+        all_key_hooks = await asyncio.gather(*[
+            call_with_labels_async({"video_id": key.split("+")[0], "subgoal": key.split("+")[1]}, __get_key_hooks, key, links)
+            for key, links in links_to.items()
+        ])
+        for key_hooks in all_key_hooks:
+            all_hooks.extend(key_hooks)
         for hook in all_hooks:
             hook["links"] = sorted(hook["links"], key=lambda x: x["importance"], reverse=True)
         return all_hooks
 
-    def generate_hooks(self):
-        for approach in APPROACHES:
+    def generate_hooks(self, approaches=None):
+        asyncio.run(self.__generate_hooks(approaches))
+
+    async def __generate_hooks(self, approaches=None):
+        """
+        (Re)generate the hooks of the videos whose incoming notables changed since the hooks were generated,
+        all of them if the hook prompt changed
+        """
+        if approaches is None:
+            approaches = APPROACHES + BASELINES
+        version = get_prompt_versions()["hooks"]
+        keys = []
+        affected_per_approach = []
+        for approach in approaches:
             if f"notables_{approach}" not in self.hooks:
                 continue
-            if f"hooks_{approach}" not in self.hooks:
-                self.hooks[f"hooks_{approach}"] = self.__generate_hooks_v2(self.hooks[f"notables_{approach}"])
+            if not self.__is_fresh("hooks", approach, version, f"hooks_{approach}" in self.hooks):
+                self.hooks.pop(f"hooks_{approach}", None)
+                self.hooks.pop(f"hook_inputs_{approach}", None)
+            hook_inputs = self.__get_hook_inputs(self.hooks[f"notables_{approach}"])
+            if f"hooks_{approach}" not in self.hooks or f"hook_inputs_{approach}" not in self.hooks:
+                affected = None
+            else:
+                previous_hook_inputs = self.hooks[f"hook_inputs_{approach}"]
+                affected = set()
+                for video_id in set(hook_inputs.keys()) | set(previous_hook_inputs.keys()):
+                    if hook_inputs.get(video_id) != previous_hook_inputs.get(video_id):
+                        affected.add(video_id)
+            keys.append(approach)
+            affected_per_approach.append(affected)
 
-        for baseline in BASELINES:
-            if f"notables_{baseline}" not in self.hooks:
-                continue
-            if f"hooks_{baseline}" not in self.hooks:
-                self.hooks[f"hooks_{baseline}"] = self.__generate_hooks_v2(self.hooks[f"notables_{baseline}"])
\ No newline at end of file
+        all_hooks = await asyncio.gather(*[
+            self.__generate_hooks_v2(self.hooks[f"notables_{approach}"], video_ids=affected)
+            if affected is None or len(affected) > 0 else asyncio.sleep(0, [])
+            for approach, affected in zip(keys, affected_per_approach)
+        ])
+        for approach, affected, hooks in zip(keys, affected_per_approach, all_hooks):
+            if affected is not None:
+                ### keep the hooks of the other videos, with the current uniqueness of their notables
+                notables = {notable["id"]: notable for notable in self.hooks[f"notables_{approach}"]}
+                kept_hooks = []
+                for hook in self.hooks[f"hooks_{approach}"]:
+                    if hook["video_id"] in affected:
+                        continue
+                    for link in hook["links"]:
+                        if link["id"] in notables:
+                            link["uniqueness"] = notables[link["id"]]["uniqueness"]
+                    kept_hooks.append(hook)
+                hooks = kept_hooks + hooks
+            self.hooks[f"hooks_{approach}"] = hooks
+            self.hooks[f"hook_inputs_{approach}"] = self.__get_hook_inputs(self.hooks[f"notables_{approach}"])
+            self.__set_fingerprint("hooks", approach, version)
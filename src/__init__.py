@@ -2,4 +2,9 @@ SIMILARITY_THRESHOLD_NOTABLE = 0.7
 SIMILARITY_THRESHOLD_HOOK = 0.7
 
 PATH = "static/results/"
+### results of runs with local stand-ins for the network, ASR or Batch API
+LOCAL_PATH = "static/results/local/"
 META_TITLE = "$meta$"
+
+### dtype of the persisted sentence embeddings (float32 or float16)
+SENTENCE_EMBEDDINGS_DTYPE = "float32"